@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Benchmark crowbar on synthetic workloads, tracking throughput and peak memory.
+
+Each workload is timed as the best of N runs, after a warm-up run. Throughput
+is reported in bytes and tokens (whitespace-separated words) of generated
+output per second. Peak memory is measured with tracemalloc, in a separate run.
+
+Usage: python benchmarks/bench.py [--repeat N] [--only NAME ...]
+                                  [--output results.json]
+                                  [--compare baseline.json [--threshold 0.1]]
+"""
+
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Union
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT))
+import crowbar
+from crowbar import *
+
+# A workload prepares its input in a temporary directory and returns a function
+# running it once, which returns the generated output (or the file holding it).
+Workload = Callable[[Path], Callable[[], Union[str, Path]]]
+WORKLOADS: Dict[str, Workload] = {}
+
+
+class SkipWorkload(Exception):
+    """Raised by a workload which cannot run here, e.g. for a missing dependency."""
+
+
+def workload(name: str) -> Callable[[Workload], Workload]:
+    def decorator(f: Workload) -> Workload:
+        WORKLOADS[name] = f
+        return f
+
+    return decorator
+
+
+@component
+def field(emit, ctype, name):
+    emit(f"{ctype} {name};")
+
+
+@component
+def struct(emit, name, nfields):
+    emit(
+        f"struct {name} {{",
+        [field("int", f"field_{i}") for i in range(nfields)],
+        "};",
+        nl,
+    )
+
+
+@component
+def nested(emit, depth):
+    if depth == 0:
+        emit("leaf();")
+        return
+    emit(f"if (cond_{depth}) {{", [nested(depth - 1), "x++;"], "}")
+
+
+@workload("emitter_wide")
+def emitter_wide(tmp: Path):
+    """Many siblings, shallow: 200 structs of 50 fields."""
+    tree = [struct(f"s{i}", 50) for i in range(200)]
+    return lambda: render(tree)
+
+
+@workload("emitter_deep")
+def emitter_deep(tmp: Path):
+    """Deep nesting, repeated: 50 trees 200 levels deep."""
+    tree = [nested(200) for _ in range(50)]
+    return lambda: render(tree)
+
+
+@workload("emitter_append")
+def emitter_append(tmp: Path):
+    """The wide and deep trees, with the list-append pattern render() replaces."""
+    tree = [struct(f"s{i}", 50) for i in range(200)]
+    tree += [nested(200) for _ in range(50)]
+
+    def run():
+        out: List[str] = []
+        Emitter(writer=out.append)(tree)
+        return "".join(out)
+
+    return run
+
+
+@workload("emitter_write")
+def emitter_write(tmp: Path):
+    """The wide tree, written to a file through a buffered Emitter."""
+    tree = [struct(f"s{i}", 50) for i in range(200)]
+    out = tmp / "emitter.c"
+
+    def run():
+        with open(out, "w") as fh, Emitter(fh, flush_threshold=1 << 16) as emit:
+            emit(tree)
+        return out
+
+    return run
+
+
+@workload("blocks_many")
+def blocks_many(tmp: Path):
+    """A file of 5000 small blocks, evaluated without the cache."""
+    src = tmp / "blocks.py"
+    src.write_text(
+        "".join(
+            f"# <<crowbar emit(f'value_{i} = {{{i} * 2}}')>>\n# <<end>>\nx = {i}\n"
+            for i in range(5000)
+        )
+    )
+    out = tmp / "blocks.out.py"
+    processor = CrowbarPreprocessor()
+
+    def run():
+        processor.process_file(src, out)
+        return out
+
+    return run
+
+
+@workload("passthrough_huge")
+def passthrough_huge(tmp: Path):
+    """64MB of text outside blocks, with 8 blocks spread over it."""
+    chunk = "".join(f"static int table_{i} = {i};\n" for i in range(100_000))
+    block = "/* <<crowbar\n * emit('generated();')\n * >>\n * <<end>> */\n"
+    src = tmp / "huge.c"
+    with open(src, "w") as fh:
+        while fh.tell() < 64 << 20:
+            fh.write(chunk)
+            fh.write(block)
+    out = tmp / "huge.out.c"
+    processor = CrowbarPreprocessor()
+
+    def run():
+        processor.process_file(src, out)
+        return out
+
+    return run
+
+
+@workload("site")
+def site(tmp: Path):
+    """Rendering the project website, see site/."""
+    sys.path.insert(0, str(ROOT / "site"))
+    try:
+        from page_index import index_page
+    except ImportError as e:
+        raise SkipWorkload(f"cannot import the site ({e})")
+    return lambda: render(index_page())
+
+
+def measure(name: str, make: Workload, repeat: int) -> Optional[Dict[str, Any]]:
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            run = make(Path(tmp))
+        except SkipWorkload as e:
+            print(f"{name:<18} skipped: {e}", file=sys.stderr)
+            return None
+        result = run()  # warm-up
+        output = result.read_text() if isinstance(result, Path) else result
+        size = len(output.encode("utf-8"))
+        tokens = len(output.split())
+        del output, result
+        times = []
+        for _ in range(repeat):
+            t_start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - t_start)
+        best = min(times)
+        tracemalloc.start()
+        try:
+            run()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return {
+        "seconds": best,
+        "bytes": size,
+        "tokens": tokens,
+        "bytes_per_s": size / best,
+        "tokens_per_s": tokens / best,
+        "peak_memory": peak,
+    }
+
+
+def compare(
+    results: Dict[str, Dict[str, Any]], baseline: Dict[str, Any], threshold: float
+) -> List[str]:
+    """Print how `results` compare to the `baseline`, returning any regressions."""
+    regressions = []
+    print(f"\ncompared to baseline (threshold {threshold:.0%}):")
+    for name, result in results.items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"{name:<18} (not in baseline)")
+            continue
+        speed = result["bytes_per_s"] / base["bytes_per_s"]
+        memory = result["peak_memory"] / max(1, base["peak_memory"])
+        flags = []
+        if speed < 1 - threshold:
+            flags.append("slower")
+        if memory > 1 + threshold:
+            flags.append("more memory")
+        if flags:
+            regressions.append(f"{name}: {', '.join(flags)}")
+        print(
+            f"{name:<18} throughput {speed - 1:+7.1%}  peak memory {memory - 1:+7.1%}"
+            f"{'  REGRESSION' if flags else ''}"
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--repeat", type=int, default=5, help="best of N runs")
+    parser.add_argument(
+        "--only",
+        nargs="+",
+        choices=list(WORKLOADS),
+        metavar="NAME",
+        help=f"run only these workloads ({', '.join(WORKLOADS)})",
+    )
+    parser.add_argument("-o", "--output", help="write results to this JSON file")
+    parser.add_argument(
+        "--compare", metavar="BASELINE", help="JSON results to compare against"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="fraction by which throughput may drop, or peak memory grow, "
+        "before counting as a regression (default: 0.1)",
+    )
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.only or WORKLOADS:
+        result = measure(name, WORKLOADS[name], args.repeat)
+        if result is None:
+            continue
+        results[name] = result
+        print(
+            f"{name:<18} {result['seconds'] * 1000:9.2f}ms "
+            f"{result['bytes_per_s'] / 1e6:9.2f} MB/s "
+            f"{result['tokens_per_s'] / 1e6:8.2f} Mtok/s "
+            f"{result['peak_memory'] / 1e6:9.2f} MB peak"
+        )
+
+    report = {
+        "crowbar": crowbar.__version__,
+        "python": sys.version,
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s): " + "; ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -82,15 +82,72 @@ NOTE - if you have just one line of code, you can also write the first parts
     # <<end>>
 """
 
-from typing import Any, Callable, Dict, Optional, List, Union, Iterator, Tuple, Protocol
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Optional,
+    List,
+    Union,
+    Iterable,
+    Iterator,
+    Literal,
+    Sequence,
+    Tuple,
+    Protocol,
+    IO,
+    Mapping,
+    Set,
+    Hashable,
+    NamedTuple,
+    Awaitable,
+    cast,
+    overload,
+)
 
 import argparse
+import asyncio
+import builtins
+import contextvars
+import ctypes
+import ctypes.util
+import difflib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from dataclasses import asdict, dataclass, field
+import errno
+import glob
+import hashlib
+import hmac
+import importlib.util
+import inspect
+import io
+import itertools
+import json
+import marshal
+import mmap
 from pathlib import Path
+import pickle
+import queue
 import re
+import secrets
+import select
 import shutil
+import socket
+import struct
+import subprocess
+import sysconfig
 import tempfile
+import threading
+import time
 import sys
 import os
+from types import (
+    BuiltinFunctionType,
+    CodeType,
+    FrameType,
+    FunctionType,
+    ModuleType,
+)
 
 __version__ = "0.3.2"
 __description__ = "Crowbar - When clever hacking fails, crude whacking works!"
@@ -110,19 +167,24 @@ if True:
 
 # Special marker types
 class _Marker:
-    def __init__(self, marker_type: str):
+    def __init__(self, marker_type: str, name: str):
         self.__type = marker_type
+        self.__name = name
 
     def __repr__(self) -> str:
         return f"<{self.__type}>"
 
+    def __reduce__(self) -> str:
+        # pickle by reference, markers are recognized by identity
+        return self.__name
+
 
 # Global marker values
-nl = _Marker("newline")
-fl = _Marker("freshline")
-lc = _Marker("line-continue")
-indent = _Marker("indent")
-dedent = _Marker("dedent")
+nl = _Marker("newline", "nl")
+fl = _Marker("freshline", "fl")
+lc = _Marker("line-continue", "lc")
+indent = _Marker("indent", "indent")
+dedent = _Marker("dedent", "dedent")
 
 MARKER_START = "<<crowbar"
 MARKER_CODE_END = ">>"
@@ -139,7 +201,9 @@ class ComponentFunction(Protocol):
     __name__: str
     __doc__: str | None
 
-    def __call__(self, emit: EmitFunction, *args: Any, **kwargs: Any) -> None: ...
+    def __call__(
+        self, emit: EmitFunction, *args: Any, **kwargs: Any
+    ) -> Optional[Awaitable[None]]: ...
 
 
 WriterFunction = Callable[[str], Any]
@@ -163,17 +227,26 @@ class UnexpectedEOF(CrowbarError):
 
     def __init__(self, line_block_start: int, msg: str):
         self.line_block_start = line_block_start
+        self.msg = msg
         super().__init__(msg)
 
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return (type(self), (self.line_block_start, self.msg))
+
 
 class IndentationError(CrowbarError):
     """Raised if code lines don't share the same indentation prefix (minimum from line start to block opening marker)"""
 
     def __init__(self, block_start_lineno: int, code_lineno: int):
+        self.block_start_lineno = block_start_lineno
+        self.code_lineno = code_lineno
         super().__init__(
             f"code on line {code_lineno}, in block starting on line {block_start_lineno} - indentation is insufficient/wrong. All code lines must:\n\t1. Be indented as least as much as the block open marker ({MARKER_START})\n\t2. Use the same indentation for this part, for all code lines"
         )
 
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return (type(self), (self.block_start_lineno, self.code_lineno))
+
 
 class InvalidOutputPath(ValueError):
     def __init__(self, output_path: Path):
@@ -182,6 +255,9 @@ class InvalidOutputPath(ValueError):
             f"invalid `output_path` ({output_path}) - exists on file system but is NOT a file!"
         )
 
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return (type(self), (self.output_path,))
+
 
 class CodeEvalError(CrowbarError):
     def __init__(self, start_line: int, code_lines: List[str], exception: Exception):
@@ -193,6 +269,9 @@ class CodeEvalError(CrowbarError):
         self.message = f"""Code in block starting at line {start_line} raised an error:\n---[ {type(exception).__name__} ]---\n{errmsg}\n---\n\nThis is *may* be due to code being incorrectly indented. Remember to indent each time such that it follows the opening marker: '{MARKER_START}'. Crowbar extracted this code block:\n---\n{codemsg}---\n"""
         super().__init__(self.message)
 
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return (type(self), (self.start_line, self.code_lines, self.exception))
+
 
 class FileParseError(CrowbarError):
     def __init__(self, fpath: Fpath, e: Exception):
@@ -200,12 +279,22 @@ class FileParseError(CrowbarError):
         self.exception = e
         super().__init__(f"Error parsing '{fpath}':\n{type(e).__name__}: {str(e)}")
 
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return (type(self), (self.fpath, self.exception))
+
 
 class ComponentClosure:
-    def __init__(self, func: ComponentFunction, args: Tuple[Any], ctx: Dict[str, Any]):
+    def __init__(
+        self,
+        func: ComponentFunction,
+        args: Tuple[Any, ...],
+        ctx: Dict[str, Any],
+        memo: Optional["_RenderCache"] = None,
+    ):
         self.__func = func
         self.__args = args
         self.__kwargs = ctx
+        self._memo = memo
         # copy over metadata too
         self.__name__ = f"ComponentClosure[{func.__name__}]"
         self.__doc__ = func.__doc__
@@ -217,13 +306,31 @@ class ComponentClosure:
     def func(self) -> ComponentFunction:
         return self.__func
 
-    def __call__(self, emit: EmitFunction) -> None:
-        self.__func(emit, *self.__args, **self.__kwargs)
+    def cache_key(self) -> Hashable:
+        """Key identifying the output of this closure, raises TypeError if args are unhashable."""
+        kwargs = tuple(sorted(self.__kwargs.items()))
+        # like functools.lru_cache(typed=True), as 1 and 1.0 render differently
+        key = (
+            self.__args,
+            kwargs,
+            tuple(type(v) for v in self.__args),
+            tuple(type(v) for _, v in kwargs),
+        )
+        hash(key)
+        return key
+
+    def __call__(self, emit: EmitFunction) -> Optional[Awaitable[None]]:
+        return self.__func(emit, *self.__args, **self.__kwargs)
 
 
 class Component:
-    def __init__(self, func: ComponentFunction):
+    def __init__(self, func: ComponentFunction, cache: Union[bool, int] = False):
         self.__func = func
+        self._memo = None
+        if cache and inspect.iscoroutinefunction(func):
+            raise TypeError("async components cannot be cached")
+        if cache:
+            self._memo = _RenderCache(128 if cache is True else int(cache))
         # copy over metadata too
         self.__name__ = func.__name__
         self.__doc__ = func.__doc__
@@ -232,10 +339,34 @@ class Component:
         self.__annotations__ = getattr(func, "__annotations__", {})
 
     def __call__(self, *args: Any, **kwargs: Any) -> ComponentClosure:
-        return ComponentClosure(self.__func, args, kwargs)
+        return ComponentClosure(self.__func, args, kwargs, memo=self._memo)
+
+    def __reduce__(self) -> str:
+        # pickle by reference, as functions are
+        return self.__qualname__
+
+    def cache_info(self) -> Optional["CacheInfo"]:
+        """Statistics of the render cache, None if the component is not cached."""
+        return None if self._memo is None else self._memo.info()
+
+    def cache_clear(self) -> None:
+        if self._memo is not None:
+            self._memo.clear()
+
+
+@overload
+def component(func: ComponentFunction) -> Component: ...
 
 
-def component(func: ComponentFunction) -> Component:
+@overload
+def component(
+    *, cache: Union[bool, int] = False
+) -> Callable[[ComponentFunction], Component]: ...
+
+
+def component(
+    func: Optional[ComponentFunction] = None, *, cache: Union[bool, int] = False
+) -> Union[Component, Callable[[ComponentFunction], Component]]:
     """
     Decorator to create an Crowbar component.
 
@@ -244,35 +375,142 @@ def component(func: ComponentFunction) -> Component:
         def greet(emit, name):
             emit("Hello", nl, f"Name: {name}")
 
+        # render each distinct `struct(name, fields)` only once
+        @component(cache=256)
+        def struct(emit, name, fields):
+            ...
+
     Args:
         func: Function that takes emit and any positional- and keyword arguments
               desired.
+        cache: memoize the output of the component, keyed on its arguments (which
+              must be hashable, otherwise the component is rendered as usual).
+              Pass True for an LRU cache of 128 entries, or the number of entries
+              to keep. The component must render the same output for the same
+              arguments. Use `cache_info()` to see if caching pays off.
 
     Returns:
         A Component, which can be called with a context to produce a Component closure
         which in turn can be rendered with emit().
     """
-    return Component(func)
+    if func is None:
+        return lambda f: Component(f, cache=cache)
+    return Component(func, cache=cache)
+
+
+class _SupportsWrite(Protocol):
+    def write(self, s: str, /) -> Any: ...
+
+
+# Where an Emitter sends its output: a function (e.g. `out.append`), an object
+# with a `write` method (e.g. a file) or a file descriptor.
+Sink = Union[WriterFunction, _SupportsWrite, int]
+
+
+def _write_all(fd: int, data: bytes) -> None:
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+
+
+def _fd_writer(fd: int) -> WriterFunction:
+    return lambda s: _write_all(fd, s.encode("utf-8"))
+
+
+def _fd_bulk_writer(fd: int) -> Callable[[List[str]], None]:
+    iov_max = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 1024
+
+    def writev(chunks: List[str]) -> None:
+        for i in range(0, len(chunks), iov_max):
+            bufs = [c.encode("utf-8") for c in chunks[i : i + iov_max]]
+            written = os.writev(fd, bufs)
+            if written < sum(map(len, bufs)):
+                # partial write, write out the remainder the slow way
+                _write_all(fd, b"".join(bufs)[written:])
+
+    return writev
+
+
+def _as_writer(sink: Sink) -> WriterFunction:
+    if isinstance(sink, int):
+        return _fd_writer(sink)
+    if callable(sink):
+        return sink
+    return sink.write
+
+
+def _as_bulk_writer(sink: Sink) -> Callable[[List[str]], None]:
+    """Get a function writing a list of strings to `sink` in as few calls as possible."""
+    if isinstance(sink, int):
+        if hasattr(os, "writev"):
+            return _fd_bulk_writer(sink)
+        return lambda chunks: _fd_writer(sink)("".join(chunks))
+    # use `writelines` of the file whose `write` method we were given
+    target = sink if not callable(sink) else getattr(sink, "__self__", None)
+    if isinstance(target, list) and sink == target.append:
+        return target.extend
+    if target is not None and hasattr(target, "writelines"):
+        if sink is target or sink == getattr(target, "write", None):
+            writelines: Callable[[List[str]], None] = target.writelines
+            return writelines
+    write = _as_writer(sink)
+    return lambda chunks: write("".join(chunks))
+
+
+class _ActiveEmitters(threading.local):
+    """Emitters currently rendering in this thread, innermost last. See `capture()`."""
+
+    def __init__(self) -> None:
+        self.stack: List["Emitter"] = []
+
+
+_active = _ActiveEmitters()
 
 
 class Emitter:
     def __init__(
-        self, writer: WriterFunction, base_indent: str = "", indent_step: str = "   "
+        self,
+        writer: Sink,
+        base_indent: str = "",
+        indent_step: str = "   ",
+        flush_threshold: Optional[int] = None,
     ):
         """
         Create an emitter instance
 
         Args:
-            writer: Function to write output to (e.g., file.write)
+            writer: Function to write output to (e.g., file.write). Also accepts
+                    a file(-like) object or a file descriptor.
             base_indent: Base indentation applied to all output
             indent_step: String added for each indent level (default: "  ")
+            flush_threshold: if set, output is buffered and passed to `writer` in
+                    bulk (using `writelines`/`os.writev` where available) whenever
+                    at least this many characters are buffered. Call `flush()`
+                    (or use the emitter as a context manager) to write out the rest.
 
         Returns:
             None - all output is passed to the `writer`
         """
-        self.writer = writer
+        self.writer = _as_writer(writer)
         self.indent_step = indent_step
         self.base_indent = base_indent
+        self.flush_threshold = flush_threshold
+        self._chunks: Optional[List[str]] = None if flush_threshold is None else []
+        self._buffered = 0
+        self._write_chunks = _as_bulk_writer(writer)
+        self._indents: Dict[int, str] = {}
+        self._prefixes: Dict[int, str] = {}
+        # number of component bodies running, and the `_render` frame running the
+        # innermost one, with its depth in the call stack
+        self._depth = 0
+        self._frame: Optional[FrameType] = None
+        self._frame_depth = 0
+        self._log: Optional[List[Any]] = None
+        self._recordings = 0
+        # set by an AsyncEmitter, to start resolving async components and
+        # awaitables, and the output it is left to render once one is emitted
+        self._prepare_async: Optional[Callable[[Iterable[Any]], List[Any]]] = None
+        self._diverted: Optional[List[Iterator[Any]]] = None
         self.reset()
 
     def reset(self) -> None:
@@ -282,47 +520,626 @@ class Emitter:
         self._first = True
 
     def get_indent_string(self) -> str:
-        return self.base_indent + (self.indent_step * self.indent_level)
+        try:
+            return self._indents[self.indent_level]
+        except KeyError:
+            s = self.base_indent + (self.indent_step * self.indent_level)
+            if len(self._indents) < 256:
+                self._indents[self.indent_level] = s
+            return s
+
+    def flush(self) -> None:
+        """Write out any buffered output."""
+        if self._chunks:
+            self._write_chunks(self._chunks)
+            self._chunks.clear()
+            self._buffered = 0
+
+    def __enter__(self) -> "Emitter":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.flush()
+
+    def _buffer(self, s: str) -> None:
+        assert self._chunks is not None and self.flush_threshold is not None
+        self._chunks.append(s)
+        self._buffered += len(s)
+        if self._buffered >= self.flush_threshold:
+            self.flush()
 
     def __call__(self, *args: Any) -> None:
-        for arg in args:
-            if isinstance(arg, _Marker):
-                if arg == lc:
-                    self.indent = self.newline = False
-                elif arg == fl and not self._first:
-                    # first line is by definition a FL, don't change the emitter state
-                    self.indent = self.newline = True
-                elif arg == nl:
-                    self.writer("\n")
-                    self.indent = True
-                    self.newline = not self._first
-                elif arg == indent:
-                    self.indent_level += 1
-                elif arg == dedent:
-                    self.indent_level = max(0, self.indent_level - 1)
-            elif isinstance(arg, list):
-                self.__call__(indent, *arg, dedent)
-            elif isinstance(arg, ComponentClosure):
-                # component with context, provide emit function
-                arg(self.__call__)
-            elif arg is None:
-                continue
-            elif isinstance(arg, Component):
-                raise TypeError(
-                    f"emit() does not accept raw components - you must call it first, provide a context"
-                )
+        # Rather than recursing into lists, args are walked depth-first using
+        # an explicit stack of iterators. A `None` entry closes the indentation
+        # of a list. Component bodies run when they are emitted, as their output
+        # is rendered, so nesting components costs Python frames per level. Close
+        # to the recursion limit, components instead emit into a list, pushed
+        # onto the stack once the component returns, so trees of any depth can
+        # be rendered. The output of cached components
+        # is recorded as it is rendered, see `_RenderCache`.
+        stack: _RenderStack = [iter(args)]
+        _active.stack.append(self)
+        try:
+            self._render(stack)
+        finally:
+            _active.stack.pop()
+            if not self._depth:
+                # drop recordings left unfinished by errors
+                self._log, self._recordings = None, 0
+
+    def iter_chunks(self, *args: Any, chunk_size: int = 1 << 16) -> Iterator[str]:
+        """
+        Render `args`, yielding the output in chunks of roughly `chunk_size` characters.
+
+        Rendering is lazy: it runs in a separate thread, which is paused from
+        when a chunk is ready until the next one is asked for, so memory use does
+        not grow with the size of the output. Components run as when calling the
+        emitter, in a copy of the caller's `contextvars` context, but not in the
+        caller's thread. Output does not go to the emitter's writer. Usage:
+
+            with gzip.open("out.c.gz", "wt") as fh:
+                for chunk in emit.iter_chunks([function(f) for f in ast.functions]):
+                    fh.write(chunk)
+        """
+        self.flush()
+
+        def produce(put: Callable[[str], None]) -> None:
+            self._write_chunks = lambda chunks: put("".join(chunks))
+            self(*args)
+            self.flush()
+
+        saved = (self._chunks, self.flush_threshold, self._write_chunks)
+        self._chunks, self.flush_threshold = [], chunk_size
+        try:
+            yield from _produced(produce)
+        finally:
+            self._chunks, self.flush_threshold, self._write_chunks = saved
+            self._buffered = 0
+
+    def _prefix(self, key: int) -> str:
+        """Newline (if key < 0) and indentation preceding a line at level `key` (or `~key`)."""
+        s = self.base_indent + self.indent_step * (key if key >= 0 else ~key)
+        if key < 0:
+            s = "\n" + s
+        if len(self._prefixes) < 512:
+            self._prefixes[key] = s
+        return s
+
+    def _emit_nested(self, *args: Any) -> None:
+        if self._diverted is not None:
+            self._diverted.append(iter(self._prepare_async(args)))  # type: ignore[misc]
+            return
+        self._render([iter(args)])
+
+    def _divert(self, item: Any, stack: "_RenderStack") -> None:
+        """Leave the async `item` and the rest of `stack` for the AsyncEmitter to render."""
+        assert self._prepare_async is not None
+        if self._recordings:
+            raise TypeError(
+                "cached components cannot emit async components or awaitables"
+            )
+        if self._diverted is None:
+            self._diverted = []
+        if item is not None:
+            self._diverted.append(iter(self._prepare_async([item])))
+        while stack:
+            it = stack.pop()
+            if it is None:
+                self._diverted.append(iter([dedent]))
             else:
-                if self.newline:
-                    self.writer("\n")
-                if self.indent:
-                    self.writer(self.get_indent_string())
-                self.writer(str(arg))
+                self._diverted.append(iter(self._prepare_async(it)))  # type: ignore[arg-type]
+
+    def _depth_of(self, frame: FrameType) -> int:
+        """The depth of `frame` in the call stack, see `_render`."""
+        depth = 0
+        f: Optional[FrameType] = frame
+        while f is not None:
+            if f is self._frame:
+                return self._frame_depth + depth
+            depth += 1
+            f = f.f_back
+        return depth
+
+    def _record(self, memo: "_RenderCache", key: Hashable) -> "_Recording":
+        """Start recording what is rendered, to store it as the fragment for `key`."""
+        if self._log is None:
+            self._log = []
+        self._recordings += 1
+        return _Recording(memo, key, len(self._log))
+
+    def _stop_recording(self) -> None:
+        self._recordings -= 1
+        if not self._recordings:
+            self._log = None
+
+    def _render(self, stack: "_RenderStack") -> None:
+        chunks = self._chunks
+        prefixes = self._prefixes
+        # no need to keep count if we never flush (as with `render()`)
+        counting = (self.flush_threshold or 0) < sys.maxsize
+        # rendered strings and markers, while recording fragments of cached components
+        log = self._log
+        # this frame and its depth, found when running the first component body
+        frame: Optional[FrameType] = None
+        frame_depth = needed = 0
+        while stack:
+            it = stack[-1]
+            if it is None:
+                stack.pop()
+                self.indent_level = max(0, self.indent_level - 1)
+                if log is not None:
+                    log.append(dedent)
+                continue
+            if isinstance(it, _Recording):
+                stack.pop()
+                it.memo.store(it.key, tuple(log[it.start :]))  # type: ignore[index]
+                self._stop_recording()
+                log = self._log
+                continue
+            for arg in it:
+                if type(arg) is not str:
+                    if isinstance(arg, _Marker):
+                        if log is not None:
+                            log.append(arg)
+                        if arg == lc:
+                            self.indent = self.newline = False
+                        elif arg == fl and not self._first:
+                            # first line is by definition a FL, don't change the emitter state
+                            self.indent = self.newline = True
+                        elif arg == nl:
+                            if chunks is None:
+                                self.writer("\n")
+                            else:
+                                self._buffer("\n")
+                            self.indent = True
+                            self.newline = not self._first
+                        elif arg == indent:
+                            self.indent_level += 1
+                        elif arg == dedent:
+                            self.indent_level = max(0, self.indent_level - 1)
+                        continue
+                    elif isinstance(arg, list):
+                        if log is not None:
+                            log.append(indent)
+                        self.indent_level += 1
+                        stack.append(None)
+                        stack.append(iter(arg))
+                        break
+                    elif isinstance(arg, ComponentClosure):
+                        if (
+                            self._prepare_async is not None
+                            and inspect.iscoroutinefunction(arg.func)
+                        ):
+                            self._divert(arg, stack)
+                            return
+                        recording = None
+                        if arg._memo is not None:
+                            cache_key, fragment = arg._memo.lookup(
+                                arg, self.indent_step
+                            )
+                            if fragment is not None:
+                                stack.append(iter(fragment))
+                                break
+                            if cache_key is not None:
+                                recording = self._record(arg._memo, cache_key)
+                                log = self._log
+                        if frame is None:
+                            frame = sys._getframe()
+                            frame_depth = self._depth_of(frame)
+                            # frames the component emitting this one took to get here,
+                            # assuming a nested component takes as many, and as many
+                            # again once deferred, when it runs from within `_collect`
+                            step = frame_depth - self._frame_depth if self._depth else 0
+                            needed = frame_depth + 2 * step + _FRAMES_RESERVED
+                        if needed >= sys.getrecursionlimit():
+                            if recording is not None:
+                                stack.append(recording)
+                            stack.append(_collect(arg))
+                            break
+                        # component with context, render its output as it is emitted
+                        self._depth += 1
+                        outer = self._frame, self._frame_depth
+                        self._frame, self._frame_depth = frame, frame_depth
+                        try:
+                            # calling `__call__` directly, rather than through the
+                            # slot, keeps the recursion depth equal to the frames
+                            result = arg.__call__(self._emit_nested)
+                            if recording is not None:
+                                fragment = tuple(log[recording.start :])  # type: ignore[index]
+                                recording.memo.store(recording.key, fragment)
+                        finally:
+                            self._depth -= 1
+                            self._frame, self._frame_depth = outer
+                            if recording is not None:
+                                self._stop_recording()
+                                log = self._log
+                        if result is not None:
+                            _reject_async(arg, result)
+                        if self._diverted is not None:
+                            self._divert(None, stack)
+                            return
+                        continue
+                    elif arg is None:
+                        continue
+                    elif isinstance(arg, Component):
+                        raise TypeError(
+                            f"emit() does not accept raw components - you must call it first, provide a context"
+                        )
+                    elif self._prepare_async is not None and inspect.isawaitable(arg):
+                        self._divert(arg, stack)
+                        return
+                    arg = str(arg)
+
+                if log is not None:
+                    log.append(arg)
+                if chunks is None:
+                    if self.newline:
+                        self.writer("\n")
+                    if self.indent:
+                        self.writer(self.get_indent_string())
+                    self.writer(arg)
+                else:
+                    # newline and indentation are buffered as a single (cached) prefix
+                    if self.indent:
+                        key = ~self.indent_level if self.newline else self.indent_level
+                        prefix = prefixes.get(key)
+                        if prefix is None:
+                            prefix = self._prefix(key)
+                    else:
+                        prefix = "\n" if self.newline else ""
+                    chunks.append(prefix)
+                    chunks.append(arg)
+                    if counting:
+                        self._buffered += len(prefix) + len(arg)
+                        if self._buffered >= self.flush_threshold:  # type: ignore[operator]
+                            self.flush()
                 self.indent = self.newline = True
                 self._first = False
+            else:
+                stack.pop()
+
+
+class _Recording(NamedTuple):
+    """Stack entry ending the fragment of a cached component, see `Emitter._record`."""
+
+    memo: "_RenderCache"
+    key: Hashable
+    start: int
+
+
+# Entries of the stack of `Emitter._render`: iterators over what remains to be
+# rendered, `None` for the end of a list, or the end of a recorded fragment.
+_RenderStack = List[Union[None, Iterator[Any], _Recording]]
+
+
+def render(*args: Any, base_indent: str = "", indent_step: str = "   ") -> str:
+    """
+    Render `args` (components, markers, values) to a string.
+
+    Equivalent to, but faster than, rendering with an Emitter writing to a list
+    and joining the result. Usage:
+
+        html = render(page(title="Home"), indent_step="  ")
+    """
+    out: List[str] = []
+    emit = Emitter(
+        writer=out.append,
+        base_indent=base_indent,
+        indent_step=indent_step,
+        flush_threshold=sys.maxsize,
+    )
+    emit(*args)
+    emit.flush()
+    return "".join(out)
+
+
+def capture(*args: Any) -> str:
+    """
+    Render `args` to a string from inside a component, e.g. to measure or
+    post-process the output of another component.
+
+    The output is rendered without indentation (it is applied if the result is
+    emitted), using the `indent_step` of the emitter rendering the component.
+
+    Usage:
+        @component
+        def boxed(emit, body):
+            text = capture(body)
+            width = max(map(len, text.split("\\n")))
+            emit("+" + "-" * width + "+", ...)
+    """
+    if _active.stack:
+        return render(*args, indent_step=_active.stack[-1].indent_step)
+    return render(*args)
+
+
+# Python frames kept in reserve below the recursion limit when running component
+# bodies nested within others, see `Emitter._render`. Before Python 3.12, calls
+# made through C (e.g. to objects defining `__call__`) also count towards the
+# limit, without a frame of their own, which only this reserve accounts for.
+_FRAMES_RESERVED = 50
+
+
+class _StopProducing(BaseException):
+    """
+    Raised in the thread of `_produced` once no more chunks are wanted. A
+    BaseException, so that components catching Exception do not carry on.
+    """
+
+
+def _produced(produce: Callable[[Callable[[str], None]], None]) -> Iterator[str]:
+    """
+    Run `produce(put)` in a separate thread, yielding the chunks passed to `put`.
+    The thread only runs while a chunk is asked for, `put` waiting for the next.
+    """
+    wanted: "queue.Queue[bool]" = queue.Queue()
+    produced: "queue.Queue[Tuple[str, Any]]" = queue.Queue()
+    stopped = False
+
+    def put(chunk: str) -> None:
+        produced.put(("chunk", chunk))
+        if stopped or not wanted.get():
+            raise _StopProducing()
+
+    def run() -> None:
+        try:
+            if wanted.get():
+                produce(put)
+            produced.put(("done", None))
+        except _StopProducing:
+            pass
+        except BaseException as e:
+            produced.put(("error", e))
+
+    context = contextvars.copy_context()
+    thread = threading.Thread(target=context.run, args=(run,), daemon=True)
+    thread.start()
+    try:
+        while True:
+            wanted.put(True)
+            kind, value = produced.get()
+            if kind == "done":
+                return
+            if kind == "error":
+                raise value
+            yield value
+    finally:
+        stopped = True
+        wanted.put(False)
+        thread.join()
+
+
+def _collect(closure: ComponentClosure) -> Iterator[Any]:
+    """Run the component body, returning an iterator over everything it emitted."""
+    emitted: List[Tuple[Any, ...]] = []
+
+    def emit(*args: Any) -> None:
+        emitted.append(args)
+
+    result = closure(emit)
+    if result is not None:
+        _reject_async(closure, result)
+    return itertools.chain.from_iterable(emitted)
+
+
+def _reject_async(closure: ComponentClosure, result: Any) -> None:
+    if inspect.iscoroutine(result):
+        result.close()
+        raise TypeError(
+            f"{closure.func.__name__} is an async component, render it with an AsyncEmitter"
+        )
+
+
+class _AsyncWriter(Protocol):
+    def write(self, data: bytes, /) -> Any: ...
+
+    async def drain(self) -> None: ...
+
+
+class _Resolved:
+    """Items emitted by an async component (or produced by an awaitable)."""
+
+    def __init__(self, items: List[Any]):
+        self.items = items
+
+
+class AsyncEmitter:
+    def __init__(
+        self,
+        writer: _AsyncWriter,
+        base_indent: str = "",
+        indent_step: str = "   ",
+        encoding: str = "utf-8",
+        high_water: int = 1 << 16,
+    ):
+        """
+        Create an emitter rendering to an asyncio stream
+
+        Like `Emitter`, but also accepts `async def` components and awaitables
+        (whose result is emitted in their place). Async components and awaitables
+        emitted together start right away and resolve concurrently, while the
+        output retains the order in which they were emitted. Other components
+        run as they are emitted, as with `Emitter`, up to the first async
+        component or awaitable they emit: the output following it is rendered,
+        and the components in it run, once it resolves.
+
+        Args:
+            writer: stream to write to, such as an `asyncio.StreamWriter`
+            base_indent: Base indentation applied to all output
+            indent_step: String added for each indent level
+            encoding: encoding of the output written to `writer`
+            high_water: output is written (and the writer drained) whenever
+                        at least this many characters are buffered
+
+        Usage:
+            @component
+            async def table(emit, name):
+                rows = await fetch_rows(name)
+                emit(f"{name} = [", [f"{row!r}," for row in rows], "]")
+
+            emit = AsyncEmitter(writer)
+            await emit(table("users"), table("groups"))
+        """
+        self.writer = writer
+        self.encoding = encoding
+        self.high_water = high_water
+        self._out: List[str] = []
+        self._emitter = Emitter(
+            writer=self._out.append,
+            base_indent=base_indent,
+            indent_step=indent_step,
+            flush_threshold=high_water,
+        )
+        self._emitter._prepare_async = self._prepare
+        self._tasks: Set["asyncio.Future[_Resolved]"] = set()
+
+    async def __call__(self, *args: Any) -> None:
+        try:
+            await self._render(self._prepare(args))
+        finally:
+            self._emitter._diverted = None
+            for task in self._tasks:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()  # retrieved, avoid "never retrieved" warnings
+            self._tasks.clear()
+        await self.flush()
+
+    async def flush(self) -> None:
+        """Write out any buffered output and wait for the writer to drain."""
+        self._emitter.flush()
+        if self._out:
+            self.writer.write("".join(self._out).encode(self.encoding))
+            self._out.clear()
+            await self.writer.drain()
+
+    def _prepare(self, items: Iterable[Any]) -> List[Any]:
+        """Start resolving async components and awaitables in `items`."""
+        prepared: List[Any] = []
+        for item in items:
+            if isinstance(item, ComponentClosure):
+                if inspect.iscoroutinefunction(item.func):
+                    item = self._schedule(self._run_component(item))
+            elif isinstance(item, list):
+                item = self._prepare(item)
+            elif inspect.isawaitable(item):
+                item = self._schedule(self._resolve(item))
+            prepared.append(item)
+        return prepared
+
+    def _schedule(self, coro: Awaitable[_Resolved]) -> "asyncio.Future[_Resolved]":
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        return task
+
+    async def _run_component(self, closure: ComponentClosure) -> _Resolved:
+        emitted: List[Tuple[Any, ...]] = []
+
+        def emit(*args: Any) -> None:
+            emitted.append(args)
+
+        await cast(Awaitable[None], closure(emit))
+        return _Resolved(self._prepare(itertools.chain.from_iterable(emitted)))
+
+    async def _resolve(self, awaitable: Awaitable[Any]) -> _Resolved:
+        return _Resolved(self._prepare([await awaitable]))
+
+    async def _render(self, items: List[Any]) -> None:
+        emit = self._emitter
+        stack: List[Optional[Iterator[Any]]] = [iter(items)]
+        while stack:
+            it = stack[-1]
+            if it is None:
+                stack.pop()
+                emit(dedent)
+                continue
+            for item in it:
+                if isinstance(item, asyncio.Future):
+                    if not item.done():
+                        # write out what we have while waiting
+                        await self.flush()
+                    stack.append(iter((await item).items))
+                    break
+                elif isinstance(item, list):
+                    emit(indent)
+                    stack.append(None)
+                    stack.append(iter(item))
+                    break
+                else:
+                    # values, markers and components, rendered by the Emitter up
+                    # to any async component or awaitable they emit
+                    emit(item)
+                    if self._out:
+                        await self.flush()
+                    if emit._diverted is not None:
+                        diverted, emit._diverted = emit._diverted, None
+                        stack.append(itertools.chain.from_iterable(diverted))
+                        break
+            else:
+                stack.pop()
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+class _RenderCache:
+    """
+    LRU cache of rendered component closures.
+
+    Closures are rendered into fragments: the flat sequence of strings and
+    markers they produce, recorded by the Emitter as it renders a closure which
+    is not cached yet. As indentation is applied by the Emitter when a
+    fragment is replayed, fragments are independent of the indentation level
+    at which they are emitted. They are keyed on the emitter's `indent_step` as
+    well as the closure's arguments, as `capture()` renders using it.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._fragments: Dict[Hashable, Tuple[Any, ...]] = {}
+
+    def lookup(
+        self, closure: ComponentClosure, indent_step: str
+    ) -> Tuple[Optional[Hashable], Optional[Tuple[Any, ...]]]:
+        """The cache key of `closure` (None if its args are unhashable) and its fragment, if cached."""
+        try:
+            key = (indent_step, closure.cache_key())
+        except TypeError:
+            self.misses += 1
+            return None, None
+        frag = self._fragments.pop(key, None)
+        if frag is None:
+            self.misses += 1
+            return key, None
+        self.hits += 1
+        self._fragments[key] = frag  # re-insert as most recently used
+        return key, frag
+
+    def store(self, key: Hashable, frag: Tuple[Any, ...]) -> None:
+        if key not in self._fragments and len(self._fragments) >= self.maxsize:
+            del self._fragments[next(iter(self._fragments))]
+        self._fragments[key] = frag
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._fragments))
+
+    def clear(self) -> None:
+        self._fragments.clear()
+        self.hits = self.misses = 0
 
 
 def _block_parser(
-    iter: Iterator[str], eval: EvalCodeFn, indent_step: str
+    iter: Iterator[str],
+    eval: EvalCodeFn,
+    indent_step: str,
+    on_block: Optional[Callable[[int], None]] = None,
 ) -> Iterator[Tuple[bool, str]]:
     """
     Parse lines provided by `iter`, evaluating code in special blocks.
@@ -331,6 +1148,7 @@ def _block_parser(
         iter: provides the content to analyze, line-by-line
         eval: function with which to evaluate code sections
         indent_step: the string used for each level of indentation
+        on_block: called with the line number of each block, before evaluating it
 
     Returns:
         an iterator yielding tuples of bool, str, where the bool indicates
@@ -351,226 +1169,3217 @@ def _block_parser(
     line: Optional[str] = next_line()
     while line is not None:
         _start = line.find(MARKER_START)
-        yield _start != -1, line
-        if _start != -1:
-            _start_lineno = lineno
-            _start_line = line
-            _end = line.find(MARKER_CODE_END)
-            if _end != -1:
-                code_lines = [line[_start + len(MARKER_START) : _end].lstrip()]
-                base_indent = str_leading_ws(line)
-            else:
-                code_lines = []
-                line = next_line()
-                while line is not None and not line[_start:].startswith(
-                    MARKER_CODE_END
-                ):
-                    code_lines.append(line)
-                    yield True, line
-                    line = next_line()
-                if line is None:
-                    raise UnexpectedEOF(
-                        _start_lineno,
-                        f"reached end of file looking for end of code-section to block starting at line {_start_lineno}",
-                    )
-                yield True, line
-                pref = code_lines[0][:_start]
-                if len(pref) < _start:
-                    # TODO: verify we can trigger this
+        if _start == -1:
+            yield False, line
+        else:
+            yield from _parse_block(
+                line, _start, lineno, next_line, eval, indent_step, on_block
+            )
+        line = next_line()  # ready next line for loop
+
+
+def _parse_block(
+    line: str,
+    _start: int,
+    _start_lineno: int,
+    next_line: Callable[[], Optional[str]],
+    eval: EvalCodeFn,
+    indent_step: str,
+    on_block: Optional[Callable[[int], None]],
+) -> Iterator[Tuple[bool, str]]:
+    """
+    Parse and evaluate the block starting on `line` (line number `_start_lineno`),
+    whose start marker is at column `_start`. Reads the rest of the block using
+    `next_line`, up to and including its end marker line.
+    """
+    yield True, line
+    _start_line = line
+    _end = line.find(MARKER_CODE_END)
+    if _end != -1:
+        code_lines = [line[_start + len(MARKER_START) : _end].lstrip()]
+        base_indent = str_leading_ws(line)
+    else:
+        code_lines = []
+        next_: Optional[str] = next_line()
+        while next_ is not None and not next_[_start:].startswith(MARKER_CODE_END):
+            code_lines.append(next_)
+            yield True, next_
+            next_ = next_line()
+        if next_ is None:
+            raise UnexpectedEOF(
+                _start_lineno,
+                f"reached end of file looking for end of code-section to block starting at line {_start_lineno}",
+            )
+        yield True, next_
+        pref = code_lines[0][:_start]
+        if len(pref) < _start:
+            # TODO: verify we can trigger this
+            raise IndentationError(
+                block_start_lineno=_start_lineno, code_lineno=_start_lineno + 2
+            )
+        if len(code_lines) > 1:
+            # all code lines must share the indentation of the block opening line
+            for i, cl in enumerate(code_lines[1:]):
+                if cl[:_start] != pref:
                     raise IndentationError(
-                        block_start_lineno=_start_lineno, code_lineno=_start_lineno + 2
+                        block_start_lineno=_start_lineno,
+                        code_lineno=_start_lineno + 2 + i,
                     )
-                if len(code_lines) > 1:
-                    # all code lines must share the indentation of the block opening line
-                    for i, cl in enumerate(code_lines[1:]):
-                        if cl[:_start] != pref:
-                            raise IndentationError(
-                                block_start_lineno=_start_lineno,
-                                code_lineno=_start_lineno + 2 + i,
-                            )
-                base_indent = str_leading_ws(_start_line)
-                code_lines = [cl[_start:] for cl in code_lines]  # strip prefix
-            # skip past all the output from last run
-            line = next_line()  # skip code end marker line
-            while line is not None and not line[_start:].startswith(MARKER_OUTPUT_END):
-                line = next_line()  # skip output lines
-            if line is None:
-                raise UnexpectedEOF(
-                    _start_lineno,
-                    f"reached end of file looking for end of block which started at line {_start_lineno}",
-                )
-            try:
-                generated_output = eval("".join(code_lines), base_indent, indent_step)
-            except Exception as e:
-                print(e)
-                raise CodeEvalError(_start_lineno, code_lines, e) from e
-            if generated_output:
-                yield False, generated_output
-                yield False, "\n"
-            if line is not None:
-                yield True, line  # marker output end line
+        base_indent = str_leading_ws(_start_line)
+        code_lines = [cl[_start:] for cl in code_lines]  # strip prefix
+    # skip past all the output from last run
+    end_line = next_line()  # skip code end marker line
+    while end_line is not None and not end_line[_start:].startswith(MARKER_OUTPUT_END):
+        end_line = next_line()  # skip output lines
+    if end_line is None:
+        raise UnexpectedEOF(
+            _start_lineno,
+            f"reached end of file looking for end of block which started at line {_start_lineno}",
+        )
+    if on_block is not None:
+        on_block(_start_lineno)
+    try:
+        generated_output = eval("".join(code_lines), base_indent, indent_step)
+    except Exception as e:
+        print(e)
+        raise CodeEvalError(_start_lineno, code_lines, e) from e
+    if generated_output:
+        yield False, generated_output
+        yield False, "\n"
+    yield True, end_line  # marker output end line
 
-        line = next_line()  # ready next line for loop
 
+# files smaller than this are read into memory rather than mmap'ed
+_MMAP_MIN_SIZE = 1 << 16
+# unchanged regions at least this large are copied kernel-side, if supported
+_COPY_RANGE_MIN_SIZE = 1 << 16
+_MARKER_START_BYTES = MARKER_START.encode("utf-8")
 
-class CrowbarPreprocessor:
-    """
-    A peprocessor for files with embedded code-generation blocks.
 
-    Will process blocks like these:
-    ---
-    # <<crowbar
-    # emit(my_component, {"name": "value"})
-    # >>
-    # Generated code will replace this
-    # <<end>>
-    ---
+def _count_lines(buf: Union[bytes, mmap.mmap], start: int, end: int) -> int:
+    """Count the newlines of `buf[start:end]`, in bounded chunks."""
+    count = 0
+    for pos in range(start, end, 1 << 20):
+        count += buf[pos : min(end, pos + (1 << 20))].count(b"\n")
+    return count
 
-    Note that the prefix (' #') can be anything, so long as each line is equally
-    indented.
-    In this example, Python-style line comments were used, but multi-line
-    comments, such as '/* ... */' in C, also work.
+
+def _scan_blocks(
+    buf: Union[bytes, mmap.mmap],
+    eval: EvalCodeFn,
+    indent_step: str,
+    on_block: Optional[Callable[[int], None]] = None,
+    markers: Optional[Sequence[Tuple[int, int]]] = None,
+) -> Iterator[Tuple[bool, Union[str, slice]]]:
     """
+    Like `_block_parser`, but scanning the raw (utf-8) contents of a file.
 
-    def __init__(self) -> None:
-        pass
+    Regions without blocks are skipped in bulk and yielded as a `slice` of
+    `buf`, only the lines of blocks themselves are decoded. If known, the
+    lines containing `MARKER_START` (see `_marker_lines`) save searching for them.
+    """
+    pos = 0
+    lineno = 0  # lines before `pos`
+    hints = None if markers is None else iter(markers)
 
-    def execute_code_block(self, code: str, base_indent: str, indent_step: str) -> str:
-        """Execute Crowbar code and return generated output"""
-        # Set up execution environment with persistent state
-        crowbar = sys.modules[__name__]
-        sys.modules["crowbar"] = crowbar
-
-        exec_globals = {
-            "crowbar": crowbar,
-            "component": component,
-            "nl": nl,
-            "fl": fl,
-            "lc": lc,
-            "indent": indent,
-            "dedent": dedent,
-            "indent_step": indent_step,
-            "__builtins__": __builtins__,
-            # Include previously imported modules and globals
-            **self.crowbar_globals,
-        }
+    def next_line() -> Optional[str]:
+        nonlocal pos, lineno
+        if pos >= len(buf):
+            return None
+        end = buf.find(b"\n", pos)
+        end = len(buf) if end == -1 else end + 1
+        line = buf[pos:end].decode("utf-8")
+        pos = end
+        lineno += 1
+        return line
 
-        # Collect rendered output
-        output_parts: List[str] = []
-        e = Emitter(
-            writer=output_parts.append,
-            base_indent=base_indent,
-            indent_step=exec_globals["indent_step"],
+    while True:
+        if hints is None:
+            marker = buf.find(_MARKER_START_BYTES, pos)
+            if marker == -1:
+                break
+            line_start = buf.rfind(b"\n", pos, marker) + 1 or pos
+            lines_before = None
+        else:
+            # skip markers within the lines of the last block
+            hint = next((h for h in hints if h[0] >= pos), None)
+            if hint is None:
+                break
+            line_start, lines_before = hint[0], hint[1] - 1
+        if line_start > pos:
+            yield False, slice(pos, line_start)
+            if lines_before is None:
+                lines_before = lineno + _count_lines(buf, pos, line_start)
+            lineno, pos = lines_before, line_start
+        line = next_line()
+        assert line is not None
+        yield from _parse_block(
+            line,
+            line.find(MARKER_START),
+            lineno,
+            next_line,
+            eval,
+            indent_step,
+            on_block,
         )
+    if pos < len(buf):
+        yield False, slice(pos, len(buf))
 
-        # convenience method, allows calling emit directly in code blocks
-        def emit(*args: Any) -> None:
-            e(*args)
 
-        exec_globals["emit"] = emit
+def _marker_lines(buf: Union[bytes, mmap.mmap]) -> List[Tuple[int, int]]:
+    """Find the lines of `buf` containing `MARKER_START`, as (offset, line number) pairs."""
+    found = []
+    pos = 0
+    lineno = 0  # lines before `pos`
+    while (marker := buf.find(_MARKER_START_BYTES, pos)) != -1:
+        line_start = buf.rfind(b"\n", pos, marker) + 1 or pos
+        lineno += _count_lines(buf, pos, line_start)
+        found.append((line_start, lineno + 1))
+        end = buf.find(b"\n", marker)
+        if end == -1:
+            break
+        pos, lineno = end + 1, lineno + 1
+    return found
 
-        # Execute the code block
-        exec(code, exec_globals)
-
-        # Update persistent state with any new imports or definitions
-        # Filter out Crowbar-specific functions and built-ins to avoid pollution
-        for key, value in exec_globals.items():
-            if key not in [
-                "crowbar",
-                "component",
-                "nl",
-                "fl",
-                "indent",
-                "dedent",
-                "write_file",
-                "__builtins__",
-            ] and not key.startswith("_"):
-                self.crowbar_globals[key] = value
-
-        return "".join(output_parts)
 
-    def process_file(
-        self,
-        input_file: Fpath,
-        output_file: Optional[Fpath] = None,
-        indent_step: str = "  ",
-        omit_code_blocks: bool = False,
-    ) -> None:
-        self.crowbar_globals: Dict[str, Any] = {}
-        input_path = Path(input_file).resolve()
-        output_path = Path(input_file if output_file is None else output_file)
-        if output_path.exists() and not output_path.is_file():
-            raise InvalidOutputPath(output_path)
-        if omit_code_blocks and input_path == output_path.resolve():
-            raise ValueError(
-                "to strip code blocks from ouput, you must be writing to a *different* file"
-            )
-        with tempfile.NamedTemporaryFile(
-            mode="w",
-            encoding="utf-8",
-            dir=output_path.parent,
-            delete=False,
-            prefix=f"{output_path.name}",
-            suffix=".tmp",
-        ) as tmp:
-            tmp_path = Path(tmp.name)
-            try:
-                sys.path.insert(1, str(input_path.parent))
-                with open(input_file, "r", encoding="utf-8") as fh:
-                    for code_block_line, out_line in _block_parser(
-                        iter(fh), self.execute_code_block, indent_step
-                    ):
-                        if omit_code_blocks and code_block_line:
-                            continue
-                        tmp.write(out_line)
+# "rewritten" - output file was (re)written
+# "unchanged" - generated output matched the existing file, which was left untouched
+# "stale"     - when checking, generated output differs from the existing file
+FileStatus = Literal["rewritten", "unchanged", "stale"]
 
-                shutil.move(tmp_path, output_path)
-            except Exception as e:
-                tmp_path.unlink(missing_ok=True)
-                raise FileParseError(input_file, e) from e
-            finally:
-                sys.path.pop(1)
 
+@dataclass
+class BlockDependencies:
+    """What a single code block depended on, see `DependencyReport`."""
 
-def main() -> None:
-    parser = argparse.ArgumentParser(
-        description="Process Python files with Crowbar preprocessor"
-    )
-    parser.add_argument("input_file", help="file to process")
-    parser.add_argument(
-        "--indent-step",
-        default="   ",
-        help="line prefix to add for each level of indentation",
-    )
-    parser.add_argument(
-        "output_file",
-        nargs="?",
-        default=None,
-        help="where to write result (default: same file)",
-    )
-    parser.add_argument(
-        "--no-code-blocks",
-        action="store_true",
+    # line number of the block's start marker
+    lineno: int
+    modules: Dict[str, str] = field(default_factory=dict)
+    files: List[str] = field(default_factory=list)
+
+
+@dataclass
+class DependencyReport:
+    """
+    The modules and files the code blocks of a file depended on.
+
+    `modules` maps the name of each module imported (directly, or by other
+    imported modules) to its source file. Standard library modules are left out.
+    `files` are the paths of the other files read while evaluating blocks.
+    `blocks` breaks this down per code block, in the order they were evaluated.
+    """
+
+    modules: Dict[str, str] = field(default_factory=dict)
+    files: List[str] = field(default_factory=list)
+    blocks: List[BlockDependencies] = field(default_factory=list)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "DependencyReport":
+        return cls(
+            modules=d["modules"],
+            files=d["files"],
+            blocks=[BlockDependencies(**b) for b in d["blocks"]],
+        )
+
+
+@dataclass
+class FileResult:
+    """Outcome of processing one file, as returned by `CrowbarPreprocessor.process_many`."""
+
+    input_file: Path
+    output_file: Path
+    elapsed: float = 0.0
+    error: Optional[FileParseError] = None
+    status: Optional[FileStatus] = None
+    # True if evaluation was skipped because nothing changed since the last run
+    cached: bool = False
+    # what the file's blocks depended on (None if processing failed, or was
+    # stopped early when checking)
+    dependencies: Optional[DependencyReport] = None
+    # unified diff of the existing output against the generated output (--diff)
+    diff: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+# A file to process, either in-place or as an (input, output) pair.
+FileJob = Union[Fpath, Tuple[Fpath, Optional[Fpath]]]
+
+
+class _OutputSink(Protocol):
+    def write(self, s: str) -> None: ...
+
+    def write_bytes(self, data: Union[bytes, memoryview]) -> None: ...
+
+    def copy_range(self, data: memoryview, src_fd: int, offset: int) -> None: ...
+
+
+class _HashingWriter:
+    """Encodes and writes output to `fh`, hashing the bytes as they are written."""
+
+    def __init__(self, fh: IO[bytes]):
+        self.fh = fh
+        self.hash = hashlib.sha256()
+        self.size = 0
+        # (remaining) means of copying ranges of files kernel-side
+        self.copy_fns = _copy_fns()
+
+    def write(self, s: str) -> None:
+        data = s.encode("utf-8")
+        self.hash.update(data)
+        self.size += len(data)
+        self.fh.write(data)
+
+    def write_bytes(self, data: Union[bytes, memoryview]) -> None:
+        self.hash.update(data)
+        self.size += len(data)
+        self.fh.write(data)
+
+    def copy_range(self, data: memoryview, src_fd: int, offset: int) -> None:
+        """
+        Write `data`, the bytes found at `offset` of `src_fd`, having the
+        kernel copy them where the platform and filesystems support it.
+        """
+        self.hash.update(data)
+        self.size += len(data)
+        copied = 0
+        if self.copy_fns:
+            self.fh.flush()
+            dst_fd = self.fh.fileno()
+            while copied < len(data) and self.copy_fns:
+                count = min(len(data) - copied, 1 << 30)
+                try:
+                    n = self.copy_fns[0](src_fd, dst_fd, offset + copied, count)
+                except OSError as e:
+                    if e.errno not in _COPY_UNSUPPORTED:
+                        raise
+                    self.copy_fns.pop(0)
+                    continue
+                if n == 0:  # source shrunk under us, let the write below tell
+                    break
+                copied += n
+        if copied < len(data):
+            self.fh.write(data[copied:])
+
+
+_COPY_UNSUPPORTED = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+    errno.EBADF,
+}
+
+
+def _copy_fns() -> List[Callable[[int, int, int, int], int]]:
+    """Kernel-side copy functions taking (src_fd, dst_fd, offset, count), best first."""
+    fns: List[Callable[[int, int, int, int], int]] = []
+    if hasattr(os, "copy_file_range"):
+        fns.append(lambda src, dst, off, n: os.copy_file_range(src, dst, n, off))
+    if sys.platform == "linux" and hasattr(os, "sendfile"):
+        fns.append(lambda src, dst, off, n: os.sendfile(dst, src, off, n))
+    return fns
+
+
+class _OutputDiffers(BaseException):
+    """
+    Raised by `_CompareWriter` to stop evaluating a file. A BaseException, so
+    that blocks catching Exception do not carry on.
+    """
+
+
+class _CompareWriter:
+    """Compares output with the contents of `fh` as it is written, raising `_OutputDiffers` at the first difference."""
+
+    def __init__(self, fh: IO[bytes]):
+        self.fh = fh
+
+    def write(self, s: str) -> None:
+        self.write_bytes(s.encode("utf-8"))
+
+    def write_bytes(self, data: Union[bytes, memoryview]) -> None:
+        for pos in range(0, len(data), 1 << 20):
+            chunk = data[pos : pos + (1 << 20)]
+            if self.fh.read(len(chunk)) != chunk:
+                raise _OutputDiffers()
+
+    def copy_range(self, data: memoryview, src_fd: int, offset: int) -> None:
+        self.write_bytes(data)
+
+    def at_end(self) -> bool:
+        return self.fh.read(1) == b""
+
+
+def _unified_diff(fpath: Path, generated: bytes) -> str:
+    """Diff the current contents of `fpath` (if any) against `generated`, as `diff -u` would."""
+    try:
+        current = fpath.read_bytes()
+    except FileNotFoundError:
+        current = b""
+    if current == generated:
+        return ""
+    diff = difflib.unified_diff(
+        current.decode("utf-8", errors="replace").splitlines(keepends=True),
+        generated.decode("utf-8", errors="replace").splitlines(keepends=True),
+        f"{fpath}",
+        f"{fpath} (generated)",
+    )
+    return "".join(
+        line if line.endswith("\n") else f"{line}\n\\ No newline at end of file\n"
+        for line in diff
+    )
+
+
+def _sha256_file(fpath: Fpath) -> "hashlib._Hash":
+    h = hashlib.sha256()
+    with open(fpath, "rb") as fh:
+        while chunk := fh.read(1 << 20):
+            h.update(chunk)
+    return h
+
+
+def _has_contents(fpath: Path, size: int, digest: bytes) -> bool:
+    """True if the file at `fpath` is `size` bytes long and hashes to `digest`."""
+    try:
+        if fpath.stat().st_size != size:
+            return False
+        return _sha256_file(fpath).digest() == digest
+    except FileNotFoundError:
+        return False
+
+
+# Dependency tracking
+# -------------------
+# While code blocks are evaluated, `builtins.__import__` is swapped for
+# `_tracking_import` and an audit hook watches for files being opened. Both
+# report to the active `_DependencyTracker` (if any).
+_active_tracker: Optional["_DependencyTracker"] = None
+_builtin_import = builtins.__import__
+_audit_hook_installed = False
+
+# importer module name -> names of the modules it imported. Lets us find the
+# transitive dependencies of modules which were imported (and thus cached in
+# sys.modules) while evaluating an earlier file.
+_import_graph: Dict[str, Set[str]] = {}
+
+_STDLIB_DIRS = tuple(
+    {sysconfig.get_paths()["stdlib"], sysconfig.get_paths()["platstdlib"]}
+)
+
+
+def _tracking_import(
+    name: str,
+    globals: Optional[Mapping[str, object]] = None,
+    locals: Optional[Mapping[str, object]] = None,
+    fromlist: Optional[Sequence[str]] = (),
+    level: int = 0,
+) -> ModuleType:
+    module = _builtin_import(name, globals, locals, fromlist, level)
+    tracker = _active_tracker
+    if tracker is not None:
+        tracker.record_import(name, globals, fromlist, level)
+    return module
+
+
+def _audit_hook(event: str, args: Tuple[Any, ...]) -> None:
+    if event == "open" and _active_tracker is not None:
+        _active_tracker.record_open(*args)
+
+
+def _module_files(module: str) -> Dict[str, str]:
+    """Map `module` and the modules it (transitively) imported to their source files."""
+    seen: Set[str] = set()
+    todo = [module]
+    while todo:
+        name = todo.pop()
+        if name not in seen:
+            seen.add(name)
+            todo.extend(_import_graph.get(name, ()))
+    result = {}
+    for name in seen:
+        fpath = getattr(sys.modules.get(name), "__file__", None)
+        if not fpath or name in ("__main__", __name__):
+            continue
+        if fpath.startswith(_STDLIB_DIRS) and "-packages" not in fpath:
+            continue
+        result[name] = os.path.abspath(fpath)
+    return result
+
+
+class _DependencyTracker:
+    """Records the modules imported and files read while evaluating code blocks."""
+
+    def __init__(self) -> None:
+        self.modules: Set[str] = set()
+        self.files: Set[str] = set()
+        self._prev: Optional[_DependencyTracker] = None
+        self._n_modules = 0
+
+    def __enter__(self) -> "_DependencyTracker":
+        global _active_tracker, _audit_hook_installed
+        if not _audit_hook_installed:
+            sys.addaudithook(_audit_hook)
+            _audit_hook_installed = True
+        self._prev = _active_tracker
+        self._n_modules = len(sys.modules)
+        _active_tracker = self
+        builtins.__import__ = _tracking_import
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        global _active_tracker
+        _active_tracker = self._prev
+        if self._prev is None:
+            builtins.__import__ = _builtin_import
+        if len(sys.modules) > self._n_modules:
+            # catches modules loaded without an import statement, e.g. importlib.import_module
+            self.modules.update(itertools.islice(sys.modules, self._n_modules, None))
+
+    def record_import(
+        self,
+        name: str,
+        globals: Optional[Mapping[str, object]],
+        fromlist: Optional[Sequence[str]],
+        level: int,
+    ) -> None:
+        importer = globals.get("__name__") if globals else None
+        if level:
+            if not globals:
+                return
+            package = str(globals.get("__package__") or "")
+            try:
+                name = importlib.util.resolve_name("." * level + name, package)
+            except (ImportError, ValueError):
+                return
+        imported = set()
+        parts = name.split(".")
+        for i in range(1, len(parts) + 1):
+            imported.add(".".join(parts[:i]))
+        for item in fromlist or ():
+            if f"{name}.{item}" in sys.modules:
+                imported.add(f"{name}.{item}")
+        self.modules.update(imported)
+        if importer is not None:
+            _import_graph.setdefault(str(importer), set()).update(imported)
+
+    def record_open(self, path: Any, mode: Optional[str], flags: int) -> None:
+        if isinstance(path, int):
+            return
+        if mode is None:
+            if flags & (os.O_WRONLY | os.O_RDWR):
+                return
+        elif any(c in mode for c in "wax+"):
+            return
+        self.files.add(os.path.abspath(os.fsdecode(path)))
+
+    def module_files(
+        self, memo: Optional[Dict[str, Dict[str, str]]] = None
+    ) -> Dict[str, str]:
+        """
+        Map each (non-stdlib) module depended upon to its source file.
+
+        `memo` caches the modules each imported module depends on, so that trackers
+        of blocks importing the same modules need not look them up again.
+        """
+        if memo is None:
+            memo = {}
+        result: Dict[str, str] = {}
+        for name in self.modules:
+            files = memo.get(name)
+            if files is None:
+                files = memo[name] = _module_files(name)
+            result.update(files)
+        return result
+
+    def data_files(self, module_files: Optional[Iterable[str]] = None) -> Set[str]:
+        """Files read by blocks, excluding the sources of imported modules."""
+        if module_files is None:
+            module_files = self.module_files().values()
+        exclude = set(module_files)
+        return {f for f in self.files if f not in exclude and "__pycache__" not in f}
+
+
+# File cache
+# ----------
+# A "stamp" records the state of a file: its size, mtime and hash. A stamp is
+# checked by stat'ing the file and only re-hashing it if size or mtime differ.
+Stamp = Optional[Dict[str, Any]]
+
+# files modified less than this long ago may be modified again without their
+# mtime changing (coarse timestamps), so their stamps must not trust the mtime.
+_RACY_NS = 2_000_000_000
+
+
+class _FileCache:
+    """
+    Records, for each processed file, the state of the file and everything its
+    blocks depended on, so that unchanged files need not be evaluated again.
+
+    Entries are JSON files in `<cache dir>/files/`.
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.files_dir = root / "files"
+        # (path, size, mtime_ns) -> sha256, saves re-hashing modules shared by many files
+        self._digests: Dict[Tuple[str, int, int], str] = {}
+
+    def key(self, *parts: Any) -> str:
+        return hashlib.sha256("\0".join(map(str, parts)).encode()).hexdigest()
+
+    def stamp(self, fpath: str) -> Stamp:
+        try:
+            st = os.stat(fpath)
+        except FileNotFoundError:
+            return None
+        k = (fpath, st.st_size, st.st_mtime_ns)
+        digest = self._digests.get(k)
+        if digest is None:
+            digest = self._digests[k] = _sha256_file(fpath).hexdigest()
+        racy = time.time_ns() - st.st_mtime_ns < _RACY_NS
+        return {
+            "size": st.st_size,
+            "mtime_ns": 0 if racy else st.st_mtime_ns,
+            "sha256": digest,
+        }
+
+    def stamp_valid(self, fpath: str, stamp: Stamp) -> bool:
+        if stamp is None:
+            return not os.path.exists(fpath)
+        try:
+            st = os.stat(fpath)
+        except FileNotFoundError:
+            return False
+        if st.st_size != stamp["size"]:
+            return False
+        if st.st_mtime_ns == stamp["mtime_ns"]:
+            return True
+        current = self.stamp(fpath)
+        if current is None or current["sha256"] != stamp["sha256"]:
+            return False
+        stamp.update(current)
+        return True
+
+    def load(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return the entry for `key`, valid or not."""
+        try:
+            with open(self.files_dir / f"{key}.json", "r", encoding="utf-8") as fh:
+                entry: Dict[str, Any] = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            return None
+        if entry.get("crowbar") != __version__ or entry.get("python") != sys.version:
+            return None
+        return entry
+
+    def lookup(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return the entry for `key` if it exists and is still valid."""
+        entry_path = self.files_dir / f"{key}.json"
+        entry = self.load(key)
+        if entry is None:
+            return None
+        stamps: Dict[str, Stamp] = entry["stamps"]
+        before = json.dumps(stamps)
+        if not all(self.stamp_valid(f, s) for f, s in stamps.items()):
+            return None
+        if json.dumps(stamps) != before:
+            # files were touched, but their contents did not change
+            self._write(entry_path, entry)
+        return entry
+
+    def store(self, key: str, paths: Iterable[str], **info: Any) -> None:
+        entry = {
+            "crowbar": __version__,
+            "python": sys.version,
+            "stamps": {f: self.stamp(f) for f in paths},
+            **info,
+        }
+        self._write(self.files_dir / f"{key}.json", entry)
+
+    def _write(self, fpath: Path, entry: Dict[str, Any]) -> None:
+        fpath.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=fpath.parent, prefix=fpath.name, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as fh:
+            json.dump(entry, fh)
+        os.replace(tmp, fpath)
+
+
+# Signing
+# -------
+# Unmarshalling code or unpickling data runs whatever its author chose, so the
+# bytecode and checkpoints crowbar keeps in a (possibly shared) cache directory
+# are signed with a key only the user can read, kept outside the cache. Those
+# signed with another key are ignored: the block is compiled or evaluated again.
+# Copying the key (~/.cache/crowbar/key) shares them between trusted machines.
+
+_KEY_SIZE = 32
+# size of the MAC (HMAC-SHA256) prefixing signed data
+_MAC_SIZE = 32
+
+
+def _local_key() -> Optional[bytes]:
+    """
+    The user's signing key, created on first use. None if it cannot be read or
+    created, in which case nothing is signed (nor trusted).
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    fpath = Path(cache_home) / "crowbar" / "key"
+    try:
+        if not fpath.exists():
+            fpath.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=fpath.parent, suffix=".tmp")  # mode 0600
+            try:
+                with os.fdopen(fd, "wb") as fh:
+                    fh.write(secrets.token_bytes(_KEY_SIZE))
+                # unlike a rename, keeps the key of a concurrent first run
+                os.link(tmp, fpath)
+            except FileExistsError:
+                pass
+            finally:
+                os.unlink(tmp)
+        key = fpath.read_bytes()
+    except OSError:
+        return None
+    return key if len(key) == _KEY_SIZE else None
+
+
+def _sign(key: bytes, name: str, data: bytes) -> bytes:
+    """Prefix `data` with its MAC, binding it to `name`."""
+    mac = hmac.new(key, name.encode("utf-8") + b"\0" + data, hashlib.sha256)
+    return mac.digest() + data
+
+
+def _verify(key: bytes, name: str, signed: bytes) -> Optional[bytes]:
+    """The data `_sign()`ed as `signed`, or None if not signed with `key`."""
+    mac, data = signed[:_MAC_SIZE], signed[_MAC_SIZE:]
+    expected = hmac.new(key, name.encode("utf-8") + b"\0" + data, hashlib.sha256)
+    return data if hmac.compare_digest(mac, expected.digest()) else None
+
+
+class _CodeCache:
+    """
+    Caches the compiled code of blocks, keyed on the hash of their source.
+
+    Code objects are kept in memory (bounded, LRU), so batch runs do not
+    compile the same block twice. If given a `root` directory and a `key`, they
+    are also marshalled to disk, much like `__pycache__`, signed with `key`.
+    """
+
+    def __init__(
+        self,
+        root: Optional[Path] = None,
+        maxsize: int = 4096,
+        key: Optional[bytes] = None,
+    ):
+        self.root = root if key is not None else None
+        self.maxsize = maxsize
+        self.key = key
+        self._code: Dict[str, CodeType] = {}
+
+    def compile(self, source: str) -> CodeType:
+        key = hashlib.sha256(source.encode("utf-8")).hexdigest()
+        code = self._code.pop(key, None)
+        if code is None:
+            code = self._load(key)
+            if code is None:
+                code = compile(source, "<string>", "exec")
+                self._store(key, code)
+            if len(self._code) >= self.maxsize:
+                del self._code[next(iter(self._code))]
+        self._code[key] = code  # (re-)insert as most recently used
+        return code
+
+    def _path(self, key: str) -> Path:
+        assert self.root is not None
+        opt = f".opt-{sys.flags.optimize}" if sys.flags.optimize else ""
+        return self.root / key[:2] / f"{key}.{sys.implementation.cache_tag}{opt}.pyc"
+
+    def _load(self, key: str) -> Optional[CodeType]:
+        if self.root is None:
+            return None
+        try:
+            with open(self._path(key), "rb") as fh:
+                data = fh.read()
+        except OSError:
+            return None
+        if data[:4] != importlib.util.MAGIC_NUMBER:
+            return None
+        assert self.key is not None
+        marshalled = _verify(self.key, key, data[4:])
+        if marshalled is None:
+            return None
+        try:
+            code = marshal.loads(marshalled)
+        except (EOFError, ValueError, TypeError):
+            return None
+        return code if isinstance(code, CodeType) else None
+
+    def _store(self, key: str, code: CodeType) -> None:
+        if self.root is None:
+            return
+        fpath = self._path(key)
+        try:
+            fpath.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=fpath.parent, suffix=".tmp")
+            with os.fdopen(fd, "wb") as fh:
+                assert self.key is not None
+                fh.write(importlib.util.MAGIC_NUMBER)
+                fh.write(_sign(self.key, key, marshal.dumps(code)))
+            os.replace(tmp, fpath)
+        except OSError:
+            pass  # a read-only or full cache must not break processing
+
+
+# Block cache
+# -----------
+# Outputs of individual blocks, shared by all files (and machines, if the cache
+# directory is). Much like ccache's "direct mode", a block is looked up by a key
+# computed before evaluating it (its source, indentation and the blocks before
+# it), leading to a manifest. The manifest lists, for each time the block was
+# evaluated, the hashes of the modules and files it depended on and the hash of
+# its output. Outputs are stored by the hash of their contents, as are the
+# checkpoints of globals, which are signed (see `_local_key()`).
+#
+#   blocks/manifests/ab/abcd...json
+#   blocks/outputs/12/1234...
+#   blocks/stats.json  (hits, misses and size, updated under blocks/lock)
+
+_BLOCK_CACHE_MAX_SIZE = 1 << 30
+# larger outputs are not cached, they would push out many smaller ones
+_BLOCK_OUTPUT_MAX_SIZE = 1 << 24
+# entries kept per manifest, i.e. sets of dependencies seen for the same block
+_MANIFEST_MAX_ENTRIES = 16
+# globals of blocks pickling to more than this are not checkpointed
+_CHECKPOINT_MAX_SIZE = 1 << 22
+# evaluate blocks for at least this many times as long as the last checkpoint took
+# before taking another, limiting their overhead to ~25%
+_CHECKPOINT_INTERVAL = 4
+
+
+class _BlockHit(NamedTuple):
+    output: str
+    deps: BlockDependencies
+    # hashes of the modules and files the block depended on
+    digests: Dict[str, Optional[str]]
+    # hash of the pickled globals after the block, None if not picklable
+    checkpoint: Optional[str]
+
+
+class _FileLock:
+    """Exclusive lock on `path` (a no-op on systems without `fcntl`)."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._fd: Optional[int] = None
+
+    def __enter__(self) -> "_FileLock":
+        try:
+            import fcntl
+        except ImportError:
+            return self
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        if self._fd is not None:
+            os.close(self._fd)  # releases the lock
+            self._fd = None
+
+
+class _BlockCache:
+    """
+    Caches the output of blocks by their source, indentation, the blocks
+    evaluated before them in the same file and what they depended on.
+
+    Least recently used entries are evicted once the cache grows beyond
+    `max_size` bytes. Processes (and machines) may share the cache directory:
+    the checkpoints stored in it are signed, see `_local_key()`.
+    """
+
+    def __init__(self, root: Path, max_size: int = _BLOCK_CACHE_MAX_SIZE):
+        self.root = root
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # bytes added since the stats were last written
+        self._added = 0
+        # (path, size, mtime_ns) -> sha256
+        self._digests: Dict[Tuple[str, int, int], str] = {}
+        # directories known to exist
+        self._dirs: Set[Path] = set()
+
+    def key(self, chain: str, source: str, base_indent: str, indent_step: str) -> str:
+        parts = (__version__, sys.version, chain, source, base_indent, indent_step)
+        return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+    def _manifest_path(self, key: str) -> Path:
+        return self.root / "manifests" / key[:2] / f"{key}.json"
+
+    def _output_path(self, digest: str) -> Path:
+        return self.root / "outputs" / digest[:2] / digest
+
+    def _digest(self, fpath: str) -> Optional[str]:
+        try:
+            st = os.stat(fpath)
+        except OSError:
+            return None
+        k = (fpath, st.st_size, st.st_mtime_ns)
+        digest = self._digests.get(k)
+        if digest is None:
+            digest = self._digests[k] = _sha256_file(fpath).hexdigest()
+        return digest
+
+    def lookup(self, key: str, base_dir: Path) -> Optional["_BlockHit"]:
+        """
+        Find the output of the block with `key`, if cached for the current state
+        of its dependencies.
+        """
+        manifest_path = self._manifest_path(key)
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as fh:
+                entries: List[Dict[str, Any]] = json.load(fh)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        for entry in reversed(entries):  # most recently stored first
+            digests = entry["digests"]
+            if not all(
+                self._digest(os.path.join(base_dir, p)) == d for p, d in digests.items()
+            ):
+                continue
+            data = self.load(entry["output"])
+            if data is None:
+                continue  # evicted output
+            try:
+                os.utime(manifest_path)
+                output = data.decode("utf-8")
+            except (OSError, ValueError):
+                continue
+            self.hits += 1
+            deps = BlockDependencies(
+                0,
+                {n: os.path.join(base_dir, p) for n, p in entry["modules"].items()},
+                [os.path.join(base_dir, p) for p in entry["files"]],
+            )
+            return _BlockHit(output, deps, digests, entry.get("checkpoint"))
+        self.misses += 1
+        return None
+
+    def store(
+        self,
+        key: str,
+        output: Optional[str],
+        deps: BlockDependencies,
+        base_dir: Path,
+        checkpoint: Optional[bytes] = None,
+    ) -> Dict[str, Optional[str]]:
+        """
+        Cache `output` of the block with `key`, and the `checkpoint` of the globals
+        after it (if picklable). Returns the digests of the block's dependencies.
+        An `output` of None (too large to keep) is not cached.
+        """
+
+        def rel(fpath: str) -> str:
+            # relative to the input file, so checkouts elsewhere can share entries
+            relpath = os.path.relpath(fpath, base_dir)
+            return fpath if relpath.startswith(os.pardir) else relpath
+
+        modules = {name: rel(p) for name, p in deps.modules.items()}
+        files = [rel(p) for p in deps.files]
+        digests = {
+            p: self._digest(os.path.join(base_dir, p))
+            for p in (*modules.values(), *files)
+        }
+        if output is None:
+            return digests
+        data = output.encode("utf-8")
+        if len(data) > _BLOCK_OUTPUT_MAX_SIZE:
+            return digests
+        try:
+            entry = {
+                "modules": modules,
+                "files": files,
+                "digests": digests,
+                "output": self._store_blob(data),
+                "checkpoint": (
+                    None if checkpoint is None else self._store_blob(checkpoint)
+                ),
+            }
+            manifest_path = self._manifest_path(key)
+            with _FileLock(self.root / "lock"):
+                try:
+                    with open(manifest_path, "r", encoding="utf-8") as fh:
+                        entries = json.load(fh)
+                    self._added -= manifest_path.stat().st_size
+                except (OSError, ValueError):
+                    entries = []
+                entries = [e for e in entries if e["digests"] != digests]
+                entries.append(entry)
+                self._added += self._write(
+                    manifest_path,
+                    json.dumps(entries[-_MANIFEST_MAX_ENTRIES:]).encode("utf-8"),
+                )
+        except OSError:
+            pass  # a read-only or full cache must not break processing
+        return digests
+
+    def load(self, digest: str) -> Optional[bytes]:
+        """Read a stored output or checkpoint, marking it as recently used."""
+        fpath = self._output_path(digest)
+        try:
+            data = fpath.read_bytes()
+            os.utime(fpath)
+        except OSError:
+            return None
+        return data
+
+    def _store_blob(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        fpath = self._output_path(digest)
+        if not fpath.exists():
+            self._added += self._write(fpath, data)
+        return digest
+
+    def _write(self, fpath: Path, data: bytes) -> int:
+        if fpath.parent not in self._dirs:
+            fpath.parent.mkdir(parents=True, exist_ok=True)
+            self._dirs.add(fpath.parent)
+        fd, tmp = tempfile.mkstemp(dir=fpath.parent, suffix=".tmp")
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp, fpath)
+        return len(data)
+
+    def stats(self) -> Dict[str, int]:
+        try:
+            with open(self.root / "stats.json", "r", encoding="utf-8") as fh:
+                stats: Dict[str, int] = json.load(fh)
+        except (OSError, ValueError):
+            stats = {}
+        for name in ("hits", "misses", "size"):
+            stats.setdefault(name, 0)
+        return stats
+
+    def flush(self) -> None:
+        """Add this process' hits, misses and stored bytes to the shared stats, evicting entries if needed."""
+        if not (self.hits or self.misses or self._added):
+            return
+        try:
+            with _FileLock(self.root / "lock"):
+                stats = self.stats()
+                stats["hits"] += self.hits
+                stats["misses"] += self.misses
+                stats["size"] = max(0, stats["size"] + self._added)
+                if stats["size"] > self.max_size:
+                    # leave some room, so we do not evict on every store
+                    stats["size"] = self._evict(self.max_size * 9 // 10)
+                self._write(self.root / "stats.json", json.dumps(stats).encode())
+        except OSError:
+            return
+        self.hits = self.misses = self._added = 0
+
+    def prune(self, max_size: int) -> int:
+        """Evict least recently used entries until at most `max_size` bytes remain."""
+        with _FileLock(self.root / "lock"):
+            stats = self.stats()
+            stats["size"] = self._evict(max_size)
+            self._write(self.root / "stats.json", json.dumps(stats).encode())
+        return stats["size"]
+
+    def _evict(self, max_size: int) -> int:
+        """Remove least recently used files until `max_size` remains, returns the size left."""
+        entries = []
+        for subdir in ("manifests", "outputs"):
+            for dirpath, _, fnames in os.walk(self.root / subdir):
+                for fname in fnames:
+                    fpath = os.path.join(dirpath, fname)
+                    try:
+                        st = os.stat(fpath)
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime_ns, st.st_size, fpath))
+        size = sum(e[1] for e in entries)
+        entries.sort()
+        for _, fsize, fpath in entries:
+            if size <= max_size:
+                break
+            try:
+                os.unlink(fpath)
+            except OSError:
+                continue
+            size -= fsize
+        return size
+
+
+# Names available to all code blocks. A block may shadow these, but not for the
+# blocks after it.
+_NAMESPACE_BUILTINS = {
+    "crowbar": sys.modules[__name__],
+    "component": component,
+    "nl": nl,
+    "fl": fl,
+    "indent": indent,
+    "dedent": dedent,
+    "__builtins__": __builtins__,
+}
+
+
+class _ImportedRef:
+    """
+    Stands in for a module, or a global imported from one (`from os import
+    environ`), in checkpoints of the globals of blocks. Pickled by name, and
+    unpickled by importing it.
+    """
+
+    def __init__(self, module: str, name: Optional[str] = None):
+        self.module = module
+        self.name = name
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        if self.name is None:
+            return (importlib.import_module, (self.module,))
+        return (getattr, (_ImportedRef(self.module), self.name))
+
+
+# Values of modules which pickle by reference, or are immutable
+_UNSHARED_TYPES = (
+    type(None),
+    type(...),
+    type(NotImplemented),
+    bool,
+    int,
+    float,
+    complex,
+    str,
+    bytes,
+    tuple,
+    frozenset,
+    range,
+    type,
+    FunctionType,
+    BuiltinFunctionType,
+    ModuleType,
+    Component,
+)
+
+
+class _CheckpointPickler(pickle.Pickler):
+    """
+    Pickles the globals of blocks for a checkpoint, refusing objects which are
+    (also) globals of a module, such as `items = mod.registry`, unless they
+    unpickle as the very same object. An unpickled copy would no longer be
+    shared with the module.
+    """
+
+    def __init__(self, file: IO[bytes]):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.shared = {
+            id(value)
+            for module in list(sys.modules.values())
+            for value in list(getattr(module, "__dict__", {}).values())
+            if not isinstance(value, _UNSHARED_TYPES)
+        }
+
+    def persistent_id(self, obj: Any) -> None:
+        if id(obj) in self.shared:
+            if pickle.loads(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)) is not obj:
+                raise pickle.PicklingError(f"{obj!r} is shared with a module")
+            self.shared.discard(id(obj))
+        return None
+
+
+def _module_state(name: str) -> Optional[str]:
+    """
+    Digest of the globals of module `name` (imported if need be), other than
+    modules, functions and classes. None if they cannot be pickled.
+    """
+    try:
+        module = importlib.import_module(name)
+        h = hashlib.sha256()
+        for key, value in list(vars(module).items()):
+            if key.startswith("__") or isinstance(
+                value, (ModuleType, FunctionType, BuiltinFunctionType, type)
+            ):
+                continue
+            h.update(key.encode() + b"\0")
+            h.update(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return None
+    return h.hexdigest()
+
+
+def _new_namespace() -> Dict[str, Any]:
+    """
+    Create the globals of the code blocks of a file.
+
+    Rather than copying the globals from one block to the next, blocks share
+    this namespace. Names defined by a block remain visible to the blocks after
+    it, and `emit` is swapped for each block.
+    """
+    return {**_NAMESPACE_BUILTINS, "lc": lc}
+
+
+# output of blocks is passed on in chunks of (at least) this many characters
+_BLOCK_FLUSH_THRESHOLD = 1 << 16
+
+
+class _BlockOutput:
+    """
+    Receives the output of a block as it is emitted, passing it on to `write`.
+
+    Unless `keep` is False, the output is also kept, to be returned by
+    `getvalue()`. If passing it on, only as long as it is small enough to
+    be cached.
+    """
+
+    def __init__(self, write: Optional[WriterFunction] = None, keep: bool = True):
+        self._write = write
+        self._parts: Optional[List[str]] = [] if keep else None
+        self.size = 0
+        self.closed = False
+
+    def write(self, s: str) -> None:
+        if self.closed or not s:
+            return
+        self.size += len(s)
+        if self._write is not None:
+            self._write(s)
+            if self.size > _BLOCK_OUTPUT_MAX_SIZE:
+                self._parts = None
+        if self._parts is not None:
+            self._parts.append(s)
+
+    def getvalue(self) -> Optional[str]:
+        """The output so far, None if not kept."""
+        return None if self._parts is None else "".join(self._parts)
+
+
+class CrowbarPreprocessor:
+    """
+    A peprocessor for files with embedded code-generation blocks.
+
+    Will process blocks like these:
+    ---
+    # <<crowbar
+    # emit(my_component, {"name": "value"})
+    # >>
+    # Generated code will replace this
+    # <<end>>
+    ---
+
+    Note that the prefix (' #') can be anything, so long as each line is equally
+    indented.
+    In this example, Python-style line comments were used, but multi-line
+    comments, such as '/* ... */' in C, also work.
+
+    If given a `cache_dir`, the preprocessor records what each file depended on
+    (its own contents, imported modules and files read by its blocks) and skips
+    evaluating files for which none of these changed since the last run. The
+    compiled code of blocks is cached there as well, as is the output of blocks:
+    a block whose source, preceding blocks and dependencies match an earlier
+    evaluation, in any file, is not evaluated again. Compiled code and the
+    checkpoints of globals are signed with a per-user key kept outside
+    `cache_dir`, and ignored unless signed with it. The output cache is kept
+    below `cache_max_size` bytes by evicting the least recently used entries.
+    Other inputs of blocks, such as environment variables, directory listings
+    or the time, are not tracked: cached output ignores changes to those.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[Fpath] = None,
+        cache_max_size: int = _BLOCK_CACHE_MAX_SIZE,
+    ) -> None:
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+        self.cache_max_size = cache_max_size
+        self._file_cache = (
+            None if self.cache_dir is None else _FileCache(self.cache_dir)
+        )
+        self._block_cache = (
+            None
+            if self.cache_dir is None
+            else _BlockCache(self.cache_dir / "blocks", cache_max_size)
+        )
+        # globals shared by the blocks of the file being processed
+        self.crowbar_globals: Dict[str, Any] = _new_namespace()
+        # dependencies of each block evaluated for the current file
+        self._block_deps: List[BlockDependencies] = []
+        self._block_lineno = 0
+        self._module_memo: Dict[str, Dict[str, str]] = {}
+        # while processing a file using the block cache: the fingerprint of the
+        # blocks evaluated so far, and the blocks skipped since the last miss.
+        self._block_chain: Optional[str] = None
+        self._skipped_blocks: List[Tuple[str, str, str, Optional[str]]] = []
+        # set once the globals of the current file failed to pickle
+        self._unpicklable = False
+        # time taken by the last checkpoint and spent evaluating blocks since
+        self._checkpoint_cost = 0.0
+        self._since_checkpoint = 0.0
+        self._input_dir = Path()
+        # signs the bytecode and checkpoints kept in the cache, see `_local_key()`
+        self._key = None if self.cache_dir is None else _local_key()
+        self._code_cache = _CodeCache(
+            None if self.cache_dir is None else self.cache_dir / "bytecode",
+            key=self._key,
+        )
+        self._marker_index = (
+            None
+            if self.cache_dir is None
+            else _MarkerIndex(self.cache_dir / "scan" / "index.json")
+        )
+
+    def execute_code_block(self, code: str, base_indent: str, indent_step: str) -> str:
+        """Execute Crowbar code and return generated output"""
+        output = _BlockOutput()
+        self._eval_block(code, base_indent, indent_step, output)
+        value = output.getvalue()
+        assert value is not None
+        return value
+
+    def _eval_block(
+        self, code: str, base_indent: str, indent_step: str, output: "_BlockOutput"
+    ) -> None:
+        if self._block_cache is None or self._block_chain is None:
+            deps = self._run_block(code, base_indent, indent_step, output)
+        else:
+            deps = self._cached_block(code, base_indent, indent_step, output)
+        deps.lineno = self._block_lineno
+        self._block_deps.append(deps)
+
+    def _cached_block(
+        self, code: str, base_indent: str, indent_step: str, output: "_BlockOutput"
+    ) -> BlockDependencies:
+        assert self._block_cache is not None and self._block_chain is not None
+        key = self._block_cache.key(self._block_chain, code, base_indent, indent_step)
+        hit = self._block_cache.lookup(key, self._input_dir)
+        if hit is not None:
+            deps, digests = hit.deps, hit.digests
+            output.write(hit.output)
+            # evaluated lazily, should a later block need the globals it defines
+            self._skipped_blocks.append(
+                (code, base_indent, indent_step, hit.checkpoint)
+            )
+        else:
+            self._restore_globals()
+            deps = self._run_block(code, base_indent, indent_step, output)
+            checkpoint = None
+            # checkpoints are taken only once evaluating blocks took a while
+            # compared to taking the last one, bounding their overhead.
+            if (
+                self._key is not None
+                and not self._unpicklable
+                and self._since_checkpoint
+                >= self._checkpoint_cost * _CHECKPOINT_INTERVAL
+            ):
+                checkpoint = self._checkpoint(deps)
+                self._unpicklable = checkpoint is None
+            digests = self._block_cache.store(
+                key, output.getvalue(), deps, self._input_dir, checkpoint
+            )
+        # blocks see the globals of the blocks before them, so the key of the next
+        # block covers this block and what it depended on.
+        self._block_chain = hashlib.sha256(
+            (key + json.dumps(digests, sort_keys=True)).encode()
+        ).hexdigest()
+        return deps
+
+    def _restore_globals(self) -> None:
+        """
+        Bring the globals up to date with the blocks skipped since the last miss,
+        restoring the latest checkpoint and evaluating the blocks after it.
+
+        A checkpoint is only restored if the modules the blocks depended on are
+        in the state they were in when it was taken: skipped blocks may have
+        changed them, which restoring their globals would not redo.
+        """
+        assert self._block_cache is not None
+        skipped = self._skipped_blocks
+        start = 0
+        for i in range(len(skipped) - 1, -1, -1):
+            digest = skipped[i][3]
+            if digest is None or self._key is None:
+                continue
+            data = self._block_cache.load(digest)
+            # only checkpoints signed by this user are trusted, see `_local_key()`
+            data = None if data is None else _verify(self._key, "checkpoint", data)
+            if data is None:
+                continue
+            try:
+                restored, module_states = pickle.loads(data)
+            except Exception:
+                continue  # e.g. a module or class no longer exists
+            if any(
+                _module_state(name) != state for name, state in module_states.items()
+            ):
+                continue
+            self.crowbar_globals = _new_namespace()
+            self.crowbar_globals.update(restored)
+            start = i + 1
+            break
+        for code, base_indent, indent_step, _ in skipped[start:]:
+            self._run_block(code, base_indent, indent_step, _BlockOutput(keep=False))
+        skipped.clear()
+
+    def _checkpoint(self, deps: BlockDependencies) -> Optional[bytes]:
+        """
+        Pickle the globals defined by blocks, with the state of the modules the
+        blocks (up to the one with `deps`) depended on, signed with the user's
+        key. None if they cannot be pickled faithfully, see `_CheckpointPickler`.
+        """
+        assert self._key is not None
+        t_start = time.perf_counter()
+        state: Dict[str, Any] = {}
+        for name, value in self.crowbar_globals.items():
+            if name in _NAMESPACE_BUILTINS or name == "emit":
+                continue
+            if isinstance(value, ModuleType):
+                value = _ImportedRef(value.__name__)
+            else:
+                module = sys.modules.get(getattr(value, "__module__", None) or "")
+                if module is not None and module.__dict__.get(name) is value:
+                    value = _ImportedRef(module.__name__, name)
+            state[name] = value
+        modules = {name for d in (*self._block_deps, deps) for name in d.modules}
+        try:
+            module_states = {name: _module_state(name) for name in sorted(modules)}
+            if None in module_states.values():
+                return None
+            buf = io.BytesIO()
+            _CheckpointPickler(buf).dump((state, module_states))
+        except Exception:
+            return None
+        finally:
+            self._checkpoint_cost = time.perf_counter() - t_start
+            self._since_checkpoint = 0.0
+        data = buf.getvalue()
+        if len(data) > _CHECKPOINT_MAX_SIZE:
+            return None
+        return _sign(self._key, "checkpoint", data)
+
+    def _run_block(
+        self, code: str, base_indent: str, indent_step: str, output: "_BlockOutput"
+    ) -> BlockDependencies:
+        # blocks share one namespace per file, see `_new_namespace`
+        sys.modules["crowbar"] = sys.modules[__name__]
+        namespace = self.crowbar_globals
+
+        e = Emitter(
+            writer=output,
+            base_indent=base_indent,
+            # blocks may override the indentation of the blocks after them
+            indent_step=namespace.setdefault("indent_step", indent_step),
+            flush_threshold=_BLOCK_FLUSH_THRESHOLD,
+        )
+
+        # convenience method, allows calling emit directly in code blocks
+        def emit(*args: Any) -> None:
+            e(*args)
+
+        namespace["emit"] = emit
+
+        # Execute the code block
+        compiled = self._code_cache.compile(code)
+        tracker = _DependencyTracker()
+        t_start = time.perf_counter()
+        try:
+            with tracker:
+                exec(compiled, namespace)
+            e.flush()
+        finally:
+            # functions defined by the block may hold on to `emit`, their
+            # output must not end up in the middle of later blocks.
+            output.closed = True
+        self._since_checkpoint += time.perf_counter() - t_start
+
+        # Crowbar's built-ins cannot be redefined for the blocks which follow
+        for key, value in _NAMESPACE_BUILTINS.items():
+            if namespace.get(key) is not value:
+                namespace[key] = value
+        namespace.pop("write_file", None)
+
+        modules = tracker.module_files(self._module_memo)
+        files = sorted(tracker.data_files(modules.values()))
+        return BlockDependencies(0, modules, files)
+
+    def process_file(
+        self,
+        input_file: Fpath,
+        output_file: Optional[Fpath] = None,
+        indent_step: str = "  ",
+        omit_code_blocks: bool = False,
+        write_if_changed: Optional[bool] = None,
+        check: bool = False,
+        diff: bool = False,
+    ) -> FileResult:
+        """
+        Evaluate all blocks of `input_file`, writing the result to `output_file`.
+
+        Args:
+            input_file: file to process
+            output_file: where to write the result (default: `input_file`)
+            indent_step: the string used for each level of indentation
+            omit_code_blocks: leave the code blocks themselves out of the output
+            write_if_changed: leave the output file untouched (keeping its mtime)
+                if the generated output is identical to its current contents.
+                Defaults to True when processing the file in-place.
+            check: only compare the generated output to the contents of
+                `output_file`, without writing anything but the cache. Evaluation
+                stops at the first difference, the `status` is then "stale".
+            diff: like `check`, but generating all output, to set `FileResult.diff`
+                to a unified diff of `output_file` against it.
+
+        Returns:
+            a `FileResult`, whose `status` tells whether the output was rewritten.
+        """
+        t_start = time.perf_counter()
+        self.crowbar_globals = _new_namespace()
+        input_path = Path(input_file).resolve()
+        output_path = Path(input_file if output_file is None else output_file)
+        if output_path.exists() and not output_path.is_file():
+            raise InvalidOutputPath(output_path)
+        in_place = input_path == output_path.resolve()
+        if omit_code_blocks and in_place:
+            raise ValueError(
+                "to strip code blocks from ouput, you must be writing to a *different* file"
+            )
+        cache_key = None
+        if self._file_cache is not None:
+            cache_key = self._file_cache.key(
+                input_path, output_path.resolve(), indent_step, omit_code_blocks
+            )
+            entry = None
+            if write_if_changed is not False:
+                entry = self._file_cache.lookup(cache_key)
+            if entry is not None and "dependencies" in entry:
+                return FileResult(
+                    Path(input_file),
+                    output_path,
+                    elapsed=time.perf_counter() - t_start,
+                    status="unchanged",
+                    cached=True,
+                    dependencies=DependencyReport.from_dict(entry["dependencies"]),
+                )
+        if write_if_changed is None:
+            write_if_changed = in_place
+        status: FileStatus
+        diff_text = None
+        self._block_deps = []
+        self._module_memo = {}
+        self._block_chain = None if self._block_cache is None else ""
+        self._skipped_blocks = []
+        self._unpicklable = False
+        self._checkpoint_cost = self._since_checkpoint = 0.0
+        self._input_dir = input_path.parent
+
+        sys.path.insert(1, str(input_path.parent))
+        try:
+            if diff:
+                buffer = io.BytesIO()
+                out = _HashingWriter(buffer)
+                out.copy_fns = []  # not a file
+                self._render(input_file, out, indent_step, omit_code_blocks)
+                diff_text = _unified_diff(output_path, buffer.getvalue())
+                status = "stale" if diff_text else "unchanged"
+            elif check:
+                status = self._check_output(
+                    input_file, output_path, indent_step, omit_code_blocks
+                )
+            else:
+                status = self._write_output(
+                    input_file,
+                    output_path,
+                    indent_step,
+                    omit_code_blocks,
+                    write_if_changed,
+                )
+        except Exception as e:
+            raise FileParseError(input_file, e) from e
+        finally:
+            sys.path.pop(1)
+            self._block_chain = None
+            if self._block_cache is not None:
+                self._block_cache.flush()
+        if status == "stale" and not diff:
+            # stopped early, blocks after the first difference were not evaluated
+            return FileResult(
+                Path(input_file),
+                output_path,
+                elapsed=time.perf_counter() - t_start,
+                status=status,
+            )
+        deps = self.dependency_report()
+        # the cache must not claim stale output matches its input
+        if self._file_cache is not None and cache_key is not None and status != "stale":
+            self._file_cache.store(
+                cache_key,
+                [
+                    str(input_path),
+                    str(output_path.resolve()),
+                    *deps.modules.values(),
+                    *deps.files,
+                ],
+                dependencies=deps.to_dict(),
+            )
+        return FileResult(
+            Path(input_file),
+            output_path,
+            elapsed=time.perf_counter() - t_start,
+            status=status,
+            dependencies=deps,
+            diff=diff_text,
+        )
+
+    def _write_output(
+        self,
+        input_file: Fpath,
+        output_path: Path,
+        indent_step: str,
+        omit_code_blocks: bool,
+        write_if_changed: bool,
+    ) -> FileStatus:
+        with tempfile.NamedTemporaryFile(
+            mode="wb",
+            dir=output_path.parent,
+            delete=False,
+            prefix=f"{output_path.name}",
+            suffix=".tmp",
+        ) as tmp:
+            tmp_path = Path(tmp.name)
+            try:
+                out = _HashingWriter(tmp)
+                self._render(input_file, out, indent_step, omit_code_blocks)
+                tmp.flush()
+                if write_if_changed and _has_contents(
+                    output_path, out.size, out.hash.digest()
+                ):
+                    tmp_path.unlink()
+                    return "unchanged"
+                shutil.move(tmp_path, output_path)
+                return "rewritten"
+            except Exception:
+                tmp_path.unlink(missing_ok=True)
+                raise
+
+    def _check_output(
+        self,
+        input_file: Fpath,
+        output_path: Path,
+        indent_step: str,
+        omit_code_blocks: bool,
+    ) -> FileStatus:
+        try:
+            existing = open(output_path, "rb")
+        except FileNotFoundError:
+            return "stale"
+        with existing:
+            out = _CompareWriter(existing)
+            try:
+                self._render(input_file, out, indent_step, omit_code_blocks)
+            except _OutputDiffers:
+                return "stale"
+            return "unchanged" if out.at_end() else "stale"
+
+    def _render(
+        self,
+        input_file: Fpath,
+        out: _OutputSink,
+        indent_step: str,
+        omit_code_blocks: bool,
+    ) -> None:
+        """Evaluate the blocks of `input_file`, writing the resulting output to `out`."""
+
+        def on_block(lineno: int) -> None:
+            self._block_lineno = lineno
+
+        def stream_block(code: str, base_indent: str, indent_step: str) -> str:
+            # the output of the block is written as it is emitted, by the time
+            # the block is evaluated the lines before it have been written.
+            output = _BlockOutput(out.write, keep=self._block_cache is not None)
+            self._eval_block(code, base_indent, indent_step, output)
+            if output.size:
+                out.write("\n")
+            return ""
+
+        with open(input_file, "rb") as fh:
+            st = os.fstat(fh.fileno())
+            buf: Union[bytes, mmap.mmap]
+            src_fd: Optional[int] = None
+            markers = None
+            if st.st_size < _MMAP_MIN_SIZE:
+                buf = fh.read()
+            else:
+                src_fd = fh.fileno()
+                buf = mmap.mmap(src_fd, 0, access=mmap.ACCESS_READ)
+                if self._marker_index is not None:
+                    self._marker_index.refresh()
+                    markers = self._marker_index.lookup(str(input_file), st)
+            try:
+                if buf.find(b"\r") == -1:
+                    self._scan_file(
+                        buf,
+                        out,
+                        indent_step,
+                        omit_code_blocks,
+                        stream_block,
+                        on_block,
+                        src_fd,
+                        markers,
+                    )
+                else:
+                    # let universal newlines translate the line endings
+                    text = io.TextIOWrapper(io.BytesIO(buf), encoding="utf-8")
+                    for code_block_line, out_line in _block_parser(
+                        iter(text), stream_block, indent_step, on_block
+                    ):
+                        if omit_code_blocks and code_block_line:
+                            continue
+                        out.write(out_line)
+            finally:
+                if isinstance(buf, mmap.mmap):
+                    buf.close()
+
+    def _scan_file(
+        self,
+        buf: Union[bytes, mmap.mmap],
+        out: _OutputSink,
+        indent_step: str,
+        omit_code_blocks: bool,
+        eval: EvalCodeFn,
+        on_block: Callable[[int], None],
+        src_fd: Optional[int] = None,
+        markers: Optional[List[Tuple[int, int]]] = None,
+    ) -> None:
+        with memoryview(buf) as view:
+            for code_block_line, item in _scan_blocks(
+                buf, eval, indent_step, on_block, markers
+            ):
+                if omit_code_blocks and code_block_line:
+                    continue
+                if isinstance(item, slice):
+                    with view[item] as chunk:
+                        if src_fd is not None and len(chunk) >= _COPY_RANGE_MIN_SIZE:
+                            out.copy_range(chunk, src_fd, item.start)
+                        else:
+                            out.write_bytes(chunk)
+                else:
+                    out.write(item)
+
+    def dependency_report(self) -> DependencyReport:
+        """Report what the blocks evaluated for the last processed file depended on."""
+        report = DependencyReport(blocks=self._block_deps)
+        files: Set[str] = set()
+        for block in self._block_deps:
+            report.modules.update(block.modules)
+            files.update(block.files)
+        module_files = set(report.modules.values())
+        report.files = sorted(f for f in files if f not in module_files)
+        return report
+
+    def _recorded_paths(
+        self,
+        input_file: Fpath,
+        output_file: Optional[Fpath],
+        indent_step: str,
+        omit_code_blocks: bool,
+    ) -> Optional[List[str]]:
+        """
+        The paths which the output of `input_file` depended on when last processed
+        (the input and output files, modules and data files), None if unknown.
+        """
+        if self._file_cache is None:
+            return None
+        input_path = Path(input_file).resolve()
+        output_path = Path(input_file if output_file is None else output_file)
+        key = self._file_cache.key(
+            input_path, output_path.resolve(), indent_step, omit_code_blocks
+        )
+        entry = self._file_cache.load(key)
+        return None if entry is None else list(entry["stamps"])
+
+    def process_many(
+        self,
+        files: Iterable[FileJob],
+        indent_step: str = "  ",
+        omit_code_blocks: bool = False,
+        jobs: Optional[int] = None,
+        write_if_changed: Optional[bool] = None,
+        check: bool = False,
+        diff: bool = False,
+    ) -> List[FileResult]:
+        """
+        Process several files, spreading them over a pool of worker processes.
+
+        Args:
+            files: paths to process in-place, or (input, output) pairs
+            indent_step: the string used for each level of indentation
+            omit_code_blocks: strip code blocks from the output (see `process_file`)
+            jobs: number of worker processes (default: one per CPU). With a single
+                  job, or a single file, files are processed in this process.
+            write_if_changed: see `process_file`
+            check: only check whether outputs are up to date, see `process_file`
+            diff: see `process_file`
+
+        Returns:
+            one `FileResult` per file, in the order the files were given. Errors
+            do not stop the batch, they are reported through `FileResult.error`.
+        """
+        return list(
+            self.iter_process_many(
+                files,
+                indent_step,
+                omit_code_blocks,
+                jobs,
+                write_if_changed,
+                check,
+                diff,
+            )
+        )
+
+    def iter_process_many(
+        self,
+        files: Iterable[FileJob],
+        indent_step: str = "  ",
+        omit_code_blocks: bool = False,
+        jobs: Optional[int] = None,
+        write_if_changed: Optional[bool] = None,
+        check: bool = False,
+        diff: bool = False,
+        ordered: bool = True,
+    ) -> Iterator[FileResult]:
+        """
+        Like `process_many`, but yielding each result as soon as it is ready.
+
+        Results are yielded in the order of `files`, unless `ordered` is False:
+        then they are yielded as they complete, so one slow file does not hold
+        back the results of the files after it.
+        """
+        tasks = [_FileTask(*(f if isinstance(f, tuple) else (f, None))) for f in files]
+        opts = _FileOptions(
+            indent_step=indent_step,
+            omit_code_blocks=omit_code_blocks,
+            write_if_changed=write_if_changed,
+            check=check,
+            diff=diff,
+        )
+        workers = min(jobs or os.cpu_count() or 1, len(tasks))
+        if workers <= 1:
+            for task in tasks:
+                yield _process_task(self, task, opts)
+            return
+
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_worker_init,
+            initargs=(opts, self.cache_dir, self.cache_max_size),
+        ) as pool:
+            if not ordered:
+                futures = [pool.submit(_worker_process, task) for task in tasks]
+                for future in as_completed(futures):
+                    yield future.result()
+                return
+            chunksize = max(1, len(tasks) // (workers * 4))
+            yield from pool.map(_worker_process, tasks, chunksize=chunksize)
+
+
+@dataclass(frozen=True)
+class _FileTask:
+    input_file: Fpath
+    output_file: Optional[Fpath] = None
+
+
+@dataclass(frozen=True)
+class _FileOptions:
+    indent_step: str
+    omit_code_blocks: bool
+    write_if_changed: Optional[bool]
+    check: bool = False
+    diff: bool = False
+
+
+def _picklable_error(err: FileParseError) -> FileParseError:
+    """Ensure `err` survives the trip back from a worker process."""
+    try:
+        pickle.dumps(err)
+        return err
+    except Exception:
+        e = err.exception
+        return FileParseError(err.fpath, CrowbarError(f"{type(e).__name__}: {e}"))
+
+
+def _process_task(
+    processor: CrowbarPreprocessor, task: _FileTask, opts: _FileOptions
+) -> FileResult:
+    t_start = time.perf_counter()
+    try:
+        return processor.process_file(
+            task.input_file,
+            task.output_file,
+            indent_step=opts.indent_step,
+            omit_code_blocks=opts.omit_code_blocks,
+            write_if_changed=opts.write_if_changed,
+            check=opts.check,
+            diff=opts.diff,
+        )
+    except Exception as e:
+        # argument validation errors (InvalidOutputPath, ...) are raised
+        # before parsing starts, report them the same way.
+        error = (
+            e if isinstance(e, FileParseError) else FileParseError(task.input_file, e)
+        )
+        output_file = task.input_file if task.output_file is None else task.output_file
+        return FileResult(
+            Path(task.input_file),
+            Path(output_file),
+            elapsed=time.perf_counter() - t_start,
+            error=error,
+        )
+
+
+# per-process state of pool workers, see `CrowbarPreprocessor.process_many`
+_worker_state: Optional[Tuple[CrowbarPreprocessor, _FileOptions]] = None
+
+
+def _worker_init(
+    opts: _FileOptions, cache_dir: Optional[Path], cache_max_size: int
+) -> None:
+    global _worker_state
+    _worker_state = (CrowbarPreprocessor(cache_dir, cache_max_size), opts)
+
+
+def _worker_process(task: _FileTask) -> FileResult:
+    assert _worker_state is not None, "worker not initialized"
+    processor, opts = _worker_state
+    result = _process_task(processor, task, opts)
+    if result.error is not None:
+        result.error = _picklable_error(result.error)
+    return result
+
+
+def _expand_paths(patterns: Sequence[str]) -> List[str]:
+    """Expand glob patterns, keeping plain paths as-is (and in order)."""
+    paths: List[str] = []
+    seen = set()
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern, recursive=True))
+            if not matches:
+                raise FileNotFoundError(f"no files match '{pattern}'")
+        else:
+            if not os.path.exists(pattern):
+                raise FileNotFoundError(f"Input file {pattern} not found")
+            matches = [pattern]
+        for m in matches:
+            if m not in seen and not os.path.isdir(m):
+                seen.add(m)
+                paths.append(m)
+    return paths
+
+
+# Discovery
+# ---------
+# `--scan DIR` walks a tree for files containing blocks. Directories and files
+# ignored by git are skipped, the rest are searched for `MARKER_START` as raw
+# bytes by a pool of threads, before anything is decoded or parsed.
+_IgnoreRule = Tuple[
+    str, "re.Pattern[str]", bool, bool
+]  # base, regex, negated, dir only
+
+
+def _glob_regex(pattern: str) -> "re.Pattern[str]":
+    """
+    Compile a gitignore-style glob. Patterns containing a '/' (other than a
+    trailing one) match paths relative to their base, others match file names
+    at any depth. '**' matches across directories.
+    """
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    out: List[str] = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            out.append(".*")
+            i += 2
+        elif c == "*":
+            out.append("[^/]*")
+            i += 1
+        elif c == "?":
+            out.append("[^/]")
+            i += 1
+        elif c == "[" and (j := pattern.find("]", i + 2)) != -1:
+            chars = pattern[i + 1 : j].replace("\\", "\\\\")
+            out.append(f"[^{chars[1:]}]" if chars[0] in "!^" else f"[{chars}]")
+            i = j + 1
+        elif c == "\\" and i + 1 < n:
+            out.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            out.append(re.escape(c))
+            i += 1
+    return re.compile(("" if anchored else "(?:.*/)?") + "".join(out) + "(?:/.*)?")
+
+
+def _read_gitignore(dirpath: str, base: str) -> List[_IgnoreRule]:
+    """Parse the .gitignore of `dirpath`, whose path relative to the top is `base`."""
+    try:
+        with open(os.path.join(dirpath, ".gitignore"), "r", encoding="utf-8") as fh:
+            lines = fh.read().splitlines()
+    except (OSError, ValueError):
+        return []
+    rules: List[_IgnoreRule] = []
+    for line in lines:
+        if not line.rstrip() or line.startswith("#"):
+            continue
+        if not line.endswith("\\ "):
+            line = line.rstrip()
+        negated = line.startswith("!")
+        if negated:
+            line = line[1:]
+        dir_only = line.endswith("/")
+        rules.append((base, _glob_regex(line.rstrip("/")), negated, dir_only))
+    return rules
+
+
+def _is_ignored(rules: List[_IgnoreRule], relpath: str, is_dir: bool) -> bool:
+    ignored = False
+    for base, regex, negated, dir_only in rules:
+        if (not dir_only or is_dir) and regex.fullmatch(relpath[len(base) :]):
+            ignored = not negated
+    return ignored
+
+
+def _git_top(path: str) -> Optional[str]:
+    """The root of the git work tree containing `path`, if any."""
+    while True:
+        if os.path.exists(os.path.join(path, ".git")):
+            return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def _discover(
+    root: Fpath,
+    include: Sequence[str] = (),
+    exclude: Sequence[str] = (),
+    skip: Iterable[Fpath] = (),
+) -> Iterator[str]:
+    """
+    Walk `root`, yielding the paths of files not ignored by git.
+
+    Files must match one of the `include` globs (if any) and no `exclude` glob,
+    matched against their path relative to `root`. Directories matching an
+    `exclude` glob, and those in `skip`, are not entered.
+    """
+    abs_root = os.path.abspath(root)
+    top = _git_top(abs_root) or abs_root
+    # .gitignore files between the top of the work tree and `root` apply too
+    rules: List[_IgnoreRule] = []
+    if top != abs_root:
+        dirpath, base = top, ""
+        for part in Path(os.path.relpath(abs_root, top)).parts:
+            rules = rules + _read_gitignore(dirpath, base)
+            dirpath, base = os.path.join(dirpath, part), f"{base}{part}/"
+    include_re = [_glob_regex(p) for p in include]
+    exclude_re = [_glob_regex(p.rstrip("/")) for p in exclude]
+    skipped = {os.path.abspath(p) for p in skip}
+    root_base = (
+        ""
+        if top == abs_root
+        else os.path.relpath(abs_root, top).replace(os.sep, "/") + "/"
+    )
+    stack = [(os.fspath(root), root_base, rules)]
+    while stack:
+        dirpath, base, parent_rules = stack.pop()
+        rules = parent_rules + _read_gitignore(dirpath, base)
+        try:
+            with os.scandir(dirpath) as it:
+                entries = sorted(it, key=lambda e: e.name, reverse=True)
+        except OSError:
+            continue
+        for entry in entries:
+            relpath = base + entry.name
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if not is_dir and not entry.is_file():
+                    continue
+            except OSError:
+                continue
+            if entry.name == ".git" or _is_ignored(rules, relpath, is_dir):
+                continue
+            scan_relpath = relpath[len(root_base) :]
+            if any(r.fullmatch(scan_relpath) for r in exclude_re):
+                continue
+            if is_dir:
+                if os.path.abspath(entry.path) not in skipped:
+                    stack.append((entry.path, relpath + "/", rules))
+            elif not include_re or any(r.fullmatch(scan_relpath) for r in include_re):
+                yield entry.path
+
+
+def _find_markers(fpath: Fpath) -> Optional[List[Tuple[int, int]]]:
+    """The lines of the file at `fpath` containing `MARKER_START`, see `_marker_lines`."""
+    try:
+        with open(fpath, "rb") as fh:
+            size = os.fstat(fh.fileno()).st_size
+            if size < _MMAP_MIN_SIZE:
+                return _marker_lines(fh.read())
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                return _marker_lines(buf)
+    except (OSError, ValueError):
+        return None
+
+
+class _MarkerIndex:
+    """
+    Records which lines of files contain `MARKER_START`, so that scans only
+    read files changed since, and the preprocessor need not search for blocks.
+
+    Entries are keyed on the absolute path of the file and valid as long as its
+    size, mtime and inode are unchanged. They are kept in a single JSON file,
+    `<cache dir>/scan/index.json`.
+    """
+
+    def __init__(self, fpath: Path):
+        self.fpath = fpath
+        # path -> [size, mtime_ns, inode, [[offset, line number], ...]]
+        self._entries: Optional[Dict[str, List[Any]]] = None
+        self._mtime_ns = 0
+        self._dirty = False
+
+    def refresh(self) -> None:
+        """Pick up changes to the index made by other processes."""
+        try:
+            mtime_ns = self.fpath.stat().st_mtime_ns
+        except OSError:
+            mtime_ns = 0
+        if self._entries is None or (mtime_ns != self._mtime_ns and not self._dirty):
+            try:
+                with open(self.fpath, "r", encoding="utf-8") as fh:
+                    data = json.load(fh)
+                valid = data.get("crowbar") == __version__
+                self._entries = data["entries"] if valid else {}
+            except (OSError, ValueError, KeyError, AttributeError):
+                self._entries = {}
+            self._mtime_ns = mtime_ns
+
+    def _load(self) -> Dict[str, List[Any]]:
+        if self._entries is None:
+            self.refresh()
+        assert self._entries is not None
+        return self._entries
+
+    def lookup(self, fpath: str, st: os.stat_result) -> Optional[List[Tuple[int, int]]]:
+        """The lines of `fpath` containing markers, if recorded for its current state."""
+        entry = self._load().get(os.path.abspath(fpath))
+        if entry is None or entry[:3] != [st.st_size, st.st_mtime_ns, st.st_ino]:
+            return None
+        return [(offset, lineno) for offset, lineno in entry[3]]
+
+    def update(
+        self, fpath: str, st: os.stat_result, markers: List[Tuple[int, int]]
+    ) -> None:
+        racy = time.time_ns() - st.st_mtime_ns < _RACY_NS
+        self._load()[os.path.abspath(fpath)] = [
+            st.st_size,
+            0 if racy else st.st_mtime_ns,
+            st.st_ino,
+            markers,
+        ]
+        self._dirty = True
+
+    def save(self) -> None:
+        if not self._dirty:
+            return
+        data = {"crowbar": __version__, "entries": self._load()}
+        try:
+            self.fpath.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.fpath.parent, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as fh:
+                json.dump(data, fh, separators=(",", ":"))
+            os.replace(tmp, self.fpath)
+            self._mtime_ns = self.fpath.stat().st_mtime_ns
+        except OSError:
+            return  # a read-only cache must not break scanning
+        self._dirty = False
+
+
+def _scan_tree(
+    root: Fpath,
+    include: Sequence[str] = (),
+    exclude: Sequence[str] = (),
+    skip: Iterable[Fpath] = (),
+    threads: Optional[int] = None,
+    index: Optional[_MarkerIndex] = None,
+) -> List[str]:
+    """
+    List the files below `root` containing blocks, see `_discover`. Given an
+    `index`, only files changed since they were last recorded in it are read.
+    """
+    candidates = list(_discover(root, include, exclude, skip))
+    if threads is None:
+        threads = min(32, os.cpu_count() or 1)
+
+    def find_markers(batch: List[str]) -> List[Tuple[bool, Any]]:
+        results: List[Tuple[bool, Any]] = []
+        for fpath in batch:
+            try:
+                st = os.stat(fpath)
+            except OSError:
+                results.append((False, None))
+                continue
+            markers = None if index is None else index.lookup(fpath, st)
+            if markers is not None:
+                results.append((bool(markers), None))
+                continue
+            markers = _find_markers(fpath)
+            results.append((bool(markers), (st, markers)))
+        return results
+
+    # files are handed to threads in batches, sparing a future per file
+    batch_size = max(1, min(256, len(candidates) // (threads * 4)))
+    batches = [
+        candidates[i : i + batch_size] for i in range(0, len(candidates), batch_size)
+    ]
+    if index is not None:
+        index.refresh()  # before starting threads
+    if threads <= 1:
+        found = [find_markers(b) for b in batches]
+    else:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            found = list(pool.map(find_markers, batches))
+    scanned = []
+    for fpath, (has_markers, read) in zip(candidates, itertools.chain(*found)):
+        if has_markers:
+            scanned.append(fpath)
+        if index is not None and read is not None and read[1] is not None:
+            index.update(fpath, *read)
+    if index is not None:
+        index.save()
+    return sorted(scanned)
+
+
+def _git(cwd: Fpath, *args: str) -> bytes:
+    try:
+        proc = subprocess.run(["git", *args], cwd=cwd, capture_output=True, check=True)
+    except FileNotFoundError:
+        raise CrowbarError("git not found") from None
+    except subprocess.CalledProcessError as e:
+        err = e.stderr.decode("utf-8", errors="replace").strip()
+        raise CrowbarError(f"git {args[0]} failed: {err}") from None
+    return proc.stdout
+
+
+def _git_changed(ref: str, cwd: Fpath = ".") -> Set[str]:
+    """
+    The absolute paths of files changed in the git work tree containing `cwd`
+    since `ref`, whether committed or not. Untracked files count as changed,
+    ignored ones do not.
+    """
+    if ref.startswith("-"):
+        raise CrowbarError(f"invalid git revision '{ref}'")
+    top = os.path.realpath(
+        os.fsdecode(_git(cwd, "rev-parse", "--show-toplevel").rstrip(b"\n"))
+    )
+    try:
+        commit = _git(top, "rev-parse", "--verify", "--quiet", f"{ref}^{{commit}}")
+    except CrowbarError:
+        raise CrowbarError(f"unknown git revision '{ref}'") from None
+    # both sides of renames, a module moving away affects its importers
+    diff = _git(
+        top, "diff", "--name-only", "--no-renames", "-z", commit.decode().strip()
+    )
+    untracked = _git(top, "ls-files", "--others", "--exclude-standard", "-z")
+    return {
+        os.path.join(top, os.fsdecode(name))
+        for name in (diff + untracked).split(b"\0")
+        if name
+    }
+
+
+def _select_changed(
+    processor: CrowbarPreprocessor,
+    files: Iterable[FileJob],
+    changed: Set[str],
+    indent_step: str,
+    omit_code_blocks: bool,
+) -> List[FileJob]:
+    """
+    Select the `files` which themselves, or whose dependencies, are among the
+    `changed` paths. Files whose dependencies are unknown are always selected.
+    """
+    selected = []
+    # recorded paths are absolute, but may go through symlinks
+    realpaths: Dict[str, str] = {}
+
+    def realpath(fpath: Fpath) -> str:
+        key = os.fspath(fpath)
+        if key not in realpaths:
+            realpaths[key] = os.path.realpath(key)
+        return realpaths[key]
+
+    for job in files:
+        input_file, output_file = job if isinstance(job, tuple) else (job, None)
+        paths = processor._recorded_paths(
+            input_file, output_file, indent_step, omit_code_blocks
+        )
+        if paths is None or realpath(input_file) in changed:
+            selected.append(job)
+        elif any(realpath(p) in changed for p in paths):
+            selected.append(job)
+    return selected
+
+
+# Watch mode
+# ----------
+class _PollingMonitor:
+    """Detects changes to files by periodically stat'ing them."""
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self._stats: Dict[str, Optional[Tuple[int, int, int]]] = {}
+
+    @staticmethod
+    def _stat(fpath: str) -> Optional[Tuple[int, int, int]]:
+        try:
+            st = os.stat(fpath)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def watch(self, paths: Iterable[str]) -> None:
+        self._stats = {p: self._stats.get(p) or self._stat(p) for p in paths}
+
+    def wait(self, timeout: Optional[float] = None) -> Set[str]:
+        """Block until one or more watched files change, returning their paths."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            changed = set()
+            for fpath, stat in self._stats.items():
+                current = self._stat(fpath)
+                if current != stat:
+                    self._stats[fpath] = current
+                    changed.add(fpath)
+            if changed:
+                return changed
+            if deadline is not None and time.monotonic() >= deadline:
+                return set()
+            time.sleep(self.interval)
+
+    def close(self) -> None:
+        pass
+
+
+class _InotifyMonitor:
+    """Detects changes to files using Linux' inotify (through ctypes)."""
+
+    # IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE - catches in-place writes and
+    # editors replacing files by renaming a new version over them.
+    MASK = 0x8 | 0x80 | 0x200
+    # time to wait for more events after the first, as editors save in steps
+    SETTLE = 0.05
+
+    def __init__(self) -> None:
+        libc_name = ctypes.util.find_library("c")
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs: Dict[int, str] = {}  # watch descriptor -> directory
+        self._paths: Set[str] = set()
+
+    def watch(self, paths: Iterable[str]) -> None:
+        self._paths = set(paths)
+        watched = set(self._dirs.values())
+        for d in {os.path.dirname(p) for p in self._paths} - watched:
+            wd = self._add_watch(self._fd, os.fsencode(d), self.MASK)
+            if wd >= 0:
+                self._dirs[wd] = d
+
+    def _read(self, timeout: Optional[float]) -> Set[str]:
+        changed: Set[str] = set()
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return changed
+        buf = os.read(self._fd, 1 << 16)
+        offset = 0
+        while offset < len(buf):
+            wd, _mask, _cookie, length = struct.unpack_from("iIII", buf, offset)
+            name = buf[offset + 16 : offset + 16 + length].rstrip(b"\0")
+            offset += 16 + length
+            d = self._dirs.get(wd)
+            if d is not None:
+                fpath = os.path.join(d, os.fsdecode(name))
+                if fpath in self._paths:
+                    changed.add(fpath)
+        return changed
+
+    def wait(self, timeout: Optional[float] = None) -> Set[str]:
+        """Block until one or more watched files change, returning their paths."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return set()
+            changed = self._read(remaining)
+            if changed:
+                while more := self._read(self.SETTLE):
+                    changed |= more
+                return changed
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+_Monitor = Union[_PollingMonitor, _InotifyMonitor]
+
+
+def _make_monitor(poll: bool = False, interval: float = 0.5) -> _Monitor:
+    if not poll and sys.platform.startswith("linux"):
+        try:
+            return _InotifyMonitor()
+        except (OSError, AttributeError, TypeError):
+            pass  # no usable inotify, fall back to polling
+    return _PollingMonitor(interval)
+
+
+def _reload_modules(
+    names: Set[str], search: Iterable[str], report: Callable[[str], None]
+) -> Set[str]:
+    """
+    Reload modules `names` and the modules importing them (transitively).
+
+    Modules are reloaded with the `search` directories on `sys.path`, as they
+    were while processing the files importing them. Returns the names of all
+    modules affected, including any which failed to reload.
+    """
+    importers: Dict[str, Set[str]] = {}
+    for importer, imported in _import_graph.items():
+        for name in imported:
+            importers.setdefault(name, set()).add(importer)
+    todo, affected = list(names), set(names)
+    while todo:
+        for importer in importers.get(todo.pop(), ()):
+            if importer not in affected and importer in sys.modules:
+                affected.add(importer)
+                todo.append(importer)
+    affected.discard(__name__)
+    affected.discard("__main__")
+
+    # reload dependencies before the modules importing them
+    ordered: List[str] = []
+    visiting: Set[str] = set()
+
+    def visit(name: str) -> None:
+        if name in visiting or name in ordered:
+            return
+        visiting.add(name)
+        for dep in _import_graph.get(name, ()):
+            if dep in affected:
+                visit(dep)
+        ordered.append(name)
+
+    for name in sorted(affected):
+        visit(name)
+    search = list(dict.fromkeys(search))
+    sys.path[1:1] = search
+    try:
+        for name in ordered:
+            t_start = time.perf_counter()
+            try:
+                importlib.reload(sys.modules[name])
+            except Exception as e:
+                report(f"Error reloading {name}: {type(e).__name__}: {e}")
+                continue
+            report(f"reloaded {name} ({(time.perf_counter() - t_start) * 1000:.1f}ms)")
+    finally:
+        del sys.path[1 : 1 + len(search)]
+    return affected
+
+
+class _Watcher:
+    """
+    Keeps files up to date while their sources change.
+
+    Files are processed by one warm `CrowbarPreprocessor`, keeping imported
+    component modules loaded. If a module changes, it and the modules importing
+    it are reloaded, and only the files depending on any of them are processed.
+    """
+
+    def __init__(
+        self,
+        processor: CrowbarPreprocessor,
+        files: Sequence[FileJob],
+        monitor: _Monitor,
+        report: Callable[[str], None] = print,
+        **options: Any,
+    ):
+        self.processor = processor
+        self.monitor = monitor
+        self.report = report
+        self.options = options
+        self.jobs: Dict[str, _FileTask] = {}
+        for f in files:
+            task = _FileTask(*(f if isinstance(f, tuple) else (f, None)))
+            self.jobs[os.path.abspath(task.input_file)] = task
+        # input file -> what its blocks depended on
+        self.deps: Dict[str, DependencyReport] = {}
+        # stats of files as written by us, changes we made ourselves are ignored
+        self.written: Dict[str, Optional[Tuple[int, int, int]]] = {}
+
+    def process(self, inputs: Iterable[str]) -> None:
+        for fpath in sorted(inputs):
+            task = self.jobs[fpath]
+            result = _process_task(self.processor, task, _FileOptions(**self.options))
+            if result.dependencies is not None:
+                self.deps[fpath] = result.dependencies
+                self.report(
+                    f"{task.input_file}: {result.status} ({result.elapsed * 1000:.1f}ms)"
+                )
+            else:
+                self.report(f"Error processing file: {result.error}")
+            for written in {fpath, str(result.output_file.resolve())}:
+                self.written[written] = _PollingMonitor._stat(written)
+        self.monitor.watch(self.watched())
+
+    def watched(self) -> Set[str]:
+        paths = set(self.jobs)
+        for deps in self.deps.values():
+            paths.update(deps.modules.values())
+            paths.update(deps.files)
+        return paths
+
+    def handle_changes(self, changed: Set[str]) -> None:
+        changed = {
+            p for p in changed if _PollingMonitor._stat(p) != self.written.pop(p, 0)
+        }
+        if not changed:
+            return
+        reloaded = self.reload_modules(changed)
+        stale = {p for p in changed if p in self.jobs}
+        for fpath, deps in self.deps.items():
+            # modules served from the cache may not have been imported (or
+            # reloaded), so their paths are checked as well as reloaded names
+            if (
+                not changed.isdisjoint(deps.files)
+                or not changed.isdisjoint(deps.modules.values())
+                or not reloaded.isdisjoint(deps.modules)
+            ):
+                stale.add(fpath)
+        self.process(stale)
+
+    def reload_modules(self, changed: Set[str]) -> Set[str]:
+        """Reload modules whose source changed and those importing them (transitively)."""
+        names = {
+            name
+            for deps in self.deps.values()
+            for name, fpath in deps.modules.items()
+            if fpath in changed and name in sys.modules
+        }
+        search = [str(Path(fpath).parent) for fpath in self.jobs]
+        return _reload_modules(names, search, self.report)
+
+    def run(self) -> None:
+        self.process(self.jobs)
+        try:
+            while True:
+                self.handle_changes(self.monitor.wait())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.monitor.close()
+
+
+# Daemon
+# ------
+_DEFAULT_SOCKET = ".crowbar.sock"
+
+
+class _Server:
+    """
+    Processes files on behalf of clients connecting to a Unix socket.
+
+    Like `_Watcher`, one warm `CrowbarPreprocessor` is kept around, so that
+    interpreter start-up and imports of component modules are paid only once.
+    Modules changed since the previous request are reloaded, along with the
+    modules importing them, before processing the files of the next request.
+
+    Each request and response is a single line of JSON, e.g.:
+        {"cwd": "/src", "files": [["a.c", null]], "indent_step": "  "}
+        {"results": [{"input_file": "a.c", "status": "rewritten", ...}]}
+    """
+
+    def __init__(
+        self,
+        processor: CrowbarPreprocessor,
+        socket_path: str = _DEFAULT_SOCKET,
+        report: Callable[[str], None] = print,
+        verbose: bool = False,
+    ):
+        self.processor = processor
+        self.socket_path = socket_path
+        self.report = report
+        self.verbose = verbose
+        # name -> path of the modules imported by files processed so far
+        self.modules: Dict[str, str] = {}
+        # directories of the files processed so far, see `_reload_modules`
+        self.search: Dict[str, None] = {}
+        self.monitor = _PollingMonitor()
+        self._closed = False
+
+        if os.path.exists(socket_path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                try:
+                    probe.connect(socket_path)
+                except OSError:
+                    os.unlink(socket_path)  # left behind by a server which died
+                else:
+                    raise CrowbarError(
+                        f"a server is already listening on {socket_path}"
+                    )
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(socket_path)
+        self.sock.listen()
+
+    def refresh(self) -> None:
+        """Reload modules changed since the last request."""
+        changed = self.monitor.wait(timeout=0)
+        names = {
+            name
+            for name, fpath in self.modules.items()
+            if fpath in changed and name in sys.modules
+        }
+        if names:
+            _reload_modules(names, self.search, self.report)
+
+    def handle(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        cwd = request["cwd"]
+        opts = _FileOptions(
+            indent_step=request.get("indent_step", "  "),
+            omit_code_blocks=bool(request.get("omit_code_blocks", False)),
+            write_if_changed=request.get("write_if_changed"),
+        )
+        self.refresh()
+        results = []
+        prev_cwd = os.getcwd()
+        os.chdir(cwd)  # blocks may open files relative to the working directory
+        try:
+            for input_file, output_file in request["files"]:
+                task = _FileTask(
+                    os.path.join(cwd, input_file),
+                    None if output_file is None else os.path.join(cwd, output_file),
+                )
+                result = _process_task(self.processor, task, opts)
+                self.search[os.path.dirname(task.input_file)] = None
+                if result.dependencies is not None:
+                    self.modules.update(result.dependencies.modules)
+                if self.verbose:
+                    status = "cached" if result.cached else result.status
+                    self.report(
+                        f"{task.input_file}: {status or 'error'} "
+                        f"({result.elapsed * 1000:.1f}ms)"
+                    )
+                error = None
+                if result.error is not None:
+                    e = result.error.exception
+                    error = f"{type(e).__name__}: {e}"
+                results.append(
+                    {
+                        "input_file": input_file,
+                        "output_file": output_file,
+                        "elapsed": result.elapsed,
+                        "error": error,
+                        "status": result.status,
+                        "cached": result.cached,
+                        "dependencies": (
+                            None
+                            if result.dependencies is None
+                            else result.dependencies.to_dict()
+                        ),
+                    }
+                )
+        finally:
+            os.chdir(prev_cwd)
+        self.monitor.watch(self.modules.values())
+        return {"results": results}
+
+    def respond(self, line: bytes) -> Dict[str, Any]:
+        try:
+            request = json.loads(line)
+            return self.handle(request)
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            return {"error": f"invalid request: {type(e).__name__}: {e}"}
+
+    def run(self) -> None:
+        self.report(f"listening on {self.socket_path}")
+        try:
+            while True:
+                try:
+                    conn, _ = self.sock.accept()
+                except OSError:
+                    if self._closed:
+                        return
+                    raise
+                try:
+                    with conn, conn.makefile("rwb") as f:
+                        # a client may send several requests over one connection
+                        for line in f:
+                            f.write(json.dumps(self.respond(line)).encode() + b"\n")
+                            f.flush()
+                except OSError:
+                    pass  # client went away
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)  # wakes up a blocked accept()
+        except OSError:
+            pass
+        self.sock.close()
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+
+def _request(
+    socket_path: str,
+    files: Iterable[FileJob],
+    indent_step: str = "  ",
+    omit_code_blocks: bool = False,
+    write_if_changed: Optional[bool] = None,
+) -> List[FileResult]:
+    """Have the server listening on `socket_path` process `files`, see `_Server`."""
+    tasks = [_FileTask(*(f if isinstance(f, tuple) else (f, None))) for f in files]
+    request = {
+        "cwd": os.getcwd(),
+        "files": [
+            [str(t.input_file), None if t.output_file is None else str(t.output_file)]
+            for t in tasks
+        ],
+        "indent_step": indent_step,
+        "omit_code_blocks": omit_code_blocks,
+        "write_if_changed": write_if_changed,
+    }
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        with sock.makefile("rb") as f:
+            line = f.readline()
+    if not line:
+        raise CrowbarError(f"no response from server on {socket_path}")
+    response = json.loads(line)
+    if "error" in response:
+        raise CrowbarError(response["error"])
+    results = []
+    for task, r in zip(tasks, response["results"]):
+        output_file = task.input_file if task.output_file is None else task.output_file
+        results.append(
+            FileResult(
+                Path(task.input_file),
+                Path(output_file),
+                elapsed=r["elapsed"],
+                error=(
+                    None
+                    if r["error"] is None
+                    else FileParseError(task.input_file, CrowbarError(r["error"]))
+                ),
+                status=r["status"],
+                cached=r["cached"],
+                dependencies=(
+                    None
+                    if r["dependencies"] is None
+                    else DependencyReport.from_dict(r["dependencies"])
+                ),
+            )
+        )
+    return results
+
+
+def _serve_main(argv: Sequence[str]) -> None:
+    parser = argparse.ArgumentParser(
+        prog="crowbar.py serve",
+        description="Keep a preprocessor running, processing files sent by "
+        "`crowbar.py --connect SOCKET ...`",
+    )
+    parser.add_argument(
+        "--socket",
+        default=_DEFAULT_SOCKET,
+        help=f"path of the Unix socket to listen on (default: {_DEFAULT_SOCKET})",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=".crowbar-cache",
+        help="where to cache results between runs (default: .crowbar-cache). Only "
+        "imported modules and opened files are tracked, see --no-cache",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        default=False,
+        help="always evaluate all blocks, ignoring (and not updating) the cache. "
+        "Required for blocks whose output depends on e.g. environment variables, "
+        "directory listings or the time",
+    )
+    parser.add_argument(
+        "--cache-max-size",
+        type=_parse_size,
+        default=_BLOCK_CACHE_MAX_SIZE,
+        metavar="SIZE",
+        help="evict cached block output beyond this size, e.g. 500M (default: 1G)",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        default=False,
+        help="report status and processing time for each file",
+    )
+    args = parser.parse_args(argv)
+    cache_dir = None if args.no_cache else os.path.abspath(args.cache_dir)
+    try:
+        server = _Server(
+            CrowbarPreprocessor(cache_dir, args.cache_max_size),
+            args.socket,
+            verbose=args.verbose,
+        )
+    except (CrowbarError, OSError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    server.run()
+
+
+def _parse_size(size: str) -> int:
+    """Parse sizes like '1024', '500K', '1.5G' (powers of 1024) to bytes."""
+    units = {"": 0, "K": 1, "M": 2, "G": 3, "T": 4}
+    m = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*", size, re.IGNORECASE)
+    if m is None:
+        raise ValueError(f"invalid size '{size}'")
+    return int(float(m.group(1)) * 1024 ** units[m.group(2).upper()])
+
+
+def _format_size(size: int) -> str:
+    if size < 1024:
+        return f"{size} B"
+    value = float(size)
+    for unit in ("KiB", "MiB", "GiB"):
+        value /= 1024
+        if value < 1024:
+            break
+    return f"{value:.1f} {unit}"
+
+
+def _dir_usage(path: Path) -> Tuple[int, int]:
+    """Total size and number of files in `path`."""
+    size = count = 0
+    for dirpath, _, fnames in os.walk(path):
+        for fname in fnames:
+            try:
+                size += os.stat(os.path.join(dirpath, fname)).st_size
+            except OSError:
+                continue
+            count += 1
+    return size, count
+
+
+# what crowbar keeps in the cache directory, `crowbar.py cache clear` leaves anything else
+_CACHE_SUBDIRS = ("files", "bytecode", "blocks", "scan")
+
+
+def _cache_main(argv: Sequence[str]) -> None:
+    parser = argparse.ArgumentParser(
+        prog="crowbar.py cache", description="Inspect and manage crowbar's cache"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=".crowbar-cache",
+        help="the cache directory (default: .crowbar-cache)",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("stats", help="show cache size and block cache hit rate")
+    prune = commands.add_parser("prune", help="evict least recently used block output")
+    prune.add_argument(
+        "--max-size",
+        type=_parse_size,
+        default=_BLOCK_CACHE_MAX_SIZE,
+        metavar="SIZE",
+        help="size to shrink the block cache to, e.g. 500M (default: 1G)",
+    )
+    commands.add_parser("clear", help="remove everything from the cache")
+    args = parser.parse_args(argv)
+
+    cache_dir = Path(args.cache_dir)
+    blocks = _BlockCache(cache_dir / "blocks")
+    if args.command == "stats":
+        stats = blocks.stats()
+        lookups = stats["hits"] + stats["misses"]
+        hit_rate = f" ({stats['hits'] / lookups:.1%})" if lookups else ""
+        print(f"cache directory: {cache_dir}")
+        print(f"block hits:      {stats['hits']}{hit_rate}")
+        print(f"block misses:    {stats['misses']}")
+        for name in _CACHE_SUBDIRS:
+            size, count = _dir_usage(cache_dir / name)
+            print(f"{name + ':':<16} {_format_size(size)} in {count} files")
+    elif args.command == "prune":
+        size = blocks.prune(args.max_size)
+        print(f"block cache size: {_format_size(size)}")
+    elif args.command == "clear":
+        for name in _CACHE_SUBDIRS:
+            shutil.rmtree(cache_dir / name, ignore_errors=True)
+
+
+def _depfile_path(fpath: Fpath) -> str:
+    """Escape `fpath` for a Makefile rule, relative to the working directory if inside it."""
+    path = os.fspath(fpath)
+    if os.path.isabs(path):
+        rel = os.path.relpath(path)
+        if not rel.startswith(os.pardir):
+            path = rel
+    return path.replace("$", "$$").replace("#", "\\#").replace(" ", "\\ ")
+
+
+def _write_depfile(fpath: Fpath, results: Iterable[FileResult]) -> None:
+    """
+    Write a Makefile-format depfile (as `gcc -MD` would) with a rule per output,
+    listing its input file and the modules and data files its blocks depended on.
+    """
+    rules = []
+    for result in results:
+        if result.dependencies is None:
+            continue
+        deps: List[Fpath] = [
+            result.input_file,
+            *sorted(result.dependencies.modules.values()),
+            *result.dependencies.files,
+        ]
+        rules.append(
+            f"{_depfile_path(result.output_file)}: "
+            + " \\\n  ".join(dict.fromkeys(map(_depfile_path, deps)))
+            + "\n"
+        )
+    with open(fpath, "w", encoding="utf-8") as fh:
+        fh.writelines(rules)
+
+
+def _check_main(
+    processor: CrowbarPreprocessor, files: List[FileJob], args: argparse.Namespace
+) -> None:
+    """Report (and with --diff, show) the out of date outputs of `files`."""
+    stale: List[Path] = []
+    failed = 0
+    # with --diff, stdout is left for the diffs
+    report = sys.stderr if args.diff else sys.stdout
+    for result in processor.iter_process_many(
+        files,
+        indent_step=args.indent_step,
+        omit_code_blocks=args.no_code_blocks,
+        jobs=args.jobs,
+        check=True,
+        diff=args.diff,
+        ordered=False,
+    ):
+        if result.error is not None:
+            failed += 1
+            print(f"Error processing file: {result.error}", file=report)
+        elif result.status == "stale":
+            stale.append(result.output_file)
+            if result.diff:
+                sys.stdout.write(result.diff)
+                sys.stdout.flush()
+        elif args.verbose:
+            status = "cached" if result.cached else "up to date"
+            print(f"{result.input_file}: {status} ({result.elapsed * 1000:.1f}ms)")
+    for fpath in sorted(stale):
+        print(f"out of date: {fpath}", file=report)
+    if stale or failed:
+        sys.exit(1)
+
+
+def main() -> None:
+    if sys.argv[1:2] == ["serve"]:
+        _serve_main(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ["cache"]:
+        _cache_main(sys.argv[2:])
+        return
+    parser = argparse.ArgumentParser(
+        description="Process Python files with Crowbar preprocessor",
+        epilog="Results are cached in --cache-dir by default, and reused for as long "
+        "as the files and modules the blocks imported or opened are unchanged. Blocks "
+        "depending on anything else (environment variables, directory listings, the "
+        "time, subprocesses) keep their cached output: use --no-cache for those. "
+        "Run `crowbar.py serve` to start a server for use with --connect, "
+        "and `crowbar.py cache {stats,prune,clear}` to manage the cache.",
+    )
+    parser.add_argument(
+        "input_files",
+        nargs="*",
+        metavar="input_file",
+        help="file(s) or glob pattern(s) to process, e.g. 'src/**/*.c'. "
+        "Exactly two plain paths are taken as `input_file output_file`, as in "
+        "earlier versions, unless the second contains blocks; prefer -o for that.",
+    )
+    parser.add_argument(
+        "--scan",
+        action="append",
+        default=[],
+        metavar="DIR",
+        help="also process all files below DIR containing blocks, skipping files ignored by git",
+    )
+    parser.add_argument(
+        "--include",
+        action="append",
+        default=[],
+        metavar="GLOB",
+        help="with --scan, only consider files matching GLOB, e.g. '*.c' or 'src/**/*.h'",
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        metavar="GLOB",
+        help="with --scan, skip files and directories matching GLOB",
+    )
+    parser.add_argument(
+        "--changed-since",
+        default=None,
+        metavar="REF",
+        help="only process files which, or whose dependencies, changed since git revision REF",
+    )
+    parser.add_argument(
+        "--indent-step",
+        default="   ",
+        help="line prefix to add for each level of indentation",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=None,
+        help="where to write result (default: same file). Requires a single input file.",
+    )
+    parser.add_argument(
+        "--no-code-blocks",
+        action="store_true",
         default=False,
         help="write out result without the code blocks themselves. Useful when generating files.",
     )
+    parser.add_argument(
+        "--always-write",
+        action="store_true",
+        default=False,
+        help="rewrite output files even if their contents did not change (updating their mtime)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=".crowbar-cache",
+        help="where to cache results between runs (default: .crowbar-cache). Only "
+        "imported modules and opened files are tracked, see --no-cache",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        default=False,
+        help="always evaluate all blocks, ignoring (and not updating) the cache. "
+        "Required for blocks whose output depends on e.g. environment variables, "
+        "directory listings or the time",
+    )
+    parser.add_argument(
+        "--cache-max-size",
+        type=_parse_size,
+        default=_BLOCK_CACHE_MAX_SIZE,
+        metavar="SIZE",
+        help="evict cached block output beyond this size, e.g. 500M (default: 1G)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="number of files to process in parallel (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        default=False,
+        help="write nothing, but exit with an error listing the files whose output is out of date",
+    )
+    parser.add_argument(
+        "--diff",
+        action="store_true",
+        default=False,
+        help="like --check, printing a unified diff of each out of date output",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        default=False,
+        help="keep running, reprocessing files whenever they or their dependencies change",
+    )
+    parser.add_argument(
+        "--poll",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help="in watch mode, poll for changes at this interval instead of using inotify",
+    )
+    parser.add_argument(
+        "-MD",
+        "--depfile",
+        default=None,
+        metavar="PATH",
+        help="write a Makefile-format depfile listing what each output depends on",
+    )
+    parser.add_argument(
+        "--connect",
+        default=None,
+        metavar="SOCKET",
+        help="have a running `crowbar.py serve` process the files, saving start-up time",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        default=False,
+        help="report status and processing time for each file",
+    )
 
     args = parser.parse_args()
 
-    if not os.path.exists(args.input_file):
-        print(f"Error: Input file {args.input_file} not found")
-        sys.exit(1)
+    output_file = args.output
+    if (
+        output_file is None
+        and len(args.input_files) == 2
+        and not args.scan
+        and not any(glob.has_magic(p) for p in args.input_files)
+    ):
+        # `crowbar.py input-file output-file`, the usage before -o existed. Taken
+        # as such only if it cannot be two files to process, losing the second.
+        if _find_markers(args.input_files[1]):
+            parser.error(
+                f"{args.input_files[1]} contains blocks, use `-o OUTPUT_FILE` to "
+                "write the output of a file to another, or process them one at a time"
+            )
+        args.input_files, output_file = args.input_files[:1], args.input_files[1]
 
-    processor = CrowbarPreprocessor()
+    if not args.input_files and not args.scan:
+        parser.error("no input files given, pass file(s) or --scan DIR")
+    processor = CrowbarPreprocessor(
+        cache_dir=None if args.no_cache else args.cache_dir,
+        cache_max_size=args.cache_max_size,
+    )
     try:
-        processor.process_file(
-            args.input_file,
-            args.output_file,
+        input_files = _expand_paths(args.input_files)
+        for root in args.scan:
+            if not os.path.isdir(root):
+                raise FileNotFoundError(f"directory {root} not found")
+            scanned = _scan_tree(
+                root,
+                args.include,
+                args.exclude,
+                skip=[args.cache_dir],
+                index=processor._marker_index,
+            )
+            seen = {os.path.abspath(p) for p in input_files}
+            input_files += [p for p in scanned if os.path.abspath(p) not in seen]
+    except FileNotFoundError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    if output_file is not None and len(input_files) != 1:
+        print("Error: an output file can only be given when processing a single file")
+        sys.exit(1)
+
+    if args.watch and args.connect is not None:
+        print("Error: --watch and --connect cannot be combined")
+        sys.exit(1)
+    if args.watch and args.depfile is not None:
+        print("Error: --watch and --depfile cannot be combined")
+        sys.exit(1)
+    check = args.check or args.diff
+    if check and (args.watch or args.connect is not None or args.depfile is not None):
+        print(
+            "Error: --check and --diff cannot be combined with --watch, --connect or --depfile"
+        )
+        sys.exit(1)
+
+    files: List[FileJob] = list(input_files)
+    if output_file is not None:
+        files = [(input_files[0], output_file)]
+    if args.changed_since is not None:
+        try:
+            changed = _git_changed(args.changed_since)
+        except CrowbarError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        selected = _select_changed(
+            processor, files, changed, args.indent_step, args.no_code_blocks
+        )
+        if args.verbose:
+            print(
+                f"{len(selected)} of {len(files)} files changed since {args.changed_since}"
+            )
+        files = selected
+    if args.watch:
+        _Watcher(
+            processor,
+            files,
+            _make_monitor(poll=args.poll is not None, interval=args.poll or 0.5),
+            indent_step=args.indent_step,
+            omit_code_blocks=args.no_code_blocks,
+            write_if_changed=False if args.always_write else None,
+        ).run()
+        return
+    if check:
+        _check_main(processor, files, args)
+        return
+    if args.connect is not None:
+        try:
+            results = _request(
+                args.connect,
+                files,
+                indent_step=args.indent_step,
+                omit_code_blocks=args.no_code_blocks,
+                write_if_changed=False if args.always_write else None,
+            )
+        except (CrowbarError, OSError, ValueError) as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+    else:
+        results = processor.process_many(
+            files,
             indent_step=args.indent_step,
             omit_code_blocks=args.no_code_blocks,
+            jobs=args.jobs,
+            write_if_changed=False if args.always_write else None,
         )
-    except Exception as e:
-        print(f"Error processing file: {e}")
+    if args.depfile is not None:
+        _write_depfile(args.depfile, results)
+    failed = 0
+    for result in results:
+        if result.error is not None:
+            failed += 1
+            print(f"Error processing file: {result.error}")
+        elif args.verbose:
+            status = "cached" if result.cached else result.status
+            print(f"{result.input_file}: {status} ({result.elapsed * 1000:.1f}ms)")
+    if failed:
         sys.exit(1)
 
 
@@ -582,6 +4391,9 @@ if __name__ == "__main__":
 __all__ = [
     "component",
     "Emitter",
+    "AsyncEmitter",
+    "render",
+    "capture",
     "nl",
     "fl",
     "lc",
@@ -589,4 +4401,7 @@ __all__ = [
     "dedent",
     "CrowbarError",
     "CrowbarPreprocessor",
+    "FileResult",
+    "DependencyReport",
+    "BlockDependencies",
 ]
@@ -1,5 +1,5 @@
 from page_index import index_page, SITE_DIR
-from crowbar import Emitter
+from crowbar import render
 import shutil
 
 def gen_site():
@@ -12,11 +12,8 @@ def gen_site():
     for asset in assets:
         shutil.copy(SITE_DIR / asset, SITE_OUT)
 
-    out = []
-    emit = Emitter(writer=out.append)
-    emit(index_page())
     with open(SITE_OUT / "index.html", mode="w") as fh:
-        fh.write("".join(out))
+        fh.write(render(index_page()))
 
 
 
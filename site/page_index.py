@@ -274,6 +274,99 @@ site_body = body(
         "for project starter templates and such. To omit the blocks from the output, run crowbar like so: "
     ),
     code_block("python crowbar.py --no-code-blocks input-file output-file"),
+    p(
+        PARAGRAPH_ATTRS,
+        "Crowbar accepts any number of files or glob patterns, processing them in parallel. "
+        "Use ", code("--jobs N"), " to limit the number of worker processes. Exactly two plain "
+        "paths are still read as input and output file, as above, unless the second contains "
+        "blocks, in which case crowbar refuses rather than overwrite it. Use ", code("-o"),
+        " for the output file in new scripts:"
+    ),
+    code_block("python crowbar.py --jobs 4 'src/**/*.c' include/*.h"),
+    p(
+        PARAGRAPH_ATTRS,
+        "Or let crowbar find them: ", code("--scan DIR"), " processes every file below ",
+        code("DIR"), " containing a block, skipping files ignored by git. Narrow it down with ",
+        code("--include"), " and ", code("--exclude"), " globs. Where blocks were found is "
+        "remembered in the cache, so later scans only read files which changed since:"
+    ),
+    code_block("python crowbar.py --scan . --include '*.c' --exclude vendor/"),
+    p(
+        PARAGRAPH_ATTRS,
+        "In CI, ", code("--changed-since REF"), " narrows this down further, to the files which "
+        "changed since a git revision, or whose blocks imported a module or read a file which did. "
+        "What each file depended on is taken from the cache, files crowbar knows nothing about are "
+        "always processed:"
+    ),
+    code_block("python crowbar.py --scan . --changed-since origin/main"),
+    p(
+        PARAGRAPH_ATTRS,
+        "To verify that checked-in output is up to date, ", code("--check"), " evaluates the "
+        "files without writing them, exiting with an error listing those which are out of date. "
+        "Evaluating a file stops at its first difference. ", code("--diff"), " prints a unified "
+        "diff of each out of date file as well:"
+    ),
+    code_block("python crowbar.py --scan . --diff"),
+    p(
+        PARAGRAPH_ATTRS,
+        "Crowbar remembers which modules and data files the blocks of each file used (in ",
+        code(".crowbar-cache/"), ", see ", code("--cache-dir"), "). Files are only evaluated "
+        "again if they, or one of their dependencies, changed since the last run. Use ",
+        code("--no-cache"), " to evaluate everything regardless."
+    ),
+    p(
+        PARAGRAPH_ATTRS,
+        "The output of individual blocks is cached too, shared between files: a block is not "
+        "evaluated again if its source, the blocks before it and the files it read are unchanged. "
+        "If a block did change, the globals defined by the blocks before it are restored from "
+        "a checkpoint where they can be pickled, rather than evaluating those blocks again. "
+        "Point ", code("--cache-dir"), " at a shared directory to share this cache between "
+        "machines. Checkpoints and compiled blocks are only loaded if signed with your own key, "
+        "kept in ", code("~/.cache/crowbar/key"), " (or under ", code("$XDG_CACHE_HOME"), "): "
+        "others are ignored, so anyone able to write to the cache cannot run code as you. Copy "
+        "the key to machines you trust to share those too. The cache is kept below ", code("--cache-max-size"), " (1G by default), and can be "
+        "inspected and managed with ", code("crowbar.py cache stats|prune|clear"), "."
+    ),
+    p(
+        PARAGRAPH_ATTRS,
+        emph("Caching is on by default, and only knows about the modules and files blocks import "
+             "or open. Blocks whose output depends on anything else, such as environment variables, "
+             "directory listings, the current time or the output of subprocesses, keep returning "
+             "their cached output until their source or dependencies change. Process such files "
+             "with --no-cache.")
+    ),
+    p(
+        PARAGRAPH_ATTRS,
+        "When driven by a build system, ", code("--depfile PATH"), " (or ", code("-MD PATH"),
+        ") writes a Makefile-format depfile, like gcc's, listing the input, modules and data files "
+        "each output depends on. With ninja:"
+    ),
+    code_block("rule crowbar\n"
+               "  command = python crowbar.py --no-code-blocks -MD $out.d $in $out\n"
+               "  depfile = $out.d\n"
+               "  deps = gcc"),
+    p(
+        PARAGRAPH_ATTRS,
+        "While editing, ", code("--watch"), " keeps crowbar running and reprocesses files as they, "
+        "or the modules and data files they depend on, change. Changed component modules are "
+        "reloaded along with the modules importing them. Where inotify is unavailable, files are "
+        "polled instead (see ", code("--poll"), "):"
+    ),
+    code_block("python crowbar.py --watch 'src/**/*.c'"),
+    p(
+        PARAGRAPH_ATTRS,
+        "For editor and pre-commit hooks, ", code("crowbar.py serve"), " keeps a preprocessor, and "
+        "the component modules it imported, running in the background. Pass ", code("--connect"),
+        " to have it process the files instead, saving the start-up time of each run:"
+    ),
+    code_block("python crowbar.py serve --socket .crowbar.sock &\n"
+               "python crowbar.py --connect .crowbar.sock src/main.c"),
+    p(
+        PARAGRAPH_ATTRS,
+        "Requests are a single line of JSON, so the fastest hooks skip starting Python altogether:"
+    ),
+    code_block("echo '{\"cwd\": \"'$PWD'\", \"files\": [[\"src/main.c\", null]]}' \\\n"
+               "  | socat - UNIX-CONNECT:.crowbar.sock"),
     section("Why use crowbar?"),
     ul(
         "BSD-2 license",
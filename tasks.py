@@ -139,6 +139,38 @@ def run_tox():
     sys.exit(result.returncode)
 
 
+@task("bench", "Run benchmarks, optionally comparing against a baseline")
+def run_bench():
+    parser = get_parser_for_task("bench")
+    parser.add_argument("--repeat", type=int, default=None, help="best of N runs")
+    parser.add_argument("--only", nargs="+", metavar="NAME", help="run only these workloads")
+    parser.add_argument("-o", "--output", help="write results to this JSON file")
+    parser.add_argument("--compare", metavar="BASELINE", help="JSON results to compare against")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=None,
+        help="allowed throughput drop / peak memory growth, as a fraction (default: 0.1)",
+    )
+
+    args = parser.parse_args()
+
+    cmd = [sys.executable, "benchmarks/bench.py"]
+    if args.repeat is not None:
+        cmd.extend(["--repeat", str(args.repeat)])
+    if args.only:
+        cmd.extend(["--only", *args.only])
+    if args.output:
+        cmd.extend(["--output", args.output])
+    if args.compare:
+        cmd.extend(["--compare", args.compare])
+    if args.threshold is not None:
+        cmd.extend(["--threshold", str(args.threshold)])
+
+    result = subprocess.run(cmd)
+    sys.exit(result.returncode)
+
+
 @task("gensite", "Generate website")
 def run_gensite():
     parser = get_parser_for_task("gensite")
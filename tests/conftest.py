@@ -1,5 +1,12 @@
 import sys
 from pathlib import Path
 
+import pytest
 
 sys.path.insert(0, str(Path(__file__).parent))
+
+
+@pytest.fixture(autouse=True)
+def signing_key_home(tmp_path_factory, monkeypatch):
+    """Keep the signing key of cached checkpoints and bytecode out of ~/.cache."""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path_factory.getbasetemp() / "home"))
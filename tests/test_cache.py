@@ -0,0 +1,321 @@
+from crowbar import *
+from test_utils.utils import slurp
+import json
+import os
+import pytest
+
+CACHED_FILE = """\
+# <<crowbar
+# import cache_test_components as c
+# emit(c.greet(open("name.txt").read().strip()))
+# >>
+# <<end>>
+"""
+
+COMPONENTS = """\
+from crowbar import *
+
+@component
+def greet(emit, name):
+    emit(f"hello, {name}!")
+"""
+
+
+def touch(fpath, contents):
+    """Write `contents` to `fpath`, ensuring its mtime changes."""
+    st = os.stat(fpath) if fpath.exists() else None
+    fpath.write_text(contents)
+    if st is not None:
+        os.utime(fpath, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))
+
+
+def test_file_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    src = tmp_path / "file.py"
+    src.write_text(CACHED_FILE)
+    (tmp_path / "cache_test_components.py").write_text(COMPONENTS)
+    (tmp_path / "name.txt").write_text("gordon")
+    cache_dir = tmp_path / ".crowbar-cache"
+
+    result = CrowbarPreprocessor(cache_dir=cache_dir).process_file(src)
+    assert not result.cached
+    assert "hello, gordon!" in slurp(src)
+
+    # fresh preprocessor instance, as if crowbar was run again
+    assert CrowbarPreprocessor(cache_dir=cache_dir).process_file(src).cached
+
+    # touching the file (without changing it) does not invalidate the cache
+    touch(src, slurp(src))
+    assert CrowbarPreprocessor(cache_dir=cache_dir).process_file(src).cached
+
+    # changing a file read by a block does
+    touch(tmp_path / "name.txt", "alex")
+    result = CrowbarPreprocessor(cache_dir=cache_dir).process_file(src)
+    assert not result.cached
+    assert "hello, alex!" in slurp(src)
+    assert CrowbarPreprocessor(cache_dir=cache_dir).process_file(src).cached
+
+    # ... as does changing an imported module
+    touch(tmp_path / "cache_test_components.py", COMPONENTS + "\n# changed\n")
+    assert not CrowbarPreprocessor(cache_dir=cache_dir).process_file(src).cached
+
+    # ... or the file itself
+    touch(src, slurp(src) + "\n")
+    assert not CrowbarPreprocessor(cache_dir=cache_dir).process_file(src).cached
+
+
+def test_file_cache_output_changed(tmp_path):
+    src = tmp_path / "in.txt"
+    src.write_text('# <<crowbar emit("generated")>>\n# <<end>>\n')
+    dst = tmp_path / "out.txt"
+    cache_dir = tmp_path / ".crowbar-cache"
+
+    p = CrowbarPreprocessor(cache_dir=cache_dir)
+    assert not p.process_file(src, dst, omit_code_blocks=True).cached
+    assert p.process_file(src, dst, omit_code_blocks=True).cached
+    # options are part of the cache key
+    assert not p.process_file(src, dst).cached
+
+    # the output file was altered or removed, regenerate it
+    touch(dst, "garbage")
+    assert not p.process_file(src, dst).cached
+    assert p.process_file(src, dst).cached
+    dst.unlink()
+    assert not p.process_file(src, dst).cached
+    assert slurp(dst) == slurp(src).replace("# <<end>>", "generated\n# <<end>>")
+
+
+def test_code_cache(tmp_path):
+    from crowbar import _CodeCache
+
+    key = b"k" * 32
+    src = "x = 1\nemit(x)\n"
+    cache = _CodeCache(tmp_path, key=key)
+    code = cache.compile(src)
+    assert cache.compile(src) is code
+    assert len(list(tmp_path.glob("*/*.pyc"))) == 1
+
+    # a new instance (as in a new run) loads the marshalled code from disk
+    loaded = _CodeCache(tmp_path, key=key).compile(src)
+    assert loaded is not code
+    assert loaded == code
+
+    # code signed with another key is not trusted
+    assert _CodeCache(tmp_path, key=b"x" * 32).compile(src) is not loaded
+
+    # corrupt cache files are ignored
+    for fpath in tmp_path.glob("*/*.pyc"):
+        fpath.write_bytes(b"garbage")
+    assert _CodeCache(tmp_path, key=key).compile(src) == code
+
+
+def test_code_cache_unsigned(tmp_path):
+    import importlib.util
+    import marshal
+
+    from crowbar import _CodeCache
+
+    src = "x = 1\n"
+    _CodeCache(tmp_path, key=b"k" * 32).compile(src)
+    # e.g. someone else with write access to a shared cache replacing the code
+    evil = compile("x = 2\n", "<string>", "exec")
+    for fpath in tmp_path.glob("*/*.pyc"):
+        fpath.write_bytes(importlib.util.MAGIC_NUMBER + marshal.dumps(evil))
+    namespace: dict = {}
+    exec(_CodeCache(tmp_path, key=b"k" * 32).compile(src), namespace)
+    assert namespace["x"] == 1
+
+    # without a key, nothing is written to (or read from) disk
+    _CodeCache(tmp_path / "nokey").compile(src)
+    assert not (tmp_path / "nokey").exists()
+
+
+def test_code_cache_bounded():
+    from crowbar import _CodeCache
+
+    cache = _CodeCache(maxsize=2)
+    first = cache.compile("a = 1")
+    cache.compile("b = 1")
+    cache.compile("a = 1")  # most recently used again
+    cache.compile("c = 1")
+    assert cache.compile("a = 1") is first
+    assert len(cache._code) == 2
+
+
+BLOCKS_FILE = """\
+# <<crowbar
+# names = open("names.txt").read().split()
+# >>
+# <<end>>
+# <<crowbar
+# for name in names:
+#     emit(f"hello, {name}!", nl)
+# >>
+# <<end>>
+# <<crowbar emit("static")>>
+# <<end>>
+"""
+
+
+def test_block_cache(tmp_path, monkeypatch):
+    from crowbar import _BlockCache
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "names.txt").write_text("gordon alex")
+    first, second = tmp_path / "first.py", tmp_path / "second.py"
+    first.write_text(BLOCKS_FILE)
+    second.write_text(BLOCKS_FILE.replace("hello", "bye"))
+    cache_dir = tmp_path / ".crowbar-cache"
+
+    def stats():
+        return _BlockCache(cache_dir / "blocks").stats()
+
+    CrowbarPreprocessor(cache_dir=cache_dir).process_file(first)
+    assert (stats()["hits"], stats()["misses"]) == (0, 3)
+    expected = slurp(first)
+    assert "hello, alex!" in expected
+
+    # evaluating the file again (bypassing the file cache), all blocks are cached
+    CrowbarPreprocessor(cache_dir=cache_dir).process_file(first, write_if_changed=False)
+    assert (stats()["hits"], stats()["misses"]) == (3, 3)
+    assert slurp(first) == expected
+
+    # blocks are shared between files. The first block is found in the cache,
+    # yet still evaluated for the changed block after it, which uses `names`.
+    result = CrowbarPreprocessor(cache_dir=cache_dir).process_file(second)
+    assert (stats()["hits"], stats()["misses"]) == (4, 5)
+    assert slurp(second) == expected.replace("hello", "bye")
+    assert [b.lineno for b in result.dependencies.blocks] == [1, 5, 10]
+    assert result.dependencies.files == [str(tmp_path / "names.txt")]
+
+    # changing a file read by a block invalidates it, and the blocks after it
+    touch(tmp_path / "names.txt", "eli")
+    CrowbarPreprocessor(cache_dir=cache_dir).process_file(first, write_if_changed=False)
+    assert (stats()["hits"], stats()["misses"]) == (4, 8)
+    assert "hello, eli!" in slurp(first)
+    assert "hello, alex!" not in slurp(first)
+
+    # least recently used entries are evicted beyond the maximum size
+    size = stats()["size"]
+    assert size > 0
+    assert _BlockCache(cache_dir / "blocks").prune(size // 2) <= size // 2
+    CrowbarPreprocessor(cache_dir=cache_dir).process_file(first, write_if_changed=False)
+    assert "hello, eli!" in slurp(first)
+
+
+CHECKPOINT_FILE = """\
+# <<crowbar
+# import os
+# with open("runs.txt", "a") as fh:
+#     fh.write("x")
+# del fh
+# data = {"answer": 42}
+# >>
+# <<end>>
+# <<crowbar emit(str(data["answer"]))>>
+# <<end>>
+"""
+
+
+@pytest.mark.parametrize("picklable", [True, False])
+def test_block_cache_checkpoints(tmp_path, monkeypatch, picklable):
+    monkeypatch.chdir(tmp_path)
+    src = CHECKPOINT_FILE
+    if not picklable:
+        # functions defined in blocks cannot be pickled
+        src = src.replace("# del fh\n", "# del fh\n# def helper(): pass\n")
+    first, second = tmp_path / "first.py", tmp_path / "second.py"
+    first.write_text(src)
+    second.write_text(src.replace('["answer"]', '["answer"] + 1'))
+    cache_dir = tmp_path / ".crowbar-cache"
+
+    CrowbarPreprocessor(cache_dir=cache_dir).process_file(first)
+    assert slurp(tmp_path / "runs.txt") == "x"
+    # the first block is cached, but its globals are needed by the second block.
+    # They are restored from a checkpoint if possible, otherwise it is evaluated again.
+    CrowbarPreprocessor(cache_dir=cache_dir).process_file(second)
+    assert "\n43\n" in slurp(second)
+    assert slurp(tmp_path / "runs.txt") == ("x" if picklable else "xx")
+
+
+class _Evil:
+    def __reduce__(self):
+        return (open, ("pwned.txt", "w"))
+
+
+def test_block_cache_checkpoints_signed(tmp_path, monkeypatch):
+    import pickle
+
+    monkeypatch.chdir(tmp_path)
+    first, second = tmp_path / "first.py", tmp_path / "second.py"
+    first.write_text(CHECKPOINT_FILE)
+    second.write_text(CHECKPOINT_FILE.replace('["answer"]', '["answer"] + 1'))
+    cache_dir = tmp_path / ".crowbar-cache"
+    CrowbarPreprocessor(cache_dir=cache_dir).process_file(first)
+
+    # someone else with write access to the cache replaces the checkpoint
+    manifests = list((cache_dir / "blocks" / "manifests").glob("*/*.json"))
+    checkpoints = [
+        e["checkpoint"] for m in manifests for e in json.loads(m.read_text())
+    ]
+    (digest,) = [c for c in checkpoints if c is not None]
+    blob = cache_dir / "blocks" / "outputs" / digest[:2] / digest
+    blob.write_bytes(bytes(32) + pickle.dumps(_Evil()))
+
+    # it is not loaded, the block is evaluated again instead
+    CrowbarPreprocessor(cache_dir=cache_dir).process_file(second)
+    assert not (tmp_path / "pwned.txt").exists()
+    assert "\n43\n" in slurp(second)
+    assert slurp(tmp_path / "runs.txt") == "xx"
+
+
+REGISTRY_FILE = """\
+# <<crowbar
+# import cache_test_registry as registry
+# {first}
+# >>
+# <<end>>
+# <<crowbar
+# {second}
+# >>
+# <<end>>
+"""
+
+
+@pytest.mark.parametrize(
+    "first, second, expected",
+    [
+        # the skipped block changes the state of a module
+        (
+            'registry.NAMES.append("gordon")',
+            'emit(", ".join(registry.NAMES) + "!")',
+            "gordon!",
+        ),
+        # the globals of the skipped block share objects with a module
+        (
+            "names = registry.NAMES",
+            'names.append("alex")\n# emit(", ".join(registry.NAMES))',
+            "alex",
+        ),
+    ],
+    ids=["module state", "shared object"],
+)
+def test_block_cache_checkpoints_shared_state(
+    tmp_path, monkeypatch, first, second, expected
+):
+    import sys
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "cache_test_registry.py").write_text("NAMES = []\n")
+    src = REGISTRY_FILE.format(first=first, second=second)
+    first_file, second_file = tmp_path / "first.py", tmp_path / "second.py"
+    first_file.write_text(src.replace(second, 'emit("first")'))
+    second_file.write_text(src)
+    cache_dir = tmp_path / ".crowbar-cache"
+
+    CrowbarPreprocessor(cache_dir=cache_dir).process_file(first_file)
+    # as in a new process, the module is imported again when restoring globals
+    monkeypatch.delitem(sys.modules, "cache_test_registry")
+    # the first block is cached, the globals it leaves must be as if it ran
+    CrowbarPreprocessor(cache_dir=cache_dir).process_file(second_file)
+    assert f"\n{expected}\n" in slurp(second_file)
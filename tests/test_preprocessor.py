@@ -9,6 +9,9 @@ from test_utils.utils import WithNamedTempFile, slurp
 from pathlib import Path
 import pytest
 from contextlib import contextmanager
+import crowbar
+import errno
+import tracemalloc
 
 
 CWD = Path(__file__).parent
@@ -175,3 +178,349 @@ def test_code_indent_insufficient_multiple_2():
     """Multiple lines, different prefixes, so we will raise an indentation error"""
     with xraises(IndentationError):
         process_file(CWD / "preproc_code_indent_insufficient_multiple_2")
+
+
+BATCH_OK = """\
+# <<crowbar emit("x = ", lc, 40 + 2)>>
+# <<end>>
+"""
+
+BATCH_BROKEN = """\
+# <<crowbar emit(undefined_name)>>
+# <<end>>
+"""
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_process_many(tmp_path, jobs):
+    """Files are processed independently, errors are reported per-file"""
+    files = []
+    for i, contents in enumerate([BATCH_OK, BATCH_BROKEN, BATCH_OK]):
+        fpath = tmp_path / f"file{i}.py"
+        fpath.write_text(contents)
+        files.append(fpath)
+
+    p = CrowbarPreprocessor()
+    results = p.process_many(files, jobs=jobs)
+
+    assert [r.input_file for r in results] == files
+    assert [r.ok for r in results] == [True, False, True]
+    assert all(r.elapsed > 0 for r in results)
+    assert isinstance(results[1].error, FileParseError)
+    assert isinstance(results[1].error.exception, CodeEvalError)
+    assert "undefined_name" in str(results[1].error)
+    # the broken file is left untouched
+    assert slurp(files[1]) == BATCH_BROKEN
+    for fpath in (files[0], files[2]):
+        assert slurp(fpath) == BATCH_OK.replace("# <<end>>", "x = 42\n# <<end>>")
+
+
+def test_process_many_output_pairs(tmp_path):
+    """(input, output) pairs write the result elsewhere"""
+    src = tmp_path / "in.py"
+    src.write_text(BATCH_OK)
+    dst = tmp_path / "out.py"
+    results = CrowbarPreprocessor().process_many(
+        [(src, dst)], omit_code_blocks=True, jobs=1
+    )
+    assert results[0].ok
+    assert results[0].output_file == dst
+    assert slurp(dst) == "x = 42\n"
+    assert slurp(src) == BATCH_OK
+
+
+def test_write_if_changed(tmp_path):
+    """In-place runs leave files untouched if the generated output is the same"""
+    fpath = tmp_path / "file.py"
+    fpath.write_text(BATCH_OK)
+    p = CrowbarPreprocessor()
+
+    assert p.process_file(fpath).status == "rewritten"
+    stat = fpath.stat()
+    assert p.process_file(fpath).status == "unchanged"
+    assert fpath.stat().st_mtime_ns == stat.st_mtime_ns
+    assert fpath.stat().st_ino == stat.st_ino
+    # no temporary files are left behind
+    assert list(tmp_path.iterdir()) == [fpath]
+
+    # explicitly disabled, the file is always rewritten
+    assert p.process_file(fpath, write_if_changed=False).status == "rewritten"
+    assert fpath.stat().st_ino != stat.st_ino
+    assert slurp(fpath) == BATCH_OK.replace("# <<end>>", "x = 42\n# <<end>>")
+
+
+def test_write_if_changed_default_off_for_other_output(tmp_path):
+    src = tmp_path / "in.py"
+    src.write_text(BATCH_OK)
+    dst = tmp_path / "out.py"
+    p = CrowbarPreprocessor()
+    assert p.process_file(src, dst).status == "rewritten"
+    assert p.process_file(src, dst).status == "rewritten"
+    assert p.process_file(src, dst, write_if_changed=True).status == "unchanged"
+
+
+DEPS_FILE = """\
+# <<crowbar
+# import deps_test_components as c
+# >>
+# <<end>>
+# <<crowbar emit(open("name.txt").read().strip())>>
+# <<end>>
+"""
+
+
+def test_dependency_report(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "deps_test_helper.py").write_text("X = 1\n")
+    (tmp_path / "deps_test_components.py").write_text(
+        "import json\nimport deps_test_helper\n"
+    )
+    (tmp_path / "name.txt").write_text("gordon")
+    src = tmp_path / "file.py"
+    src.write_text(DEPS_FILE)
+
+    cache_dir = tmp_path / ".crowbar-cache"
+    result = CrowbarPreprocessor(cache_dir=cache_dir).process_file(src)
+    deps = result.dependencies
+    # modules imported by imported modules are included, the stdlib is not
+    assert deps.modules == {
+        "deps_test_components": str(tmp_path / "deps_test_components.py"),
+        "deps_test_helper": str(tmp_path / "deps_test_helper.py"),
+    }
+    assert deps.files == [str(tmp_path / "name.txt")]
+    assert [b.lineno for b in deps.blocks] == [1, 5]
+    assert deps.blocks[0].modules == deps.modules
+    assert deps.blocks[0].files == []
+    assert deps.blocks[1].modules == {}
+    assert deps.blocks[1].files == deps.files
+
+    # the same report is given when the cache says nothing changed
+    cached = CrowbarPreprocessor(cache_dir=cache_dir).process_file(src)
+    assert cached.cached
+    assert cached.dependencies == deps
+
+
+def test_depfile(tmp_path, monkeypatch):
+    from crowbar import _write_depfile
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "depfile_helper.py").write_text("X = 1\n")
+    (tmp_path / "depfile_components.py").write_text("import depfile_helper\n")
+    (tmp_path / "my name.txt").write_text("gordon")
+    src = tmp_path / "file.py"
+    src.write_text(
+        DEPS_FILE.replace("deps_test_", "depfile_").replace("name.txt", "my name.txt")
+    )
+
+    results = CrowbarPreprocessor().process_many([("file.py", "out.py")], jobs=1)
+    _write_depfile("out.d", results)
+    assert slurp(tmp_path / "out.d") == (
+        "out.py: file.py \\\n"
+        "  depfile_components.py \\\n"
+        "  depfile_helper.py \\\n"
+        "  my\\ name.txt\n"
+    )
+
+
+NAMESPACE_FILE = """\
+# <<crowbar
+# x = 1
+# nl = "shadowed"
+# def write_file(): pass
+# def show(value):
+#     emit(str(value))
+# >>
+# <<end>>
+# <<crowbar
+# emit(str(x))
+# emit(str(nl is crowbar.nl))
+# emit(str("write_file" in globals()))
+# show(x + 1)
+# >>
+# <<end>>
+"""
+
+
+def test_shared_namespace(tmp_path):
+    """Blocks see earlier definitions, but not redefined crowbar built-ins"""
+    fpath = tmp_path / "file.py"
+    fpath.write_text(NAMESPACE_FILE)
+    CrowbarPreprocessor().process_file(fpath)
+    assert slurp(fpath).endswith("# >>\n1\nTrue\nFalse\n2\n# <<end>>\n")
+
+
+SCAN_BLOCK = """\
+  # <<crowbar
+  # emit("héllo")
+  # >>
+  # <<end>>
+"""
+
+
+@pytest.mark.parametrize("lines", [3, 10_000])
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+def test_scan_blocks(tmp_path, lines, newline):
+    """Large files are scanned in bulk, line numbers must stay exact"""
+    padding = "".join(f"x = 'ünïcode {i}'\n" for i in range(lines))
+    contents = f"{padding}{SCAN_BLOCK}{padding}# <<crowbar emit(a)>>\n# <<end>>\n{padding}"
+    fpath = tmp_path / "file.py"
+    fpath.write_bytes(contents.replace("\n", newline).encode("utf-8"))
+    with xraises(CodeEvalError) as exc_info:
+        CrowbarPreprocessor().process_file(fpath)
+    assert exc_info.value.start_line == 2 * lines + 5
+
+    fpath.write_bytes(contents.replace("(a)", "('a')").replace("\n", newline).encode("utf-8"))
+    result = CrowbarPreprocessor().process_file(fpath)
+    assert [b.lineno for b in result.dependencies.blocks] == [lines + 1, 2 * lines + 5]
+    assert slurp(fpath) == contents.replace("(a)", "('a')").replace(
+        "  # >>\n", "  # >>\n  héllo\n"
+    ).replace("# <<crowbar emit('a')>>\n", "# <<crowbar emit('a')>>\na\n")
+
+
+def unsupported_copy(src, dst, offset, count):
+    raise OSError(errno.EXDEV, "cross-device link")
+
+
+@pytest.mark.parametrize("copy_fn", [None, unsupported_copy])
+def test_copy_unchanged_ranges(tmp_path, monkeypatch, copy_fn):
+    """Large unchanged regions are copied kernel-side, falling back to plain writes"""
+    copied = []
+    copy_fns = crowbar._copy_fns()
+
+    def record(src, dst, offset, count):
+        copied.append((offset, count))
+        return copy_fns[0](src, dst, offset, count)
+
+    monkeypatch.setattr(crowbar, "_copy_fns", lambda: [copy_fn or record])
+    padding = "".join(f"x = {i}\n" for i in range(20_000))
+    block = "# <<crowbar emit('a')>>\n# <<end>>\n"
+    fpath = tmp_path / "file.py"
+    fpath.write_text(f"{padding}{block}{padding}")
+    CrowbarPreprocessor().process_file(fpath, tmp_path / "out.py")
+    assert slurp(tmp_path / "out.py") == (
+        f"{padding}# <<crowbar emit('a')>>\na\n# <<end>>\n{padding}"
+    )
+    if copy_fn is None and copy_fns:
+        offset = len(padding) + len(block)
+        assert copied == [(0, len(padding)), (offset, len(padding))]
+
+
+STREAM_FILE = """\
+# <<crowbar
+# for i in range(LINES):
+#     emit(f"{i:099}")
+# def later(emit=emit):
+#     emit("stale")
+# >>
+# <<end>>
+# <<crowbar emit("second"); later()>>
+# <<end>>
+"""
+
+
+def test_stream_block_output(tmp_path):
+    """Block output goes to the output file as emitted, rather than being accumulated"""
+    fpath = tmp_path / "file.py"
+    fpath.write_text(STREAM_FILE.replace("LINES", "80_000"))
+    tracemalloc.start()
+    try:
+        CrowbarPreprocessor().process_file(fpath, tmp_path / "out.py")
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert peak < 2_000_000  # output is 8MB
+    lines = slurp(tmp_path / "out.py").split("\n")
+    assert len(lines) == 80_000 + 11
+    assert lines[6:8] == [f"{0:099}", f"{1:099}"]
+    # emitting through `emit` of an earlier block has no effect
+    assert lines[-4:] == ['# <<crowbar emit("second"); later()>>', "second", "# <<end>>", ""]
+
+
+CHECK_FILE = """\
+# <<crowbar
+# emit("one")
+# reached = 1
+# >>
+one
+# <<end>>
+# <<crowbar
+# emit("two")
+# reached = 2
+# >>
+old
+# <<end>>
+# <<crowbar reached = 3>>
+# <<end>>
+"""
+
+
+def test_check(tmp_path):
+    """Checking writes nothing, stopping at the first difference"""
+    fpath = tmp_path / "file.py"
+    fpath.write_text(CHECK_FILE)
+    st = fpath.stat()
+    p = CrowbarPreprocessor()
+    result = p.process_file(fpath, check=True)
+    assert result.status == "stale" and result.dependencies is None
+    assert p.crowbar_globals["reached"] == 2
+
+    result = p.process_file(fpath, diff=True)
+    assert result.status == "stale" and p.crowbar_globals["reached"] == 3
+    assert result.diff == (
+        f"--- {fpath}\n+++ {fpath} (generated)\n@@ -8,7 +8,7 @@\n"
+        " # emit(\"two\")\n # reached = 2\n # >>\n-old\n+two\n # <<end>>\n"
+        " # <<crowbar reached = 3>>\n # <<end>>\n"
+    )
+    assert fpath.stat().st_mtime_ns == st.st_mtime_ns
+    assert slurp(fpath) == CHECK_FILE
+
+    p.process_file(fpath)
+    assert p.process_file(fpath, check=True).status == "unchanged"
+    assert p.process_file(fpath, diff=True).diff == ""
+    out = tmp_path / "out.py"
+    assert p.process_file(fpath, out, check=True).status == "stale"
+    assert not out.exists()
+    p.process_file(fpath, out)
+    assert p.process_file(fpath, out, check=True).status == "unchanged"
+    # trailing content which is not generated
+    out.write_text(slurp(out) + "extra\n")
+    assert p.process_file(fpath, out, check=True).status == "stale"
+
+
+def test_iter_process_many_unordered(tmp_path):
+    """Unordered, results are yielded as files complete"""
+    slow, fast = tmp_path / "slow.py", tmp_path / "fast.py"
+    done = tmp_path / "fast.done"
+    # the slow file waits until the fast one is processed
+    slow.write_text(
+        "# <<crowbar\n"
+        "# import os, time\n"
+        "# deadline = time.time() + 10\n"
+        f"# while not os.path.exists({str(done)!r}) and time.time() < deadline:\n"
+        "#     time.sleep(0.01)\n"
+        "# >>\n"
+        "# <<end>>\n"
+    )
+    fast.write_text(f"# <<crowbar open({str(done)!r}, 'w').close()>>\n# <<end>>\n")
+    p = CrowbarPreprocessor()
+    results = list(p.iter_process_many([slow, fast], jobs=2, check=True, ordered=False))
+    assert [r.input_file for r in results] == [fast, slow]
+
+
+def test_main_two_paths(tmp_path, monkeypatch, capsys):
+    """Two plain paths are input and output file, unless the second has blocks"""
+    monkeypatch.chdir(tmp_path)
+    one, two = tmp_path / "one.py", tmp_path / "two.py"
+    one.write_text("# <<crowbar emit('one')>>\n# <<end>>\n")
+    two.write_text("# <<crowbar emit('two')>>\n# <<end>>\nhand-written\n")
+    monkeypatch.setattr("sys.argv", ["crowbar.py", "--no-cache", "one.py", "two.py"])
+    with pytest.raises(SystemExit):
+        crowbar.main()
+    assert "two.py contains blocks" in capsys.readouterr().err
+    assert slurp(two).endswith("hand-written\n")
+
+    out = tmp_path / "out.py"
+    monkeypatch.setattr("sys.argv", ["crowbar.py", "--no-cache", "one.py", "out.py"])
+    crowbar.main()
+    assert slurp(out) == "# <<crowbar emit('one')>>\none\n# <<end>>\n"
+    assert slurp(one) == "# <<crowbar emit('one')>>\n# <<end>>\n"
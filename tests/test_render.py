@@ -363,3 +363,558 @@ def test_emit_state_retained_across_render_calls():
 render1
 render2"""
     )
+
+
+@component
+def _nested_tree(emit, depth=3):
+    if depth == 0:
+        emit("leaf;", lc, "// done", nl)
+        return
+    emit(
+        f"level{depth} {{",
+        [_nested_tree(depth=depth - 1), indent, "x;", dedent, _nested_tree(depth - 1)],
+        "}",
+        fl,
+    )
+
+
+def _render_unbuffered(*args, **kwargs):
+    out = []
+    emit = Emitter(writer=out.append, **kwargs)
+    emit(*args)
+    return "".join(out)
+
+
+@pytest.mark.parametrize("threshold", [0, 1, 16, 1 << 20])
+def test_buffered_same_output(threshold):
+    """Buffering output must not change it"""
+    expected = _render_unbuffered(_nested_tree(), base_indent="  ")
+
+    out = []
+    emit = Emitter(writer=out.append, base_indent="  ", flush_threshold=threshold)
+    emit(_nested_tree())
+    emit.flush()
+    assert "".join(out) == expected
+
+
+def test_buffered_flush_threshold():
+    """Output is passed on in bulk, once the threshold is reached"""
+    calls = []
+    emit = Emitter(writer=lambda s: calls.append(s), flush_threshold=10)
+    emit("hello")
+    assert calls == []
+    emit("world")
+    # a single call for newline, indentation and text of both lines
+    assert calls == ["hello\nworld"]
+    emit("!")
+    assert len(calls) == 1
+    emit.flush()
+    assert calls == ["hello\nworld", "\n!"]
+    emit.flush()
+    assert len(calls) == 2
+
+
+def test_buffered_sinks(tmp_path):
+    """Files (writelines) and file descriptors (os.writev) are supported as sinks"""
+    import io
+
+    expected = _render_unbuffered(_nested_tree())
+
+    buf = io.StringIO()
+    with Emitter(writer=buf, flush_threshold=32) as emit:
+        emit(_nested_tree())
+    assert buf.getvalue() == expected
+
+    buf = io.StringIO()
+    with Emitter(writer=buf.write, flush_threshold=32) as emit:
+        emit(_nested_tree())
+    assert buf.getvalue() == expected
+
+    fpath = tmp_path / "out.txt"
+    with open(fpath, "wb") as fh:
+        with Emitter(writer=fh.fileno(), flush_threshold=32) as emit:
+            emit(_nested_tree(), "æøå")
+    assert slurp(fpath) == expected + "\næøå"
+
+
+def test_deep_nesting():
+    """Deeply nested lists and components must not hit the recursion limit"""
+    import sys
+
+    depth = sys.getrecursionlimit() * 2
+
+    tree = ["leaf"]
+    for _ in range(depth):
+        tree = ["{", tree, "}"]
+    out = []
+    Emitter(writer=out.append, indent_step=" ")(tree)
+    lines = "".join(out).split("\n")
+    assert len(lines) == 2 * depth + 1
+    assert lines[depth] == " " * (depth + 1) + "leaf"
+    assert lines[-1] == " }"
+
+    @component
+    def nest(emit, n):
+        if n == 0:
+            emit("leaf")
+        else:
+            emit(f"{n}:", lc, nest(n - 1))
+
+    out = []
+    Emitter(writer=out.append)(nest(depth))
+    assert "".join(out) == "".join(f"{n}:" for n in range(depth, 0, -1)) + "leaf"
+
+    # components emitting their children through helpers, costing more frames
+    def h1(emit, n):
+        h2(emit, n)
+
+    def h2(emit, n):
+        h3(emit, n)
+
+    def h3(emit, n):
+        emit(f"{n}:", lc, helped(n - 1))
+
+    @component
+    def helped(emit, n):
+        if n == 0:
+            emit("leaf")
+        else:
+            h1(emit, n)
+
+    assert render(helped(depth)) == "".join(out)
+
+
+def test_component_runs_when_emitted():
+    """Component bodies run as they are emitted, so their errors and side effects reach the emitting component"""
+    calls = []
+
+    @component
+    def child(emit, fail):
+        calls.append("child")
+        if fail:
+            raise ValueError("child failed")
+        emit("child")
+
+    @component
+    def parent(emit):
+        emit([child(False)])
+        calls.append("after child")
+        try:
+            emit(child(True))
+        except ValueError:
+            emit("recovered")
+        calls.append("parent end")
+
+    assert _render_unbuffered(parent()) == "   child\nrecovered"
+    assert calls == ["child", "after child", "child", "parent end"]
+    assert render(parent()) == "   child\nrecovered"
+
+
+def test_cached_component():
+    """Cached components render once, and replay at any indentation level"""
+    calls = 0
+
+    @component(cache=True)
+    def struct(emit, name, *fields):
+        nonlocal calls
+        calls += 1
+        emit(f"struct {name} {{", [f"int {f};" for f in fields], "};")
+
+    @component
+    def uncached(emit, name, *fields):
+        emit(f"struct {name} {{", [f"int {f};" for f in fields], "};")
+
+    def doc(s):
+        return [s("point", "x", "y"), "{", [s("point", "x", "y"), [s("point", "x", "y")]]]
+
+    expected = _render_unbuffered(doc(uncached), base_indent="  ")
+    assert _render_unbuffered(doc(struct), base_indent="  ") == expected
+    assert calls == 1
+    assert struct.cache_info() == (2, 1, 128, 1)
+
+    struct.cache_clear()
+    assert struct.cache_info() == (0, 0, 128, 0)
+    assert uncached.cache_info() is None
+
+
+def test_cached_component_args():
+    @component(cache=2)
+    def value(emit, v, suffix=""):
+        emit(f"{v!r}{suffix}")
+
+    def render(*args):
+        return _render_unbuffered(*[x for arg in args for x in (lc, arg)])
+
+    assert render(value(1), value(1.0), value(1)) == "11.01"
+    assert value.cache_info().hits == 1
+    assert value.cache_info().currsize == 2
+    # LRU eviction
+    render(value(2))
+    assert value.cache_info().currsize == 2
+    assert render(value(v=1, suffix="!"), value(suffix="!", v=1)) == "1!1!"
+    assert value.cache_info().hits == 2
+    # unhashable arguments are rendered, but not cached
+    assert render(value([1])) == "[1]"
+    assert value.cache_info().currsize == 2
+
+
+def test_cached_component_nested():
+    """Cached components can contain (cached) components, markers and lists"""
+
+    @component
+    def inner(emit, n):
+        emit("inner", lc, n, nl)
+
+    @component(cache=True)
+    def leaf(emit, n):
+        emit(fl, "leaf", indent, n, dedent, inner(n))
+
+    @component(cache=True)
+    def outer(emit, n):
+        emit("outer", [leaf(n), leaf(n + 1)], lc, "end")
+
+    expected = (
+        "outer\n   leaf\n      1\n   inner1\n\n   leaf\n      2\n   inner2\nend"
+    )
+    assert _render_unbuffered(outer(1)) == expected
+    assert _render_unbuffered(outer(1)) == expected
+    assert outer.cache_info().hits == 1
+    assert leaf.cache_info().misses == 2
+
+
+def test_cached_component_deep_nesting():
+    """Deeply nested cached components must not hit the recursion limit"""
+    import sys
+
+    depth = sys.getrecursionlimit() * 2
+
+    @component(cache=depth + 1)
+    def nest(emit, n):
+        if n == 0:
+            emit("leaf")
+        else:
+            emit(f"{n}:", lc, nest(n - 1))
+
+    def expected(n):
+        return "".join(f"{i}:" for i in range(n, 0, -1)) + "leaf"
+
+    assert render(nest(depth)) == expected(depth)
+    assert nest.cache_info().misses == depth + 1
+    assert render(nest(depth)) == expected(depth)
+    assert render([nest(depth - 1)]) == "   " + expected(depth - 1)
+    assert nest.cache_info().hits == 2
+
+
+def test_component_pickle():
+    """Components pickle by reference, like functions"""
+    import pickle
+
+    assert pickle.loads(pickle.dumps(_nested_tree)) is _nested_tree
+
+
+def test_render():
+    assert render(_nested_tree(), base_indent="  ", indent_step="\t") == (
+        _render_unbuffered(_nested_tree(), base_indent="  ", indent_step="\t")
+    )
+    assert render() == ""
+    assert render("a", ["b"], lc, "c") == "a\n   bc"
+
+
+def test_capture():
+    """capture() renders within components, using the active emitter's indent_step"""
+
+    @component
+    def body(emit):
+        emit("line1", ["line2"])
+
+    @component
+    def boxed(emit, child):
+        lines = capture(child).split("\n")
+        width = max(map(len, lines))
+        emit("+" + "-" * width + "+", [f"{line:<{width}}" for line in lines], "+")
+
+    assert render([boxed(body())], indent_step="  ") == "\n".join(
+        [
+            "  +-------+",
+            "    line1  ",
+            "      line2",
+            "  +",
+        ]
+    )
+    assert capture(body()) == "line1\n   line2"
+
+    # the output of cached components capturing others depends on the indent_step
+    @component(cache=True)
+    def captured(emit):
+        emit(capture(body()))
+
+    assert render(captured(), indent_step="  ") == "line1\n  line2"
+    assert render(captured(), indent_step="\t") == "line1\n\tline2"
+    assert render(captured(), indent_step="  ") == "line1\n  line2"
+    assert captured.cache_info().hits == 1
+
+
+def test_iter_chunks():
+    tree = [_nested_tree(depth=6) for _ in range(5)]
+    expected = render(tree, indent_step="  ")
+
+    emit = Emitter(writer=lambda s: pytest.fail("writer must not be used"), indent_step="  ")
+    chunks = list(emit.iter_chunks(tree, chunk_size=100))
+    assert "".join(chunks) == expected
+    assert len(chunks) > 1
+    # chunks only exceed chunk_size by (less than) one token
+    assert all(len(c) < 100 + 20 for c in chunks)
+
+
+def test_iter_chunks_lazy():
+    """Components are only rendered once output is requested"""
+    rendered = []
+
+    @component
+    def table(emit, i):
+        rendered.append(i)
+        emit([f"{{{i}, {j}}}," for j in range(100)])
+
+    emit = Emitter(writer=print)
+    chunks = emit.iter_chunks(
+        "int table[] = {", [table(i) for i in range(100)], "};", chunk_size=1000
+    )
+    first = next(chunks)
+    assert first.startswith("int table[] = {")
+    assert len(rendered) < 10
+    rest = "".join(chunks)
+    assert rendered == list(range(100))
+    assert (first + rest).endswith("{99, 99},\n};")
+
+    # the emitter can be used as normal afterwards
+    out = []
+    emit = Emitter(writer=out.append)
+    assert "".join(emit.iter_chunks("a", "b")) == "a\nb"
+    emit("c")
+    assert out == ["\n", "", "c"]
+
+
+def test_iter_chunks_nested_lazy():
+    """The output of a single component is rendered as chunks are requested"""
+    rows = []
+
+    @component
+    def row(emit, i):
+        rows.append(i)
+        emit(f"{{{i}, {i * 2}}},")
+
+    @component
+    def table(emit, n):
+        emit("int table[][2] = {")
+        for i in range(n):
+            emit([row(i)])
+        emit("};")
+
+    emit = Emitter(writer=print)
+    chunks = emit.iter_chunks(table(10_000), chunk_size=1000)
+    first = next(chunks)
+    assert first.startswith("int table[][2] = {")
+    assert len(rows) < 200
+    # no more is rendered once the chunks are no longer wanted
+    chunks.close()
+    assert len(rows) < 200
+    assert "".join(Emitter(print).iter_chunks(table(3))) == render(table(3))
+
+    @component
+    def failing(emit):
+        emit("ok")
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError, match="failed"):
+        list(emit.iter_chunks(failing()))
+
+
+class _StreamWriter:
+    """Stand-in for asyncio.StreamWriter"""
+
+    def __init__(self):
+        self.data = b""
+        self.drains = 0
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        self.drains += 1
+
+
+def test_async_emitter():
+    import asyncio
+
+    events = []
+    release = None
+
+    @component
+    async def fetch(emit, name, wait):
+        # "slow" can only finish once "fast", emitted after it, ran
+        events.append(f"start {name}")
+        if wait:
+            await release.wait()
+        else:
+            release.set()
+        events.append(f"end {name}")
+        emit(f"{name} = {{", [field(name, i) for i in range(2)], "}")
+
+    @component
+    def field(emit, name, i):
+        emit(f"{name}_{i},")
+
+    @component
+    def module(emit):
+        emit("// generated", [fetch("slow", True), fetch("fast", False)], nl)
+
+    async def value():
+        await asyncio.sleep(0)
+        return "trailer"
+
+    async def main():
+        nonlocal release
+        release = asyncio.Event()
+        await asyncio.wait_for(emit(module(), value(), "æøå"), timeout=10)
+
+    writer = _StreamWriter()
+    emit = AsyncEmitter(writer, indent_step="  ")
+    asyncio.run(main())
+
+    # siblings resolve concurrently, but output keeps the declared order
+    assert events.index("start slow") < events.index("start fast")
+    assert events.index("end fast") < events.index("end slow")
+    assert writer.data.decode("utf-8") == render(
+        "// generated",
+        ["slow = {", ["slow_0,", "slow_1,"], "}", "fast = {", ["fast_0,", "fast_1,"], "}"],
+        nl,
+        "trailer",
+        "æøå",
+        indent_step="  ",
+    )
+    assert writer.drains >= 1
+
+
+def test_async_emitter_cached_component():
+    import asyncio
+
+    calls = []
+
+    @component(cache=True)
+    def header(emit, name):
+        calls.append(name)
+        emit(f"// {name}", ["generated"])
+
+    writer = _StreamWriter()
+    asyncio.run(AsyncEmitter(writer)(header("a"), [header("a")], header("b")))
+    assert writer.data.decode("utf-8") == render(header("a"), [header("a")], header("b"))
+    assert calls == ["a", "b"]
+    assert header.cache_info().misses == 2
+
+
+def test_async_emitter_sync_components():
+    """Sync components run as they are emitted, up to an async one"""
+    import asyncio
+
+    calls = []
+
+    @component
+    def child(emit, name, fail=False):
+        calls.append(name)
+        if fail:
+            raise ValueError("child failed")
+        emit(name)
+
+    @component
+    def parent(emit):
+        emit([child("a")])
+        calls.append("after a")
+        try:
+            emit(child("b", fail=True))
+        except ValueError:
+            emit("recovered")
+
+    @component
+    async def fetch(emit, name):
+        await asyncio.sleep(0)
+        calls.append(name)
+        emit(name)
+
+    @component
+    def mixed(emit):
+        emit(child("c"), [fetch("d"), child("e")])
+        calls.append("after d")
+        emit(child("f"))
+
+    writer = _StreamWriter()
+    asyncio.run(AsyncEmitter(writer)(parent()))
+    assert writer.data.decode("utf-8") == render(parent()) == "   a\nrecovered"
+    assert calls[:3] == ["a", "after a", "b"]
+
+    # what follows an async component, runs once it resolved
+    calls.clear()
+    writer = _StreamWriter()
+    asyncio.run(AsyncEmitter(writer)(mixed(), "end"))
+    assert writer.data.decode("utf-8") == "c\n   d\n   e\nf\nend"
+    assert calls == ["c", "after d", "d", "e", "f"]
+
+
+def test_async_emitter_backpressure():
+    import asyncio
+
+    writer = _StreamWriter()
+    emit = AsyncEmitter(writer, high_water=100)
+    lines = [f"line {i}" for i in range(100)]
+    asyncio.run(emit(lines))
+    assert writer.data.decode() == render(lines)
+    assert writer.drains >= len(writer.data) // 100
+
+
+def test_async_emitter_errors():
+    import asyncio
+
+    cancelled = []
+
+    @component
+    async def fails(emit):
+        raise RuntimeError("boom")
+
+    @component
+    async def slow(emit):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    with pytest.raises(RuntimeError, match="boom"):
+        asyncio.run(AsyncEmitter(_StreamWriter())(fails(), slow()))
+    assert cancelled == [True]
+
+    # async components cannot be rendered by the synchronous Emitter
+    with pytest.raises(TypeError, match="AsyncEmitter"):
+        render(fails())
+
+
+def test_async_emitter_stream():
+    """Render to a real asyncio stream"""
+    import asyncio
+    import socket
+
+    @component
+    async def greet(emit, name):
+        await asyncio.sleep(0)
+        emit(f"hello, {name}!")
+
+    async def main():
+        rsock, wsock = socket.socketpair()
+        reader, rwriter = await asyncio.open_connection(sock=rsock)
+        _, writer = await asyncio.open_connection(sock=wsock)
+        await AsyncEmitter(writer)(greet("gordon"), greet("alex"))
+        writer.write_eof()
+        data = await reader.read()
+        writer.close()
+        rwriter.close()
+        return data
+
+    assert asyncio.run(main()) == b"hello, gordon!\nhello, alex!"
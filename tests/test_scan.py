@@ -0,0 +1,216 @@
+from crowbar import CrowbarError, CrowbarPreprocessor
+from crowbar import (
+    _discover,
+    _find_markers,
+    _git_changed,
+    _MarkerIndex,
+    _scan_tree,
+    _select_changed,
+)
+import crowbar
+from pathlib import Path
+import os
+import pytest
+import subprocess
+
+BLOCK = "# <<crowbar emit('x')>>\n# <<end>>\n"
+
+
+def make_tree(root, files):
+    for relpath, contents in files.items():
+        fpath = root / relpath
+        fpath.parent.mkdir(parents=True, exist_ok=True)
+        fpath.write_text(contents)
+
+
+def relpaths(root, paths):
+    return sorted(Path(p).relative_to(root).as_posix() for p in paths)
+
+
+def test_discover_gitignore(tmp_path):
+    (tmp_path / ".git").mkdir()
+    make_tree(
+        tmp_path,
+        {
+            ".gitignore": "# comment\n*.log\n!keep.log\nbuild/\n/top.c\n",
+            "a.c": "",
+            "top.c": "",
+            "src/top.c": "",
+            "src/x.log": "",
+            "src/keep.log": "",
+            "src/build/gen.c": "",
+            "src/.gitignore": "gen_*\nsub/*.h\n",
+            "src/gen_a.c": "",
+            "src/sub/a.h": "",
+            "src/sub/deeper/a.h": "",
+            ".git/config": "",
+        },
+    )
+    assert relpaths(tmp_path, _discover(tmp_path)) == [
+        ".gitignore",
+        "a.c",
+        "src/.gitignore",
+        "src/keep.log",
+        "src/sub/deeper/a.h",
+        "src/top.c",
+    ]
+    # rules of the .gitignore files above the scanned directory apply
+    assert relpaths(tmp_path, _discover(tmp_path / "src")) == [
+        "src/.gitignore",
+        "src/keep.log",
+        "src/sub/deeper/a.h",
+        "src/top.c",
+    ]
+
+
+def test_discover_include_exclude(tmp_path):
+    make_tree(
+        tmp_path,
+        {
+            "a.c": "",
+            "a.h": "",
+            "src/b.c": "",
+            "src/vendor/c.c": "",
+            "vendor/d.c": "",
+            "cache/e.c": "",
+        },
+    )
+    found = _discover(
+        tmp_path, include=["*.c"], exclude=["/vendor"], skip=[tmp_path / "cache"]
+    )
+    assert relpaths(tmp_path, found) == ["a.c", "src/b.c", "src/vendor/c.c"]
+    found = _discover(tmp_path, include=["src/**/*.c"], exclude=["vendor/"])
+    assert relpaths(tmp_path, found) == ["src/b.c"]
+
+
+@pytest.mark.parametrize("offset", [0, (1 << 16) - 4, (1 << 20) + 3])
+def test_find_markers(tmp_path, offset):
+    fpath = tmp_path / "file"
+    fpath.write_bytes(b"x" * offset + b"\n<<crowbar <<crowbar\n\nx <<crowbar")
+    assert _find_markers(fpath) == [(offset + 1, 2), (offset + 22, 4)]
+    fpath.write_bytes(b"x" * offset + b"<<crowba" + b"x" * 10)
+    assert _find_markers(fpath) == []
+    assert _find_markers(tmp_path / "missing") is None
+
+
+def test_scan_tree(tmp_path):
+    make_tree(
+        tmp_path,
+        {"a.py": BLOCK, "b.py": "x = 1\n", "sub/c.py": f"x = 1\n{BLOCK}"},
+    )
+    os.symlink(tmp_path / "sub", tmp_path / "link")
+    assert relpaths(tmp_path, _scan_tree(tmp_path, threads=2)) == ["a.py", "sub/c.py"]
+
+
+def test_marker_index(tmp_path, monkeypatch):
+    make_tree(tmp_path / "src", {"a.py": BLOCK, "b.py": "x = 1\n"})
+    index = _MarkerIndex(tmp_path / "index.json")
+    # a stale mtime, as the index does not trust recently modified files
+    for name in ("a.py", "b.py"):
+        os.utime(tmp_path / "src" / name, ns=(0, 1_000_000_000))
+    assert relpaths(tmp_path, _scan_tree(tmp_path / "src", index=index)) == ["src/a.py"]
+    st = os.stat(tmp_path / "src" / "a.py")
+    assert _MarkerIndex(tmp_path / "index.json").lookup(
+        str(tmp_path / "src" / "a.py"), st
+    ) == [(0, 1)]
+
+    # only files whose stat changed are read again
+    read = []
+    find_markers = crowbar._find_markers
+    monkeypatch.setattr(
+        crowbar, "_find_markers", lambda p: read.append(p) or find_markers(p)
+    )
+    (tmp_path / "src" / "b.py").write_text(BLOCK)
+    index = _MarkerIndex(tmp_path / "index.json")
+    assert relpaths(tmp_path, _scan_tree(tmp_path / "src", index=index)) == [
+        "src/a.py",
+        "src/b.py",
+    ]
+    assert relpaths(tmp_path, read) == ["src/b.py"]
+
+
+def test_process_file_marker_hints(tmp_path):
+    """Large files are processed using the block lines recorded by a scan"""
+    padding = "x = 1\n" * 20_000
+    fpath = tmp_path / "file.py"
+    fpath.write_text(
+        f"{padding}{BLOCK}{padding}# <<crowbar\n# emit('<<crowbar')\n# >>\n# <<end>>\n"
+    )
+    os.utime(fpath, ns=(0, 1_000_000_000))
+    p = CrowbarPreprocessor(cache_dir=tmp_path / "cache")
+    assert _scan_tree(tmp_path, skip=[tmp_path / "cache"], index=p._marker_index) == [
+        str(fpath)
+    ]
+    st = os.stat(fpath)
+    assert len(p._marker_index.lookup(str(fpath), st)) == 3
+
+    p.process_file(fpath, tmp_path / "out.py")
+    lines = (tmp_path / "out.py").read_text().split("\n")
+    assert lines[20_000:20_003] == ["# <<crowbar emit('x')>>", "x", "# <<end>>"]
+    assert lines[-4:] == ["# >>", "<<crowbar", "# <<end>>", ""]
+    assert [b.lineno for b in p.dependency_report().blocks] == [20_001, 40_003]
+
+
+def git(cwd, *args):
+    subprocess.run(
+        ["git", "-c", "user.name=crowbar", "-c", "user.email=crowbar@localhost", *args],
+        cwd=cwd,
+        check=True,
+        capture_output=True,
+    )
+
+
+def test_changed_since(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    make_tree(
+        tmp_path,
+        {
+            ".gitignore": "cache/\n*.log\n",
+            "changed_helper.py": "NAME = 'a'\n",
+            "data.txt": "b\n",
+            "a.py": "# <<crowbar\n"
+            "# from changed_helper import NAME\n"
+            "# emit(NAME)\n"
+            "# >>\n"
+            "# <<end>>\n",
+            "b.py": "# <<crowbar emit(open('data.txt').read())>>\n# <<end>>\n",
+            "c.py": BLOCK,
+        },
+    )
+    git(tmp_path, "init", "-q")
+    git(tmp_path, "add", ".")
+    git(tmp_path, "commit", "-q", "-m", "initial")
+    p = CrowbarPreprocessor(cache_dir="cache")
+    assert all(r.ok for r in p.process_many(["a.py", "b.py", "c.py"], jobs=1))
+    git(tmp_path, "commit", "-q", "-am", "generate")
+    assert _git_changed("HEAD") == set()
+
+    def select(files):
+        changed = _git_changed("HEAD")
+        return _select_changed(p, files, changed, "  ", False)
+
+    (tmp_path / "changed_helper.py").write_text("NAME = 'b'\n")
+    (tmp_path / "new.py").write_text(BLOCK)  # untracked, no dependency information
+    (tmp_path / "x.log").write_text("ignored")
+    assert _git_changed("HEAD") == {
+        str(tmp_path / "changed_helper.py"),
+        str(tmp_path / "new.py"),
+    }
+    assert select(["a.py", "b.py", "c.py", "new.py"]) == ["a.py", "new.py"]
+
+    git(tmp_path, "add", ".")
+    git(tmp_path, "commit", "-q", "-m", "update helper")
+    (tmp_path / "data.txt").write_text("c\n")
+    assert select(["a.py", "b.py", "c.py"]) == ["b.py"]
+    # changes committed since the revision count as well
+    assert _git_changed("HEAD~1") == {
+        str(tmp_path / "changed_helper.py"),
+        str(tmp_path / "data.txt"),
+        str(tmp_path / "new.py"),
+    }
+    # without a cache nothing is known about dependencies
+    p = CrowbarPreprocessor()
+    assert select(["a.py", "b.py", "c.py"]) == ["a.py", "b.py", "c.py"]
+
+    with pytest.raises(CrowbarError, match="unknown git revision"):
+        _git_changed("no-such-branch")
@@ -0,0 +1,70 @@
+from crowbar import *
+from crowbar import FileParseError, _Server, _request
+from test_utils.utils import slurp, write
+from pathlib import Path
+import json
+import os
+import pytest
+import socket
+import threading
+
+BLOCK = """\
+# <<crowbar
+# from serve_helper import NAME
+# emit(f"hello, {NAME}!")
+# >>
+# <<end>>
+"""
+
+
+@pytest.fixture
+def server(tmp_path):
+    log = []
+    server = _Server(CrowbarPreprocessor(), str(tmp_path / "s.sock"), report=log.append)
+    thread = threading.Thread(target=server.run)
+    thread.start()
+    yield server
+    server.close()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    assert not os.path.exists(server.socket_path)
+
+
+def test_server(server, tmp_path, monkeypatch):
+    write(tmp_path / "serve_helper.py", "NAME = 'gordon'\n")
+    src, broken = tmp_path / "src.py", tmp_path / "broken.py"
+    write(src, BLOCK)
+    write(broken, "# <<crowbar emit(undefined)>>\n# <<end>>\n")
+
+    # relative paths are resolved against the working directory of the client
+    monkeypatch.chdir(tmp_path)
+    results = _request(server.socket_path, ["src.py", ("broken.py", "out.py")])
+    assert [r.input_file for r in results] == [Path("src.py"), Path("broken.py")]
+    assert results[0].ok and results[0].status == "rewritten"
+    assert "hello, gordon!" in slurp(src)
+    assert list(results[0].dependencies.modules) == ["serve_helper"]
+    assert isinstance(results[1].error, FileParseError)
+    assert "NameError" in str(results[1].error)
+    assert results[1].output_file == Path("out.py")
+
+    # modules changed between requests are reloaded
+    write(tmp_path / "serve_helper.py", "NAME = 'alex'\n")
+    results = _request(server.socket_path, [str(src)])
+    assert results[0].ok
+    assert "hello, alex!" in slurp(src)
+
+
+def test_server_invalid_request(server):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(server.socket_path)
+        with sock.makefile("rwb") as f:
+            # the connection stays usable after a bad request
+            for line in (b"not json\n", b'{"files": []}\n'):
+                f.write(line)
+                f.flush()
+                assert "invalid request" in json.loads(f.readline())["error"]
+
+
+def test_server_already_running(server):
+    with pytest.raises(CrowbarError, match="already listening"):
+        _Server(CrowbarPreprocessor(), server.socket_path)
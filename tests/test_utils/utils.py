@@ -25,6 +25,14 @@ def slurp(fname: Fpath, encoding="utf-8") -> str:
         return fh.read()
 
 
+def write(fpath: Path, contents: str) -> None:
+    """Write `contents` to `fpath`, ensuring the change can be seen from its stat."""
+    st = fpath.stat() if fpath.exists() else None
+    fpath.write_text(contents)
+    if st is not None and fpath.stat().st_mtime_ns == st.st_mtime_ns:
+        os.utime(fpath, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))
+
+
 class WithNamedTempFile:
     def __init__(self, prefix: Optional[str] = None, suffix: str = ".tmp"):
         fd, path = tempfile.mkstemp(prefix=prefix, suffix=suffix, text=True)
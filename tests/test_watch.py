@@ -0,0 +1,142 @@
+from crowbar import *
+from crowbar import _Watcher, _PollingMonitor, _InotifyMonitor
+from test_utils.utils import slurp, write
+import pytest
+import sys
+import threading
+import time
+
+BLOCK = """\
+# <<crowbar
+# from watch_comp import greet
+# emit(greet())
+# >>
+# <<end>>
+"""
+
+PLAIN = """\
+# <<crowbar emit("static")>>
+# <<end>>
+"""
+
+
+def test_watcher_reloads_dependencies(tmp_path):
+    write(tmp_path / "watch_helper.py", "NAME = 'gordon'\n")
+    write(
+        tmp_path / "watch_comp.py",
+        "from crowbar import *\n"
+        "from watch_helper import NAME\n"
+        "@component\n"
+        "def greet(emit):\n"
+        "    emit(f'hello, {NAME}!')\n",
+    )
+    uses_comp, plain = tmp_path / "uses_comp.py", tmp_path / "plain.py"
+    write(uses_comp, BLOCK)
+    write(plain, PLAIN)
+
+    log = []
+    watcher = _Watcher(
+        CrowbarPreprocessor(),
+        [str(uses_comp), str(plain)],
+        _PollingMonitor(0.01),
+        report=log.append,
+        indent_step="  ",
+        omit_code_blocks=False,
+        write_if_changed=None,
+    )
+    watcher.process(watcher.jobs)
+    assert "hello, gordon!" in slurp(uses_comp)
+    assert str(tmp_path / "watch_helper.py") in watcher.watched()
+
+    # our own writes are ignored
+    log.clear()
+    watcher.handle_changes({str(uses_comp), str(plain)})
+    assert log == []
+
+    # changing a module imported by a component module, reloads both
+    # and reprocesses only the files depending on them.
+    write(tmp_path / "watch_helper.py", "NAME = 'alex'\n")
+    watcher.handle_changes({str(tmp_path / "watch_helper.py")})
+    assert "hello, alex!" in slurp(uses_comp)
+    assert [line.split(" ")[:2] for line in log] == [
+        ["reloaded", "watch_helper"],
+        ["reloaded", "watch_comp"],
+        [f"{uses_comp}:", "rewritten"],
+    ]
+
+    # editing an input file reprocesses just that file
+    log.clear()
+    write(plain, PLAIN.replace("static", "dynamic"))
+    watcher.handle_changes({str(plain)})
+    assert log[0].startswith(f"{plain}: rewritten")
+    assert "\ndynamic\n" in slurp(plain)
+
+
+def test_watcher_warm_cache(tmp_path):
+    """Modules of files served from the cache, never imported, are watched too"""
+    comps = tmp_path / "watch_cached.py"
+    write(comps, "VALUE = 'v1'\n")
+    gen = tmp_path / "gen.py"
+    write(
+        gen,
+        "# <<crowbar\n# from watch_cached import VALUE\n# emit(VALUE)\n# >>\n"
+        "# <<end>>\n",
+    )
+
+    def make_watcher(log):
+        return _Watcher(
+            CrowbarPreprocessor(cache_dir=tmp_path / "cache"),
+            [str(gen)],
+            _PollingMonitor(0.01),
+            report=log.append,
+            indent_step="  ",
+            omit_code_blocks=False,
+            write_if_changed=None,
+        )
+
+    warm = make_watcher([])
+    warm.process(warm.jobs)
+    # as if in a new process
+    del sys.modules["watch_cached"]
+
+    log = []
+    watcher = make_watcher(log)
+    watcher.process(watcher.jobs)
+    assert "watch_cached" not in sys.modules
+    assert str(comps) in watcher.watched()
+
+    write(comps, "VALUE = 'v2'\n")
+    watcher.handle_changes({str(comps)})
+    assert "\nv2\n" in slurp(gen)
+    assert log[-1].startswith(f"{gen}: rewritten")
+
+
+def _check_monitor(monitor, tmp_path):
+    watched, other = tmp_path / "watched.txt", tmp_path / "other.txt"
+    write(watched, "1")
+    write(other, "1")
+    monitor.watch([str(watched)])
+    assert monitor.wait(timeout=0.05) == set()
+
+    def modify():
+        time.sleep(0.05)
+        write(other, "2")
+        write(watched, "22")
+
+    t = threading.Thread(target=modify)
+    t.start()
+    assert monitor.wait(timeout=5) == {str(watched)}
+    t.join()
+    monitor.close()
+
+
+def test_polling_monitor(tmp_path):
+    _check_monitor(_PollingMonitor(0.01), tmp_path)
+
+
+def test_inotify_monitor(tmp_path):
+    try:
+        monitor = _InotifyMonitor()
+    except (OSError, AttributeError, TypeError):
+        pytest.skip("inotify not available")
+    _check_monitor(monitor, tmp_path)